@@ -0,0 +1,18 @@
+"""Benchmarks for the dairy API.
+
+    python -m benchmarks seed --workdir bench-data
+    python -m benchmarks run --workdir bench-data --output before.json
+    python -m benchmarks compare before.json after.json
+    python -m benchmarks scale --workdir bench-data --from-copy --postgres
+
+``seed`` builds a scratch database at production volumes (10k customers,
+10M milk entries, three years of sales, purchases and expenses; smaller
+with --customers/--milks/--years). ``run`` drives every route through the
+ASGI app in process and reports throughput, p50/p95/p99 latency and peak
+RSS per scenario as JSON, which ``compare`` diffs between two commits.
+``scale`` repeats the write scenarios at 1 to 16 concurrent writers. With
+--postgres, either command copies the seeded data into a local PostgreSQL
+server (see benchmarks/postgres.py) and runs the app against that instead;
+with --archive, ``run`` first archives the paid rows older than a year, to
+compare the hot tables with and without their history.
+"""
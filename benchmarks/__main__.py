@@ -0,0 +1,135 @@
+import argparse
+import contextlib
+import json
+import os
+import shutil
+import sys
+
+from benchmarks import driver, postgres, seed
+
+# Collection writes, for scale: new entries, corrections and settlements.
+WRITE_SCENARIOS = ["create milk", "patch milk", "settle milk"]
+LEVELS = [1, 2, 4, 8, 16]
+
+
+def seed_database(args):
+    os.makedirs(args.workdir, exist_ok=True)
+    path = os.path.join(args.workdir, "dairy-database.db")
+    counts = seed.seed(
+        path, customers=args.customers, milks=args.milks, years=args.years, seed=args.seed
+    )
+    if args.keep_copy:
+        shutil.copyfile(path, path + ".seed")
+    print(json.dumps(counts))
+
+
+def _run(args, concurrency, only):
+    if args.from_copy:
+        path = os.path.join(args.workdir, "dairy-database.db")
+        # A write-ahead log left by an earlier run belongs to the old file.
+        for suffix in ("-wal", "-shm"):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+        shutil.copyfile(path + ".seed", path)
+        # So are the archives it made.
+        shutil.rmtree(os.path.join(args.workdir, "archive"), ignore_errors=True)
+    log = lambda line: print(line, file=sys.stderr)
+    with contextlib.ExitStack() as stack:
+        database_url = None
+        if args.postgres:
+            database_url = stack.enter_context(postgres.server(args.workdir, port=args.port))
+        return driver.run(
+            args.workdir,
+            requests=args.requests,
+            concurrency=concurrency,
+            seed=args.seed,
+            only=only,
+            log=log,
+            database_url=database_url,
+            archive=args.archive,
+        )
+
+
+def _write(args, report):
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as output:
+            output.write(text + "\n")
+    else:
+        print(text)
+
+
+def run(args):
+    report = _run(args, args.concurrency, args.only)
+    _write(args, report)
+    if report["uncovered"]:
+        sys.exit(1)
+
+
+def scale(args):
+    report = _run(args, args.levels, args.only)
+    _write(args, report)
+    driver.scaling(report, log=lambda line: print(line, file=sys.stderr))
+
+
+def compare(args):
+    with open(args.before) as before, open(args.after) as after:
+        driver.compare(json.load(before), json.load(after))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks", description="Dairy API benchmarks")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    command = commands.add_parser("seed", help="create and fill a scratch database")
+    command.add_argument("--workdir", default="bench-data")
+    command.add_argument("--customers", type=int, default=seed.CUSTOMERS)
+    command.add_argument("--milks", type=int, default=seed.MILKS)
+    command.add_argument("--years", type=int, default=seed.YEARS)
+    command.add_argument("--seed", type=int, default=1)
+    command.add_argument(
+        "--keep-copy", action="store_true", help="save a pristine copy for run --from-copy"
+    )
+    command.set_defaults(handler=seed_database)
+
+    def run_options(command):
+        command.add_argument("--workdir", default="bench-data")
+        command.add_argument("--requests", type=int, default=driver.REQUESTS)
+        command.add_argument("--seed", type=int, default=1)
+        command.add_argument("--output", help="write the JSON report here instead of stdout")
+        command.add_argument(
+            "--from-copy", action="store_true", help="restore the seeded copy first, for exact comparisons"
+        )
+        command.add_argument(
+            "--postgres", action="store_true",
+            help="run against a local PostgreSQL server in workdir, loaded from the SQLite database",
+        )
+        command.add_argument("--port", type=int, default=postgres.PORT)
+        command.add_argument(
+            "--archive", action="store_true",
+            help="archive the paid rows older than a year first (python manage.py archive)",
+        )
+
+    command = commands.add_parser("run", help="benchmark every route")
+    run_options(command)
+    command.add_argument("--concurrency", type=int, default=driver.CONCURRENCY)
+    command.add_argument("--only", nargs="*", help="run scenarios whose name contains a word")
+    command.set_defaults(handler=run)
+
+    command = commands.add_parser("scale", help="measure write throughput as concurrent writers are added")
+    run_options(command)
+    command.add_argument("--levels", type=int, nargs="+", default=LEVELS)
+    command.add_argument("--only", nargs="*", default=WRITE_SCENARIOS)
+    command.set_defaults(handler=scale)
+
+    command = commands.add_parser("compare", help="diff two reports")
+    command.add_argument("before")
+    command.add_argument("after")
+    command.set_defaults(handler=compare)
+
+    args = parser.parse_args(argv)
+    args.handler(args)
+
+
+if __name__ == "__main__":
+    main()
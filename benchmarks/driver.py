@@ -0,0 +1,734 @@
+"""Drive every API route in process and measure it.
+
+Requests go straight into the ASGI app through httpx, so the numbers cover
+routing, validation, services, the database and serialization, but no
+network or server. Each scenario runs a fixed number of requests with a
+fixed concurrency, and its arguments come from a seeded generator, so two
+runs on the same database issue the same requests.
+"""
+import asyncio
+import datetime as _dt
+import gc
+import json
+import math
+import os
+import platform
+import random
+import re
+import resource
+import sqlite3
+import subprocess
+import sys
+import time
+
+import fastapi.routing as _routing
+import httpx
+import sqlalchemy as _sql
+
+REQUESTS = 200
+CONCURRENCY = 8
+
+# The API's Server-Timing entry for SQL: duration in ms and statement count.
+_SQL_TIMING = re.compile(r'sql;dur=([\d.]+);desc="(\d+) queries"')
+
+
+def _peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS bytes.
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def _percentile(ordered, fraction: float):
+    if not ordered:
+        return None
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+
+class Scenario:
+    """One kind of request: a route, and how to make its arguments.
+
+    ``build(rng, context)`` returns the keyword arguments for
+    ``httpx.AsyncClient.request``, including the concrete ``url``.
+    """
+
+    def __init__(self, name, method, route, build, requests=None, concurrency=None):
+        self.name = name
+        self.method = method
+        self.route = route
+        self.build = build
+        self.requests = requests
+        self.concurrency = concurrency
+
+
+class Context:
+    """What the scenarios need to know about the database and each other."""
+
+    def __init__(self, counts, first_day: _dt.date, last_day: _dt.date, names=()):
+        self.counts = counts
+        self.first_day = first_day
+        self.last_day = last_day
+        self.names = list(names) or ["Customer 1"]
+        self.headers = {}
+        self.tokens = []
+        self.created = {}
+        self.sync_tokens = []
+
+    def random_day(self, rng: random.Random):
+        span = (self.last_day - self.first_day).days
+        return self.first_day + _dt.timedelta(days=rng.randrange(span + 1))
+
+    def recent_week(self):
+        return dict(
+            date_from=(self.last_day - _dt.timedelta(days=6)).isoformat(),
+            date_to=self.last_day.isoformat(),
+        )
+
+    def take(self, table: str, rng: random.Random):
+        """An id created by an earlier scenario, used once, for updates and DELETE.
+
+        Falls back to a seeded row once the created ones run out.
+        """
+        created = self.created.get(table)
+        if created:
+            return created.pop()
+        return rng.randrange(1, self.counts[table] + 1)
+
+    def job(self, rng: random.Random):
+        """A job submitted by an earlier scenario, or job 1."""
+        return rng.choice(self.created.get("job") or [1])
+
+
+def _milk_body(rng, context):
+    customer = rng.randrange(1, context.counts["customer"] + 1)
+    lit = round(rng.uniform(1, 15), 1)
+    return dict(
+        customer_id=customer,
+        customer_name=f"Customer {customer}",
+        milk_type=rng.choice(["Cow", "Buffalo"]),
+        lit=str(lit),
+        fat=str(round(rng.uniform(3.2, 8.0), 1)),
+        snf=str(round(rng.uniform(8.0, 9.5), 1)),
+        amount=str(round(lit * 42, 2)),
+        is_paid="No",
+    )
+
+
+def _rate_chart():
+    """A rate chart covering the readings ``_milk_body`` sends, every half
+    point, for run() to install so that the milk writes are priced on the
+    server."""
+    fat = range(30, 81, 5)
+    snf = range(80, 96, 5)
+    return dict(
+        version="bench",
+        milk_types={
+            milk_type: dict(
+                fat=[f"{tenths / 10:.1f}" for tenths in fat],
+                snf=[f"{tenths / 10:.1f}" for tenths in snf],
+                rates=[[f"{base + 0.4 * f + 0.2 * s:.2f}" for s in snf] for f in fat],
+            )
+            for milk_type, base in (("Cow", 5), ("Buffalo", 10))
+        },
+    )
+
+
+def _trade_body(rng, context):
+    lit = round(rng.uniform(5, 500), 1)
+    return dict(
+        customername=f"Customer {rng.randrange(1, context.counts['customer'] + 1)}",
+        milk_type="Cow",
+        lit=str(lit),
+        amount=str(round(lit * 52, 2)),
+        is_paid="No",
+    )
+
+
+def _expense_body(rng, context):
+    return dict(remark=rng.choice(["Feed", "Diesel"]), amount=str(round(rng.uniform(50, 5000), 2)))
+
+
+def _customer_body(rng, context):
+    number = rng.randrange(10**6)
+    return dict(
+        name=f"Bench {number}", mobile="9000000000", email=f"bench{number}@example.com",
+        pan="00000", address="Bench",
+    )
+
+
+def _typed_name(rng, context):
+    """The first letters of a customer's name words, as an operator types them."""
+    words = rng.choice(context.names).split()[: rng.randint(1, 2)]
+    return " ".join(word[: rng.randint(2, 4)] for word in words)
+
+
+def _random_id(table):
+    return lambda rng, context: rng.randrange(1, context.counts[table] + 1)
+
+
+def _paid_patch(rng, context):
+    return dict(is_paid=rng.choice(["Yes", "No"]))
+
+
+LEDGERS = (
+    # (url prefix, table, body builder, filters, sparse update builder)
+    (
+        "milks", "milk", _milk_body, lambda rng, c: dict(customer_id=_random_id("customer")(rng, c)),
+        _paid_patch,
+    ),
+    ("sales", "sale", _trade_body, lambda rng, c: dict(is_paid="No", **c.recent_week()), _paid_patch),
+    ("purchases", "purchase", _trade_body, lambda rng, c: dict(is_paid="No", **c.recent_week()), _paid_patch),
+    (
+        "expenses", "expense", _expense_body, lambda rng, c: c.recent_week(),
+        lambda rng, c: dict(amount=str(round(rng.uniform(50, 5000), 2))),
+    ),
+)
+
+
+def scenarios():
+    """Every route, in an order where writes create what later updates and DELETEs use."""
+    found = [
+        Scenario("root", "GET", "/api", lambda rng, c: dict(url="/api")),
+        Scenario(
+            "signup", "POST", "/api/users",
+            lambda rng, c: dict(
+                url="/api/users",
+                json=dict(email=f"bench{rng.randrange(10**9)}@example.com", hashed_password="bench"),
+            ),
+            requests=10, concurrency=4,
+        ),
+        Scenario(
+            "login", "POST", "/api/token",
+            lambda rng, c: dict(url="/api/token", data=dict(username="bench@example.com", password="bench")),
+            requests=20, concurrency=4,
+        ),
+        Scenario("me", "GET", "/api/users/me", lambda rng, c: dict(url="/api/users/me", headers=c.headers)),
+        Scenario(
+            "password metrics", "GET", "/api/metrics/passwords",
+            lambda rng, c: dict(url="/api/metrics/passwords", headers=c.headers),
+        ),
+        Scenario("metrics", "GET", "/metrics", lambda rng, c: dict(url="/metrics")),
+        Scenario("rate chart", "GET", "/api/rate-chart", lambda rng, c: dict(url="/api/rate-chart")),
+        Scenario(
+            "customers page", "GET", "/api/customers",
+            lambda rng, c: dict(url="/api/customers", params=dict(cursor=_cursor(rng, c, "customer"), limit=100)),
+        ),
+        Scenario(
+            "customers with milks", "GET", "/api/customers",
+            lambda rng, c: dict(
+                url="/api/customers",
+                params=dict(include="milks", milk_limit=10, limit=20, cursor=_cursor(rng, c, "customer")),
+            ),
+        ),
+        Scenario(
+            "customer search", "GET", "/api/customers/search",
+            lambda rng, c: dict(url="/api/customers/search", params=dict(q=_typed_name(rng, c))),
+        ),
+        Scenario(
+            "customer", "GET", "/api/customers/{customer_id}",
+            lambda rng, c: dict(url=f"/api/customers/{_random_id('customer')(rng, c)}"),
+        ),
+        Scenario(
+            "create customer", "POST", "/api/customers",
+            lambda rng, c: dict(url="/api/customers", json=_customer_body(rng, c)),
+        ),
+        Scenario(
+            "update customer", "PUT", "/api/customers/{customer_id}",
+            lambda rng, c: dict(url=f"/api/customers/{c.take('customer', rng)}", json=_customer_body(rng, c)),
+            requests=50,
+        ),
+        Scenario(
+            "patch customer", "PATCH", "/api/customers/{customer_id}",
+            lambda rng, c: dict(
+                url=f"/api/customers/{c.take('customer', rng)}", json=dict(mobile=f"9{rng.randrange(10**9):09d}")
+            ),
+            requests=50,
+        ),
+        Scenario(
+            "delete customer", "DELETE", "/api/customers/{customer_id}",
+            lambda rng, c: dict(url=f"/api/customers/{c.take('customer', rng)}"),
+            requests=50,
+        ),
+        Scenario(
+            "export customers", "GET", "/api/customers/export",
+            lambda rng, c: dict(url="/api/customers/export", params=dict(format=rng.choice(["ndjson", "csv"]))),
+            requests=5, concurrency=1,
+        ),
+        Scenario(
+            "milk bulk 1000", "POST", "/api/milks/bulk",
+            lambda rng, c: dict(url="/api/milks/bulk", json=[_milk_body(rng, c) for _ in range(1000)]),
+            requests=10, concurrency=1,
+        ),
+        Scenario(
+            "sync, week", "GET", "/api/sync",
+            lambda rng, c: dict(url="/api/sync", params=dict(since=c.recent_week()["date_from"])),
+            requests=20,
+        ),
+        Scenario(
+            "sync, next page", "GET", "/api/sync",
+            lambda rng, c: dict(url="/api/sync", params=dict(token=c.sync_tokens.pop()) if c.sync_tokens else {}),
+            requests=20,
+        ),
+        Scenario(
+            "sync push 100", "POST", "/api/sync/milks",
+            lambda rng, c: dict(
+                url="/api/sync/milks",
+                json=[
+                    dict(_milk_body(rng, c), date_created=f"{c.last_day.isoformat()}T06:{rng.randrange(60):02d}:00+05:30")
+                    for _ in range(100)
+                ],
+                headers={"Idempotency-Key": f"bench-{rng.randrange(10**12)}"},
+            ),
+            requests=10, concurrency=1,
+        ),
+        # The jobs run in their own processes while the scenarios after
+        # these do; the results of those not done yet answer 409.
+        Scenario(
+            "submit job", "POST", "/api/jobs",
+            lambda rng, c: dict(
+                url="/api/jobs",
+                json=dict(kind=rng.choice(["profit-loss", "sale-report"]), params=c.recent_week()),
+            ),
+            requests=20, concurrency=1,
+        ),
+        Scenario(
+            "job status", "GET", "/api/jobs/{job_id}",
+            lambda rng, c: dict(url=f"/api/jobs/{c.job(rng)}"),
+        ),
+        Scenario(
+            "job result", "GET", "/api/jobs/{job_id}/result",
+            lambda rng, c: dict(url=f"/api/jobs/{c.job(rng)}/result"),
+            requests=20,
+        ),
+        Scenario(
+            "cancel job", "POST", "/api/jobs/{job_id}/cancel",
+            lambda rng, c: dict(url=f"/api/jobs/{c.job(rng)}/cancel"),
+            requests=20, concurrency=1,
+        ),
+    ]
+
+    for prefix, table, body, filters, patch in LEDGERS:
+        item = f"/api/{prefix}/{{{table}_id}}"
+        found += [
+            Scenario(
+                f"create {table}", "POST", f"/api/{prefix}",
+                lambda rng, c, prefix=prefix, body=body: dict(url=f"/api/{prefix}", json=body(rng, c)),
+            ),
+            Scenario(
+                f"{table} page", "GET", f"/api/{prefix}",
+                lambda rng, c, prefix=prefix, table=table: dict(
+                    url=f"/api/{prefix}", params=dict(cursor=_cursor(rng, c, table), limit=100)
+                ),
+            ),
+            Scenario(
+                f"{table} filtered", "GET", f"/api/{prefix}",
+                lambda rng, c, prefix=prefix, filters=filters: dict(
+                    url=f"/api/{prefix}", params=dict(filters(rng, c), limit=100)
+                ),
+            ),
+            Scenario(
+                table, "GET", item,
+                lambda rng, c, prefix=prefix, table=table: dict(
+                    url=f"/api/{prefix}/{_random_id(table)(rng, c)}"
+                ),
+            ),
+            Scenario(
+                f"update {table}", "PUT", item,
+                lambda rng, c, prefix=prefix, table=table, body=body: dict(
+                    url=f"/api/{prefix}/{c.take(table, rng)}", json=body(rng, c)
+                ),
+                requests=50,
+            ),
+            Scenario(
+                f"patch {table}", "PATCH", item,
+                lambda rng, c, prefix=prefix, table=table, patch=patch: dict(
+                    url=f"/api/{prefix}/{c.take(table, rng)}", json=patch(rng, c)
+                ),
+                requests=50,
+            ),
+            Scenario(
+                f"delete {table}", "DELETE", item,
+                lambda rng, c, prefix=prefix, table=table: dict(url=f"/api/{prefix}/{c.take(table, rng)}"),
+                requests=50,
+            ),
+            Scenario(
+                f"export {table} week", "GET", f"/api/{prefix}/export",
+                lambda rng, c, prefix=prefix: dict(
+                    url=f"/api/{prefix}/export", params=dict(format="ndjson", **c.recent_week())
+                ),
+                requests=5, concurrency=1,
+            ),
+        ]
+
+    for prefix, table, *_ in LEDGERS:
+        if table == "expense":
+            continue  # never archived
+        item = f"/api/{prefix}/{{{table}_id}}"
+        found += [
+            Scenario(
+                f"{table} page with archive", "GET", f"/api/{prefix}",
+                lambda rng, c, prefix=prefix, table=table: dict(
+                    url=f"/api/{prefix}",
+                    params=dict(cursor=_cursor(rng, c, table), limit=100, include_archived="true"),
+                ),
+            ),
+            Scenario(
+                f"{table} with archive", "GET", item,
+                lambda rng, c, prefix=prefix, table=table: dict(
+                    url=f"/api/{prefix}/{_random_id(table)(rng, c)}", params=dict(include_archived="true")
+                ),
+            ),
+        ]
+
+    for prefix in ("milks", "sales", "purchases"):
+        found += [
+            Scenario(
+                f"{prefix} report by customer, month", "GET", f"/api/reports/{prefix}",
+                lambda rng, c, prefix=prefix: dict(url=f"/api/reports/{prefix}", params=_month(rng, c)),
+                requests=50,
+            ),
+            Scenario(
+                f"{prefix} report by day and type, year", "GET", f"/api/reports/{prefix}",
+                lambda rng, c, prefix=prefix: dict(
+                    url=f"/api/reports/{prefix}",
+                    params=dict(_year(rng, c), group_by=["day", "milk_type"]),
+                ),
+                requests=20,
+            ),
+        ]
+    found += [
+        Scenario(
+            "settle milk, month", "POST", "/api/milks/settle",
+            lambda rng, c: dict(
+                url="/api/milks/settle",
+                json=dict(_month(rng, c), customer_id=_random_id("customer")(rng, c)),
+                headers={"Idempotency-Key": f"bench-{rng.randrange(10**12)}"},
+            ),
+            requests=50,
+        ),
+        Scenario(
+            "settle sales, year", "POST", "/api/sales/settle",
+            lambda rng, c: dict(url="/api/sales/settle", json=dict(_year(rng, c), customername=rng.choice(c.names))),
+            requests=50,
+        ),
+        Scenario(
+            "settle purchases, year", "POST", "/api/purchases/settle",
+            lambda rng, c: dict(
+                url="/api/purchases/settle", json=dict(_year(rng, c), customername=rng.choice(c.names))
+            ),
+            requests=50,
+        ),
+        Scenario(
+            "settlements page", "GET", "/api/settlements",
+            lambda rng, c: dict(url="/api/settlements", params=dict(limit=100)),
+        ),
+        Scenario(
+            "milk report by shift, week", "GET", "/api/reports/milks",
+            lambda rng, c: dict(url="/api/reports/milks", params=dict(c.recent_week(), group_by=["shift"])),
+            requests=20,
+        ),
+        Scenario(
+            "dues, month", "GET", "/api/reports/dues",
+            lambda rng, c: dict(url="/api/reports/dues", params=_month(rng, c)),
+            requests=50,
+        ),
+        Scenario(
+            "profit and loss, year", "GET", "/api/reports/profit-loss",
+            lambda rng, c: dict(url="/api/reports/profit-loss", params=_year(rng, c)),
+            requests=50,
+        ),
+        Scenario(
+            "revoke token", "POST", "/api/token/revoke",
+            lambda rng, c: dict(url="/api/token/revoke", headers=c.tokens.pop()),
+            requests=10, concurrency=1,
+        ),
+    ]
+    return found
+
+
+def _cursor(rng, context, table):
+    import services as _services
+
+    return _services.encode_cursor(rng.randrange(context.counts[table]))
+
+
+def _month(rng, context):
+    day = context.random_day(rng)
+    return dict(date_from=day.isoformat(), date_to=(day + _dt.timedelta(days=30)).isoformat())
+
+
+def _year(rng, context):
+    day = context.random_day(rng)
+    return dict(date_from=day.isoformat(), date_to=(day + _dt.timedelta(days=365)).isoformat())
+
+
+def _uncovered(app, found):
+    covered = {(scenario.method, scenario.route) for scenario in found}
+    routes = {
+        (method, route.path)
+        for route in app.routes
+        if isinstance(route, _routing.APIRoute)
+        for method in route.methods
+    }
+    return sorted(routes - covered)
+
+
+async def _measure(client, scenario, rng, context, requests, concurrency):
+    count = scenario.requests or requests
+    arguments = [scenario.build(rng, context) for _ in range(count)]
+    latencies = []
+    statuses = {}
+    queries = 0
+    sql = 0.0
+    limit = asyncio.Semaphore(scenario.concurrency or concurrency)
+
+    async def one(kwargs):
+        async with limit:
+            started = time.perf_counter()
+            response = await client.request(scenario.method, **kwargs)
+            latencies.append(time.perf_counter() - started)
+        statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+        nonlocal queries, sql
+        timing = _SQL_TIMING.search(response.headers.get("server-timing", ""))
+        if timing:
+            sql += float(timing.group(1)) / 1000
+            queries += int(timing.group(2))
+        return response
+
+    started = time.perf_counter()
+    responses = await asyncio.gather(*[one(kwargs) for kwargs in arguments])
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    milliseconds = lambda seconds: None if seconds is None else round(seconds * 1000, 3)
+    return responses, dict(
+        name=scenario.name,
+        method=scenario.method,
+        route=scenario.route,
+        requests=count,
+        concurrency=scenario.concurrency or concurrency,
+        statuses={str(status): number for status, number in sorted(statuses.items())},
+        errors=sum(number for status, number in statuses.items() if status >= 500),
+        throughput_rps=round(count / elapsed, 1),
+        p50_ms=milliseconds(_percentile(latencies, 0.50)),
+        p95_ms=milliseconds(_percentile(latencies, 0.95)),
+        p99_ms=milliseconds(_percentile(latencies, 0.99)),
+        max_ms=milliseconds(latencies[-1] if latencies else None),
+        queries_per_request=round(queries / count, 2),
+        sql_ms_per_request=milliseconds(sql / count),
+        peak_rss_mb=_peak_rss_mb(),
+    )
+
+
+def _remember_created(context, scenario, responses):
+    """Keep the ids of rows a POST scenario created, for PUT and DELETE,
+    the jobs submitted, to poll, and the sync tokens handed out, for the
+    next sync."""
+    if scenario.name == "sync, week":
+        context.sync_tokens = [response.json()["token"] for response in responses if response.status_code == 200]
+    table = {
+        "create customer": "customer",
+        "create milk": "milk",
+        "create sale": "sale",
+        "create purchase": "purchase",
+        "create expense": "expense",
+        "submit job": "job",
+    }.get(scenario.name)
+    if table is not None:
+        context.created[table] = [
+            response.json()["id"] for response in responses if response.status_code in (200, 202)
+        ]
+
+
+def _dataset(path: str):
+    connection = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        counts = {
+            table: connection.execute(f"SELECT max(id) FROM {table}").fetchone()[0] or 0
+            for table in ("customer", "milk", "sale", "purchase", "expense")
+        }
+        first, last = connection.execute("SELECT min(date_created), max(date_created) FROM milk").fetchone()
+        names = [name for (name,) in connection.execute("SELECT name FROM customer ORDER BY id")]
+    finally:
+        connection.close()
+    day = lambda stamp: _dt.date.fromisoformat(stamp[:10]) if stamp else _dt.date.today()
+    return counts, day(first), day(last), names
+
+
+def _commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+            capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def _run(app, context, found, requests, levels, seed, only, log):
+    rng = random.Random(seed)
+    results = []
+    # An unhandled error in the app becomes a 500 that counts as an error,
+    # rather than an exception that stops the run.
+    transport = httpx.ASGITransport(app=app, raise_app_exceptions=False)
+    await app.router.startup()
+    try:
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            await client.post("/api/users", json=dict(email="bench@example.com", hashed_password="bench"))
+            tokens = []
+            for _ in range(11):
+                response = await client.post(
+                    "/api/token", data=dict(username="bench@example.com", password="bench")
+                )
+                tokens.append({"Authorization": f"Bearer {response.json()['access_token']}"})
+            context.headers = tokens.pop()
+            context.tokens = tokens
+
+            for scenario in found:
+                if only and not any(word in scenario.name for word in only):
+                    continue
+                for concurrency in levels:
+                    gc.collect()
+                    responses, result = await _measure(client, scenario, rng, context, requests, concurrency)
+                    _remember_created(context, scenario, responses)
+                    results.append(result)
+                    log(
+                        f"{result['name']:<40} x{result['concurrency']:<3} {result['throughput_rps']:>9.1f} req/s"
+                        f"  p50 {result['p50_ms']:>9.2f}  p95 {result['p95_ms']:>9.2f}"
+                        f"  p99 {result['p99_ms']:>9.2f} ms  {result['statuses']}"
+                    )
+    finally:
+        await app.router.shutdown()
+    return results
+
+
+async def _archive(database):
+    import services as _services
+
+    try:
+        async with database.AsyncSessionLocal() as db:
+            return await _services.archive_ledgers(db)
+    finally:
+        # The scenarios run on another event loop.
+        await database.async_engine.dispose()
+
+
+def run(
+    workdir: str,
+    requests: int = REQUESTS,
+    concurrency=CONCURRENCY,
+    seed: int = 1,
+    only=None,
+    log=print,
+    database_url=None,
+    archive=False,
+):
+    """Benchmark the API against ``workdir``/dairy-database.db and return the report.
+
+    The API opens ``./dairy-database.db`` and its engines fix that path
+    when they are created, so the run changes into ``workdir`` before the
+    app is imported, and refuses to run if it already was. Writes made by
+    the run stay in that database; restore a fresh copy to compare runs
+    exactly.
+
+    With ``database_url`` the API runs against that database instead, after
+    the SQLite file has been loaded into it (see benchmarks.postgres).
+    ``concurrency`` may be a list: each scenario then runs once per level.
+    With ``archive`` the old paid rows are archived first, as by ``python
+    manage.py archive``, so the hot tables hold about a year; ids picked
+    from the seeded range may then answer 404 outside the archive scenarios.
+    """
+    if "database" in sys.modules:
+        raise RuntimeError("run() must import the app itself, after changing into workdir")
+    os.chdir(workdir)
+    with open("rate-chart.json", "w") as chart:
+        json.dump(_rate_chart(), chart)
+    if database_url:
+        from benchmarks import postgres
+
+        os.environ["DAIRY_DATABASE_URL"] = database_url
+        postgres.load(os.path.abspath("dairy-database.db"), database_url, log=log)
+    import config as _config, database as _database, main as _main, migrations as _migrations
+
+    # A dataset seeded at an older commit lacks the newer tables and indexes.
+    _migrations.migrate()
+    counts, first_day, last_day, names = _dataset(os.path.abspath("dairy-database.db"))
+    if archive:
+        started = time.perf_counter()
+        moved = asyncio.run(_archive(_database))
+        log(f"archived {moved} ({time.perf_counter() - started:.0f}s)")
+
+    context = Context(counts, first_day, last_day, names)
+    found = scenarios()
+    uncovered = _uncovered(_main.app, found)
+    for method, route in uncovered:
+        log(f"no scenario for {method} {route}")
+
+    levels = concurrency if isinstance(concurrency, (list, tuple)) else [concurrency]
+    started = time.perf_counter()
+    results = asyncio.run(_run(_main.app, context, found, requests, levels, seed, only, log))
+
+    return dict(
+        meta=dict(
+            commit=_commit(),
+            started=_dt.datetime.now().isoformat(timespec="seconds"),
+            seconds=round(time.perf_counter() - started, 1),
+            python=platform.python_version(),
+            database=_database.ASYNC_DATABASE_URL.get_backend_name(),
+            archived=archive,
+            sqlite=sqlite3.sqlite_version,
+            sqlalchemy=_sql.__version__,
+            platform=platform.platform(),
+            dataset=counts,
+            requests=requests,
+            concurrency=concurrency,
+            seed=seed,
+            settings=_config.settings.dict(exclude={"jwt_secret"}),
+        ),
+        uncovered=[f"{method} {route}" for method, route in uncovered],
+        results=results,
+        peak_rss_mb=_peak_rss_mb(),
+    )
+
+
+def scaling(report: dict, log=print):
+    """Print throughput per concurrency level, relative to the lowest."""
+    by_name = {}
+    for result in report["results"]:
+        by_name.setdefault(result["name"], []).append(result)
+    log(f"{'scenario':<40} {'writers':>7} {'req/s':>9} {'speedup':>8} {'p99 ms':>9}   ({report['meta']['database']})")
+    for name, results in by_name.items():
+        base = results[0]["throughput_rps"]
+        for result in results:
+            speedup = f"{result['throughput_rps'] / base:.2f}x" if base else "n/a"
+            log(
+                f"{name:<40} {result['concurrency']:>7} {result['throughput_rps']:>9.1f}"
+                f" {speedup:>8} {result['p99_ms']:>9.2f}"
+            )
+
+
+def compare(before: dict, after: dict, log=print):
+    """Print the change in throughput and tail latency per scenario."""
+    previous = {result["name"]: result for result in before["results"]}
+    log(
+        f"{'scenario':<40} {'req/s':>18} {'p50 ms':>20} {'p99 ms':>20}"
+        f"   ({before['meta'].get('commit')} -> {after['meta'].get('commit')})"
+    )
+    for result in after["results"]:
+        old = previous.get(result["name"])
+        if old is None:
+            log(f"{result['name']:<40} (new)")
+            continue
+        cells = []
+        for key in ("throughput_rps", "p50_ms", "p99_ms"):
+            a, b = old[key], result[key]
+            if a is None or b is None:
+                cells.append(f"{'n/a':>19}")
+                continue
+            change = f"{(b - a) / a * 100:+.0f}%" if a else "n/a"
+            cells.append(f"{b:>11.1f} {change:>7}")
+        queries = old.get("queries_per_request"), result.get("queries_per_request")
+        if None not in queries and queries[0] != queries[1]:
+            cells.append(f"  queries/request {queries[0]} -> {queries[1]}")
+        log(f"{result['name']:<40} " + " ".join(cells))
+    log(f"{'peak RSS MB':<40} {after['peak_rss_mb']:>11.1f} (was {before['peak_rss_mb']})")
@@ -0,0 +1,123 @@
+"""A throwaway PostgreSQL server for benchmark runs.
+
+    python -m benchmarks run --workdir bench-data --from-copy --postgres
+
+``server()`` creates a cluster in ``workdir``/postgres on first use, starts
+it listening on a Unix socket in that directory only, and stops it on exit.
+The binaries come from $PG_BIN or PATH, and, as initdb requires, the run
+must not be root. ``load()`` copies the seeded SQLite database into a fresh
+``dairy`` database with COPY, so both backends start from the same rows.
+
+Needs the PostgreSQL drivers: pip install asyncpg psycopg2-binary
+"""
+import asyncio
+import contextlib
+import os
+import shutil
+import subprocess
+import time
+
+import sqlalchemy as _sql
+import sqlalchemy.ext.asyncio as _asyncio
+
+USER = "dairy"
+DATABASE = "dairy"
+PORT = 5499
+BATCH_SIZE = 50_000
+
+
+def _binary(name: str):
+    directory = os.environ.get("PG_BIN")
+    path = os.path.join(directory, name) if directory else shutil.which(name)
+    if not path or not os.path.exists(path):
+        raise RuntimeError(f"{name} not found: put PostgreSQL's bin directory on PATH or in PG_BIN")
+    return path
+
+
+def _pg_ctl(data: str, *args):
+    subprocess.run([_binary("pg_ctl"), "-D", data, "-w", *args], check=True, capture_output=True)
+
+
+@contextlib.contextmanager
+def server(workdir: str, port: int = PORT):
+    """Run a local server for the duration of the block and yield its URL."""
+    data = os.path.abspath(os.path.join(workdir, "postgres"))
+    if not os.path.exists(os.path.join(data, "PG_VERSION")):
+        subprocess.run(
+            [_binary("initdb"), "-D", data, "-U", USER, "--auth=trust", "-E", "UTF8"],
+            check=True, capture_output=True,
+        )
+    # No TCP listener: only this user's processes can reach it.
+    options = f"-p {port} -k {data} -c listen_addresses=''"
+    _pg_ctl(data, "-l", os.path.join(data, "server.log"), "-o", options, "start")
+    try:
+        yield f"postgresql+asyncpg://{USER}@localhost:{port}/{DATABASE}?host={data}"
+    finally:
+        _pg_ctl(data, "-m", "fast", "stop")
+
+
+def _recreate(url):
+    """Drop and create the target database, through the server's own database."""
+    url = _sql.engine.make_url(url).set(drivername="postgresql")
+    engine = _sql.create_engine(url.set(database="postgres"), isolation_level="AUTOCOMMIT")
+    try:
+        with engine.connect() as connection:
+            connection.exec_driver_sql(f'DROP DATABASE IF EXISTS "{url.database}"')
+            connection.exec_driver_sql(f'CREATE DATABASE "{url.database}"')
+    finally:
+        engine.dispose()
+
+
+async def _copy(source_path: str, url: str, log):
+    # Imported here, like the rest of the app, once DAIRY_DATABASE_URL is
+    # set; models registers the tables on the metadata.
+    import database as _database, models as _models
+
+    source = _sql.create_engine(f"sqlite:///{source_path}")
+    target = _asyncio.create_async_engine(url)
+    try:
+        async with target.begin() as connection:
+            await connection.run_sync(_database.Base.metadata.create_all)
+
+        existing = set(_sql.inspect(source).get_table_names())
+        async with target.connect() as connection:
+            raw = await connection.get_raw_connection()
+            for table in _database.Base.metadata.sorted_tables:
+                if table.name not in existing:
+                    continue
+                started = time.perf_counter()
+                copied = 0
+                columns = [column.name for column in table.columns]
+                with source.connect() as reader:
+                    # Read through the models' column types, so values arrive
+                    # as the datetimes, Decimals and bools COPY expects.
+                    result = reader.execution_options(stream_results=True).execute(table.select())
+                    for rows in result.partitions(BATCH_SIZE):
+                        await raw.driver_connection.copy_records_to_table(
+                            table.name, records=[tuple(row) for row in rows], columns=columns
+                        )
+                        copied += len(rows)
+                log(f"{table.name}: {copied} rows ({time.perf_counter() - started:.0f}s)")
+
+        # COPY sets the ids itself; move each sequence past them.
+        async with target.begin() as connection:
+            for table in _database.Base.metadata.sorted_tables:
+                if "id" in table.c and table.c.id.primary_key:
+                    sequence = _sql.func.pg_get_serial_sequence(table.name, "id")
+                    await connection.execute(
+                        _sql.select(_sql.func.setval(sequence, _sql.func.max(table.c.id)))
+                        .select_from(table)
+                        .having(_sql.func.count() > 0)
+                    )
+        async with target.connect() as connection:
+            connection = await connection.execution_options(isolation_level="AUTOCOMMIT")
+            await connection.exec_driver_sql("ANALYZE")
+    finally:
+        source.dispose()
+        await target.dispose()
+
+
+def load(source_path: str, url: str, log=print):
+    """Replace the database at ``url`` with the contents of a seeded SQLite file."""
+    _recreate(url)
+    asyncio.run(_copy(source_path, url, log))
@@ -0,0 +1,208 @@
+"""Synthetic dairy data at production volumes.
+
+Milk is collected twice a day: each shift a share of the customers bring
+cow or buffalo milk, measured for fat and SNF and priced from those. Entries
+older than a month are mostly paid. Rows go in in date order, as they do in
+a live ledger, so ids and dates rise together.
+
+Rows are written with the sqlite3 module in large executemany batches, with
+the ledger indexes dropped during the load and rebuilt afterwards. The milk
+rollups are then rebuilt with the same service the API uses. No ANALYZE is
+run, so the planner sees what it sees on a real database.
+"""
+import asyncio
+import datetime as _dt
+import os
+import random
+import sqlite3
+import time
+
+import sqlalchemy as _sql
+import sqlalchemy.ext.asyncio as _asyncio
+
+CUSTOMERS = 10_000
+MILKS = 10_000_000
+YEARS = 3
+BATCH_SIZE = 100_000
+
+SHIFTS = ((6, 2), (17, 2))  # (first hour, hours long)
+MILK_TYPES = ("Cow", "Cow", "Cow", "Buffalo")
+FIRST_NAMES = ("Ramesh", "Suresh", "Sunita", "Anil", "Kavita", "Prakash", "Meena", "Vijay", "Lata", "Ganesh")
+LAST_NAMES = ("Patil", "Shinde", "Jadhav", "Pawar", "More", "Kale", "Shirke", "Deshmukh", "Gaikwad", "Chavan")
+
+
+def _stamp(day: _dt.date, seconds: int):
+    hours, seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+    return f"{day.isoformat()} {hours:02d}:{minutes:02d}:{seconds:02d}.000000"
+
+
+def _customers(rng: random.Random, count: int, start: _dt.date):
+    for number in range(1, count + 1):
+        stamp = _stamp(start, rng.randrange(8 * 3600, 20 * 3600))
+        yield (
+            f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)} {number}",
+            f"9{rng.randrange(10**9):09d}",
+            f"customer{number}@example.com",
+            f"{rng.randrange(10**5):05d}",
+            f"Village {number % 250}",
+            stamp,
+            stamp,
+        )
+
+
+def _milks(rng: random.Random, customers: int, count: int, start: _dt.date, days: int, names):
+    per_shift = count / (days * len(SHIFTS))
+    paid_before = start + _dt.timedelta(days=days - 30)
+    produced = 0
+    carry = 0.0
+    for offset in range(days):
+        day = start + _dt.timedelta(days=offset)
+        for first_hour, hours in SHIFTS:
+            carry += per_shift
+            entries = min(int(carry), count - produced)
+            carry -= entries
+            base = first_hour * 3600
+            times = sorted(rng.randrange(base, base + hours * 3600) for _ in range(entries))
+            for seconds in times:
+                customer = rng.randrange(1, customers + 1)
+                milk_type = rng.choice(MILK_TYPES)
+                if milk_type == "Cow":
+                    lit = round(rng.uniform(1, 15), 1)
+                    fat = round(rng.uniform(3.2, 5.0), 1)
+                else:
+                    lit = round(rng.uniform(1, 10), 1)
+                    fat = round(rng.uniform(5.5, 8.0), 1)
+                snf = round(rng.uniform(8.0, 9.5), 1)
+                amount = round(lit * (fat * 6 + snf * 2), 2)
+                paid = day < paid_before and rng.random() < 0.97
+                stamp = _stamp(day, seconds)
+                yield (
+                    customer, names[customer], milk_type, lit, fat, snf, amount, paid, stamp, stamp,
+                )
+            produced += entries
+
+
+def _trades(rng: random.Random, count: int, start: _dt.date, days: int, names):
+    for _ in range(count):
+        day = start + _dt.timedelta(days=rng.randrange(days))
+        stamp = _stamp(day, rng.randrange(7 * 3600, 21 * 3600))
+        lit = round(rng.uniform(5, 500), 1)
+        yield (
+            rng.choice(names), rng.choice(MILK_TYPES), lit, round(lit * 52, 2),
+            rng.random() < 0.9, stamp, stamp,
+        )
+
+
+def _expenses(rng: random.Random, count: int, start: _dt.date, days: int):
+    remarks = ("Feed", "Diesel", "Electricity", "Salary", "Repairs", "Testing kit", "Cans")
+    for _ in range(count):
+        day = start + _dt.timedelta(days=rng.randrange(days))
+        stamp = _stamp(day, rng.randrange(9 * 3600, 19 * 3600))
+        yield (rng.choice(remarks), round(rng.uniform(50, 25_000), 2), stamp, stamp)
+
+
+def _insert(connection, table: str, columns, rows):
+    sql = f'INSERT INTO {table} ({", ".join(columns)}) VALUES ({", ".join("?" * len(columns))})'
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == BATCH_SIZE:
+            connection.executemany(sql, batch)
+            batch.clear()
+    if batch:
+        connection.executemany(sql, batch)
+
+
+async def _rebuild_rollups(path: str):
+    import services as _services
+
+    engine = _asyncio.create_async_engine(f"sqlite+aiosqlite:///{path}")
+    try:
+        async with _asyncio.AsyncSession(engine, expire_on_commit=False) as db:
+            return await _services.rebuild_milk_rollups(db)
+    finally:
+        await engine.dispose()
+
+
+def seed(
+    path: str,
+    customers: int = CUSTOMERS,
+    milks: int = MILKS,
+    years: int = YEARS,
+    seed: int = 1,
+    log=print,
+):
+    """Create a fresh database at ``path`` and fill it; return the row counts."""
+    # Imported here rather than at the top: importing the app creates its
+    # engines, which must wait until driver.run() has changed directory.
+    import database as _database, models as _models
+
+    if os.path.exists(path):
+        raise FileExistsError(path)
+
+    rng = random.Random(seed)
+    days = 365 * years
+    start = _dt.date.today() - _dt.timedelta(days=days)
+    started = time.perf_counter()
+
+    engine = _sql.create_engine(f"sqlite:///{path}")
+    _database.Base.metadata.create_all(bind=engine)
+    engine.dispose()
+
+    ledgers = [_models.Milk, _models.Sale, _models.Purchase, _models.Expense]
+    indexes = [index for model in ledgers for index in model.__table__.indexes]
+
+    connection = sqlite3.connect(path, isolation_level=None)
+    connection.execute("PRAGMA journal_mode = OFF")
+    connection.execute("PRAGMA synchronous = OFF")
+    for index in indexes:
+        connection.execute(f'DROP INDEX "{index.name}"')
+    connection.execute("BEGIN")
+
+    customer_rows = list(_customers(rng, customers, start))
+    names = [""] + [row[0] for row in customer_rows]
+    _insert(
+        connection,
+        "customer",
+        ("name", "mobile", "email", "pan", "address", "date_created", "date_last_updated"),
+        customer_rows,
+    )
+    connection.execute(
+        f"INSERT INTO {_models.customer_search.name} (rowid, name, mobile) SELECT id, name, mobile FROM customer"
+    )
+    log(f"customers: {customers}")
+
+    _insert(
+        connection,
+        "milk",
+        (
+            "customer_id", "customer_name", "milk_type", "lit", "fat", "snf", "amount",
+            "is_paid", "date_created", "date_last_updated",
+        ),
+        _milks(rng, customers, milks, start, days, names),
+    )
+    log(f"milk: {milks} ({time.perf_counter() - started:.0f}s)")
+
+    trade_columns = (
+        "customername", "milk_type", "lit", "amount", "is_paid", "date_created", "date_last_updated",
+    )
+    counts = dict(customer=customers, milk=milks, sale=days * 20, purchase=days * 5, expense=days * 3)
+    _insert(connection, "sale", trade_columns, _trades(rng, counts["sale"], start, days, names[1:]))
+    _insert(connection, "purchase", trade_columns, _trades(rng, counts["purchase"], start, days, names[1:]))
+    _insert(
+        connection,
+        "expense",
+        ("remark", "amount", "date_created", "date_last_updated"),
+        _expenses(rng, counts["expense"], start, days),
+    )
+    connection.execute("COMMIT")
+
+    for index in indexes:
+        connection.execute(str(_sql.schema.CreateIndex(index).compile(dialect=engine.dialect)))
+    connection.close()
+    log(f"indexes ({time.perf_counter() - started:.0f}s)")
+
+    counts["milk_daily"] = asyncio.run(_rebuild_rollups(path))
+    log(f"rollups: {counts['milk_daily']} customer-days ({time.perf_counter() - started:.0f}s)")
+    return counts
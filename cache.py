@@ -0,0 +1,241 @@
+"""Response cache for hot GET routes, with ETag revalidation.
+
+Cached responses are keyed by path and query string. Each key also embeds
+the current generation of every tag the response depends on (``customers``
+for the customer list, ``customer:7`` for one customer, and so on). Writes
+bump the tags they affect, so later reads miss and rebuild, and stale
+entries simply age out. Generations are read before the query runs, so a
+response built from data that a concurrent write has since replaced is
+stored under a key nobody will ask for again.
+
+A bump gives the tag a fresh value that is never handed out again, and the
+tag keeps it for one TTL; after that every entry stored before the bump has
+expired, so the tag can fall back to 0 and per-row tags do not pile up.
+
+Two backends: an in-process LRU with a TTL (per API process), and Redis,
+which shares entries and invalidations across processes. Any client with
+the redis.asyncio interface will do, including ``fakeredis.aioredis`` in
+local runs.
+"""
+import asyncio
+import collections
+import contextlib
+import hashlib
+import itertools
+import json
+import logging
+import math
+import time
+import urllib.parse
+
+import fastapi as _fastapi
+import fastapi.encoders as _encoders
+from fastapi.responses import JSONResponse
+
+import config as _config, instrumentation as _instrumentation
+
+logger = logging.getLogger("dairy.cache")
+
+class MemoryBackend:
+    """An LRU of encoded responses that expire after ``ttl`` seconds."""
+
+    def __init__(self, size: int, ttl: float):
+        self.size = size
+        self.ttl = ttl
+        self._entries = collections.OrderedDict()
+        # tag -> (expires, generation), oldest bump first.
+        self._generations = collections.OrderedDict()
+        self._counter = itertools.count(1)
+
+    def _expire_generations(self, now: float):
+        while self._generations:
+            expires, _ = next(iter(self._generations.values()))
+            if expires > now:
+                break
+            self._generations.popitem(last=False)
+
+    async def generations(self, tags):
+        self._expire_generations(time.monotonic())
+        return [self._generations.get(tag, (0, 0))[1] for tag in tags]
+
+    async def bump(self, tags):
+        now = time.monotonic()
+        self._expire_generations(now)
+        generation = next(self._counter)
+        for tag in tags:
+            self._generations[tag] = (now + self.ttl, generation)
+            self._generations.move_to_end(tag)
+
+    async def get(self, key: str):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires, value = entry
+        if expires <= time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    async def set(self, key: str, value: bytes):
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+
+
+class RedisBackend:
+    """Entries and tag generations kept in Redis, shared by every process."""
+
+    def __init__(self, client, ttl: float, prefix: str = "dairy:cache:"):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    async def generations(self, tags):
+        values = await self.client.mget([self.prefix + "gen:" + tag for tag in tags])
+        return [int(value or 0) for value in values]
+
+    async def bump(self, tags):
+        generation = await self.client.incr(self.prefix + "generation")
+        async with self.client.pipeline(transaction=False) as pipe:
+            for tag in tags:
+                pipe.set(self.prefix + "gen:" + tag, generation, ex=math.ceil(self.ttl) + 1)
+            await pipe.execute()
+
+    async def get(self, key: str):
+        return await self.client.get(self.prefix + key)
+
+    async def set(self, key: str, value: bytes):
+        await self.client.set(self.prefix + key, value, ex=max(int(self.ttl), 1))
+
+
+class NullBackend:
+    """No caching; responses still carry ETags."""
+
+    async def generations(self, tags):
+        return [0] * len(tags)
+
+    async def bump(self, tags):
+        pass
+
+    async def get(self, key: str):
+        return None
+
+    async def set(self, key: str, value: bytes):
+        pass
+
+
+def create_backend(settings=_config.settings):
+    if settings.cache_backend == "redis":
+        try:
+            import redis.asyncio as _redis
+        except ImportError:
+            raise RuntimeError("DAIRY_CACHE_BACKEND=redis needs the redis package")
+        return RedisBackend(_redis.from_url(settings.cache_url), settings.cache_ttl_seconds)
+    if settings.cache_backend == "memory":
+        return MemoryBackend(settings.cache_size, settings.cache_ttl_seconds)
+    return NullBackend()
+
+
+backend = create_backend()
+
+
+def _etag(body: bytes):
+    return '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+
+
+def _encode(body: bytes, headers: dict):
+    return json.dumps(headers).encode() + b"\n" + body
+
+
+def _decode(value: bytes):
+    headers, body = value.split(b"\n", 1)
+    return body, json.loads(headers)
+
+
+def _not_modified(request: _fastapi.Request, etag: str):
+    header = request.headers.get("if-none-match")
+    if header is None:
+        return False
+    tags = [tag.strip() for tag in header.split(",")]
+    return "*" in tags or etag in tags or "W/" + etag in tags
+
+
+def _respond(request: _fastapi.Request, body: bytes, headers: dict):
+    if _not_modified(request, headers["ETag"]):
+        return _fastapi.Response(status_code=304, headers=headers)
+    return _fastapi.Response(content=body, media_type="application/json", headers=headers)
+
+
+async def cached_json(request: _fastapi.Request, tags, produce):
+    """Serve a JSON response from the cache, or build and store it.
+
+    ``produce`` is awaited on a miss and returns the content, or JSON bytes
+    already encoded, together with any extra response headers. A request whose If-None-Match equals the
+    response's ETag gets an empty 304.
+    """
+    generations = await backend.generations(tags)
+    key = "|".join(
+        [request.url.path, urllib.parse.urlencode(sorted(request.query_params.multi_items()))]
+        + [f"{tag}={generation}" for tag, generation in zip(tags, generations)]
+    )
+
+    value = await backend.get(key)
+    if value is not None:
+        return _respond(request, *_decode(value))
+
+    content, headers = await produce()
+    if isinstance(content, bytes):
+        body = content
+    else:
+        with _instrumentation.timed("serialize"):
+            body = JSONResponse(_encoders.jsonable_encoder(content)).body
+    headers = dict(headers, ETag=_etag(body))
+    await backend.set(key, _encode(body, headers))
+    return _respond(request, body, headers)
+
+
+async def invalidate(*tags):
+    """Drop every cached response that depends on any of ``tags``."""
+    await backend.bump(tags)
+
+
+class Watch:
+    """Invalidates ``tags`` whenever ``probe`` returns something new.
+
+    For writes made by other processes, such as management commands, that
+    an in-process cache would not otherwise hear of. ``probe`` is awaited
+    every ``seconds``; shared and disabled caches need no watching.
+    """
+
+    def __init__(self, probe, tags, seconds: float):
+        self.probe = probe
+        self.tags = tags
+        self.seconds = seconds
+        self._task = None
+
+    def start(self):
+        """Start watching on the running event loop."""
+        if isinstance(backend, MemoryBackend) and self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._loop())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await self._task
+        self._task = None
+
+    async def _loop(self):
+        seen = None
+        while True:
+            try:
+                value = await self.probe()
+                if seen is not None and value != seen:
+                    await invalidate(*self.tags)
+                seen = value
+            except Exception:
+                logger.exception("cache watch")
+            await asyncio.sleep(self.seconds)
@@ -0,0 +1,136 @@
+"""Response compression, brotli or gzip, negotiated per request.
+
+Brotli is offered when the brotli package is installed (pip install brotli)
+and the client lists ``br`` in Accept-Encoding; otherwise gzip. Bodies
+smaller than ``compress_min_bytes`` are sent as they are. Streamed
+responses (the exports) are compressed chunk by chunk and flushed after
+each one, so the client still receives rows as they are produced.
+
+A compressed body is a different representation of the resource, so its
+ETag is sent weak; ``cache`` matches weak validators in If-None-Match.
+"""
+import zlib
+
+from starlette.datastructures import Headers, MutableHeaders
+
+import config as _config
+
+try:
+    import brotli as _brotli
+except ImportError:
+    _brotli = None
+
+
+class _Gzip:
+    def __init__(self, level: int):
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def chunk(self, data: bytes):
+        return self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self, data: bytes):
+        return self._compressor.compress(data) + self._compressor.flush()
+
+
+class _Brotli:
+    def __init__(self, level: int):
+        self._compressor = _brotli.Compressor(quality=level)
+
+    def chunk(self, data: bytes):
+        return self._compressor.process(data) + self._compressor.flush()
+
+    def finish(self, data: bytes):
+        return self._compressor.process(data) + self._compressor.finish()
+
+
+def _accepted(header: str):
+    """The content codings in an Accept-Encoding header, minus any with q=0."""
+    codings = set()
+    for item in header.split(","):
+        coding, *parameters = [part.strip() for part in item.split(";")]
+        quality = 1.0
+        for parameter in parameters:
+            if parameter.startswith("q="):
+                try:
+                    quality = float(parameter[2:])
+                except ValueError:
+                    quality = 0.0
+        if coding and quality > 0:
+            codings.add(coding.lower())
+    return codings
+
+
+def negotiate(header: str):
+    """The coding to send for ``header`` ("br", "gzip"), or None."""
+    codings = _accepted(header)
+    if _brotli is not None and "br" in codings:
+        return "br"
+    if "gzip" in codings or "*" in codings:
+        return "gzip"
+    return None
+
+
+_CODECS = {"br": _Brotli, "gzip": _Gzip}
+
+
+class CompressionMiddleware:
+    """Compress response bodies in the coding the client prefers."""
+
+    def __init__(self, app, settings=_config.settings):
+        self.app = app
+        self.settings = settings
+
+    async def __call__(self, scope, receive, send):
+        level = self.settings.compress_level
+        coding = negotiate(Headers(scope=scope).get("accept-encoding", "")) if scope["type"] == "http" else None
+        if not level or coding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start = None
+        compressor = None
+        passthrough = False
+
+        async def send_compressed(message):
+            nonlocal start, compressor, passthrough
+            if message["type"] == "http.response.start":
+                # Held back until the first body chunk shows how big it is.
+                start = message
+                return
+            if passthrough or message["type"] != "http.response.body":
+                await send(message)
+                return
+
+            body = message.get("body", b"")
+            more = message.get("more_body", False)
+            if compressor is None:
+                headers = MutableHeaders(scope=start)
+                if (
+                    "content-encoding" in headers
+                    or headers.get("content-type", "").startswith("text/event-stream")
+                    or (not more and len(body) < self.settings.compress_min_bytes)
+                ):
+                    passthrough = True
+                    await send(start)
+                    await send(message)
+                    return
+
+                compressor = _CODECS[coding](level)
+                headers["Content-Encoding"] = coding
+                headers.add_vary_header("Accept-Encoding")
+                etag = headers.get("etag")
+                if etag and not etag.startswith("W/"):
+                    headers["ETag"] = "W/" + etag
+                if more:
+                    del headers["Content-Length"]
+                    body = compressor.chunk(body)
+                else:
+                    body = compressor.finish(body)
+                    headers["Content-Length"] = str(len(body))
+                await send(start)
+            else:
+                body = compressor.chunk(body) if more else compressor.finish(body)
+
+            await send({"type": "http.response.body", "body": body, "more_body": more})
+
+        await self.app(scope, receive, send_compressed)
@@ -1,11 +1,221 @@
+import datetime as _dt
+import functools as _functools
+import zoneinfo
+
 import sqlalchemy as _sql
+import sqlalchemy.ext.asyncio as _asyncio
+import sqlalchemy.ext.compiler as _compiler
 import sqlalchemy.ext.declarative as _declarative
 import sqlalchemy.orm as _orm
+import sqlalchemy.pool as _pool
+
+import config as _config, instrumentation as _instrumentation
+
+LOCAL_TIMEZONE = zoneinfo.ZoneInfo(_config.settings.timezone)
+
+
+def local_time(value: _dt.datetime):
+    """A stored (naive UTC) timestamp on the dairy's clock, still naive."""
+    return value.replace(tzinfo=_dt.timezone.utc).astimezone(LOCAL_TIMEZONE).replace(tzinfo=None)
+
+
+def utc_time(value: _dt.datetime):
+    """A naive time on the dairy's clock as a stored (naive UTC) timestamp."""
+    return value.replace(tzinfo=LOCAL_TIMEZONE).astimezone(_dt.timezone.utc).replace(tzinfo=None)
+
+
+def local_today():
+    return local_time(_dt.datetime.utcnow()).date()
+
+
+class local_timestamp(_sql.sql.expression.FunctionElement):
+    """SQL for ``local_time`` of a timestamp column, to take days and hours from."""
+
+    name = "local_timestamp"
+    inherit_cache = True
+
+
+@_compiler.compiles(local_timestamp, "postgresql")
+def _local_timestamp_postgresql(element, compiler, **kw):
+    # The zone inline rather than bound, so that GROUP BY matches the
+    # selected expression.
+    zone = _config.settings.timezone.replace("'", "''")
+    return f"timezone('{zone}', timezone('UTC', {compiler.process(element.clauses, **kw)}))"
+
+
+def _fixed_offset(zone):
+    """The zone's UTC offset as a SQLite modifier, if it has not changed
+    since 1970 and is not set to change; else None."""
+    offsets = {
+        _dt.datetime(year, month, 1, tzinfo=_dt.timezone.utc).astimezone(zone).utcoffset()
+        for year in range(1970, 2038)
+        for month in (1, 4, 7, 10)
+    }
+    if len(offsets) > 1:
+        return None
+    return f"{offsets.pop() // _dt.timedelta(minutes=1):+d} minutes"
+
+
+_LOCAL_OFFSET = _fixed_offset(LOCAL_TIMEZONE)
+
+
+@_compiler.compiles(local_timestamp, "sqlite")
+def _local_timestamp_sqlite(element, compiler, **kw):
+    # SQLite's own modifiers only know fixed offsets; in a zone with
+    # daylight saving the offset comes from _sqlite_local_offset, registered
+    # on every connection, at a Python call per row.
+    timestamp = compiler.process(element.clauses, **kw)
+    if _LOCAL_OFFSET is not None:
+        return f"datetime({timestamp}, '{_LOCAL_OFFSET}')"
+    return f"datetime({timestamp}, local_offset({timestamp}))"
+
+
+@_functools.lru_cache(maxsize=65536)
+def _hour_offset(hour: str):
+    """The offset of every instant in a UTC hour ("YYYY-MM-DD HH") as a
+    SQLite modifier, or None if the offset changes within it."""
+    start = _dt.datetime.fromisoformat(hour + ":00")
+    offsets = {
+        local_time(stamp) - stamp for stamp in (start, start + _dt.timedelta(hours=1, microseconds=-1))
+    }
+    if len(offsets) > 1:
+        return None
+    return f"{offsets.pop() // _dt.timedelta(minutes=1):+d} minutes"
+
+
+def _sqlite_local_offset(value):
+    # Per row of a report, hence the cache by hour.
+    if value is None:
+        return None
+    offset = _hour_offset(value[:13])
+    if offset is None:
+        stamp = _dt.datetime.fromisoformat(value)
+        offset = f"{(local_time(stamp) - stamp) // _dt.timedelta(minutes=1):+d} minutes"
+    return offset
 
-DATABASE_URL = "sqlite:///./dairy-database.db"
 
-engine = _sql.create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
+def sync_url(url):
+    """The same database through its backend's default sync driver."""
+    url = _sql.engine.make_url(url)
+    return url.set(drivername=url.get_backend_name())
+
+
+def read_only_url(url):
+    """``url`` opened read-only: SQLite files as a read-only URI; servers
+    keep the URL and are made read-only per connection (``_connect_args``)."""
+    url = _sql.engine.make_url(url)
+    if url.get_backend_name() != "sqlite" or url.query.get("mode") == "ro":
+        return url
+    return url.set(database=f"file:{url.database}", query=dict(url.query, mode="ro", uri="true"))
+
+
+ASYNC_DATABASE_URL = _sql.engine.make_url(_config.settings.database_url)
+DATABASE_URL = sync_url(ASYNC_DATABASE_URL)
+READ_DATABASE_URL = _sql.engine.make_url(
+    _config.settings.read_database_url or read_only_url(ASYNC_DATABASE_URL)
+)
+
+
+def sqlite_pragmas(settings=_config.settings):
+    return [
+        ("journal_mode", settings.sqlite_journal_mode),
+        ("synchronous", settings.sqlite_synchronous),
+        ("busy_timeout", settings.sqlite_busy_timeout_ms),
+        # A negative cache_size is in KiB rather than pages.
+        ("cache_size", -settings.sqlite_cache_size_kib),
+        ("mmap_size", settings.sqlite_mmap_size_mib * 1024 * 1024),
+        ("temp_store", "memory"),
+    ]
+
+
+def use_sqlite_profile(engine, read_only: bool = False):
+    """Apply the configured pragmas to each connection ``engine`` opens.
+
+    Read-only connections leave the journal mode to the primary and refuse
+    writes with ``query_only``, which also covers a replica file opened
+    read-write.
+    """
+    pragmas = sqlite_pragmas()
+    if read_only:
+        pragmas = [(name, value) for name, value in pragmas if name != "journal_mode"]
+        pragmas.append(("query_only", 1))
+
+    @_sql.event.listens_for(engine, "connect")
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for name, value in pragmas:
+                cursor.execute(f"PRAGMA {name} = {value}")
+        finally:
+            cursor.close()
+        dbapi_connection.create_function("local_offset", 1, _sqlite_local_offset, deterministic=True)
+
+    return engine
+
+
+def _pool_options(poolclass):
+    return dict(
+        poolclass=poolclass,
+        pool_size=_config.settings.db_pool_size,
+        max_overflow=_config.settings.db_max_overflow,
+        pool_timeout=_config.settings.db_pool_timeout,
+        pool_pre_ping=_config.settings.db_pool_pre_ping,
+        pool_recycle=_config.settings.db_pool_recycle,
+    )
+
+
+def _connect_args(url, read_only: bool = False):
+    if url.get_driver_name() == "pysqlite":
+        return {"check_same_thread": False}
+    if url.get_driver_name() == "asyncpg" and read_only:
+        return {"server_settings": {"default_transaction_read_only": "on"}}
+    return {}
+
+
+def _create_engine(url, read_only: bool = False, create=_sql.create_engine, poolclass=_pool.QueuePool):
+    """An engine for ``url`` with the configured pool, the SQLite profile
+    when it is SQLite, and the SQL instrumentation."""
+    engine = create(url, connect_args=_connect_args(url, read_only), **_pool_options(poolclass))
+    sync_engine = getattr(engine, "sync_engine", engine)
+    if url.get_backend_name() == "sqlite":
+        use_sqlite_profile(sync_engine, read_only=read_only)
+    _instrumentation.instrument_engine(sync_engine)
+    return engine
+
+
+# The API runs on the async engine; the sync engine is kept for the
+# maintenance commands in manage.py and the migrations.
+engine = _create_engine(DATABASE_URL)
 
 SessionLocal = _orm.sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+async_engine = _create_engine(
+    ASYNC_DATABASE_URL, create=_asyncio.create_async_engine, poolclass=_pool.AsyncAdaptedQueuePool
+)
+
+# Reads from GET routes get their own engine and pool, so reporting and
+# exports never queue behind collection writes for a connection.
+read_engine = _create_engine(
+    READ_DATABASE_URL,
+    read_only=True,
+    create=_asyncio.create_async_engine,
+    poolclass=_pool.AsyncAdaptedQueuePool,
+)
+
+# expire_on_commit=False: after a commit, reading an attribute must not
+# trigger lazy I/O, which an AsyncSession cannot do implicitly.
+AsyncSessionLocal = _orm.sessionmaker(
+    bind=async_engine,
+    class_=_asyncio.AsyncSession,
+    autoflush=False,
+    expire_on_commit=False,
+)
+
+ReadSessionLocal = _orm.sessionmaker(
+    bind=read_engine,
+    class_=_asyncio.AsyncSession,
+    autoflush=False,
+    expire_on_commit=False,
+)
+
 Base = _declarative.declarative_base()
@@ -0,0 +1,388 @@
+"""Per-request timing, SQL instrumentation and Prometheus metrics.
+
+Each HTTP request gets a ``RequestTimings`` in a context variable. Engine
+hooks add every statement's time to it, the route class adds the time spent
+turning the endpoint's return value into a response, and the password pool
+adds bcrypt time. The middleware reports the totals in a ``Server-Timing``
+header, which browser devtools show per request, and adds them to per-route
+counters that ``GET /metrics`` exposes in the Prometheus text format.
+
+Statements slower than ``slow_query_ms`` are logged on the ``dairy.sql``
+logger. With ``profiling`` switched on, a request sent with ``X-Profile: 1``
+runs under cProfile and its stats are written to ``profile_dir``.
+"""
+import asyncio
+import contextlib
+import contextvars
+import cProfile
+import functools
+import logging
+import os
+import re
+import time
+import uuid
+
+import fastapi.routing as _routing
+import sqlalchemy as _sql
+from starlette.datastructures import MutableHeaders
+
+import config as _config
+
+# Starlette appends the charset to text/ media types.
+CONTENT_TYPE = "text/plain; version=0.0.4"
+
+# Upper bounds, in seconds, of the request duration histogram buckets.
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+logger = logging.getLogger("dairy.sql")
+
+
+class RequestTimings:
+    """Where one request's time went, in seconds."""
+
+    __slots__ = ("started", "route", "queries", "sql", "serialize", "password", "endpoint_finished")
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.route = None
+        self.queries = 0
+        self.sql = 0.0
+        self.serialize = 0.0
+        self.password = 0.0
+        self.endpoint_finished = None
+
+    def server_timing(self, now: float):
+        ms = lambda seconds: f"{seconds * 1000:.2f}"
+        entries = [
+            f'sql;dur={ms(self.sql)};desc="{self.queries} queries"',
+            f"serialize;dur={ms(self.serialize)}",
+        ]
+        if self.password:
+            entries.append(f"password;dur={ms(self.password)}")
+        entries.append(f"total;dur={ms(now - self.started)}")
+        return ", ".join(entries)
+
+
+_current = contextvars.ContextVar("request_timings", default=None)
+
+
+def record(phase: str, seconds: float):
+    """Add ``seconds`` to ``phase`` of the current request, if there is one."""
+    timings = _current.get()
+    if timings is not None:
+        setattr(timings, phase, getattr(timings, phase) + seconds)
+
+
+@contextlib.contextmanager
+def timed(phase: str):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(phase, time.perf_counter() - started)
+
+
+#------------------------------------------------------------------Metrics-----------------------------------------------------
+
+
+class RouteStats:
+    """Counters for one method and route template."""
+
+    def __init__(self):
+        self.statuses = {}
+        self.buckets = [0] * len(BUCKETS)
+        self.count = 0
+        self.seconds = 0.0
+        self.queries = 0
+        self.sql = 0.0
+        self.serialize = 0.0
+        self.password = 0.0
+
+    def observe(self, status: int, timings: RequestTimings, seconds: float):
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+        for index, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                self.buckets[index] += 1
+                break
+        self.count += 1
+        self.seconds += seconds
+        self.queries += timings.queries
+        self.sql += timings.sql
+        self.serialize += timings.serialize
+        self.password += timings.password
+
+
+class Metrics:
+    """Process-wide counters, rendered in the Prometheus text format."""
+
+    def __init__(self):
+        self.routes = {}
+        self.queries = 0
+        self.sql = 0.0
+        self.slow_queries = 0
+        self.profiles = 0
+        self._collectors = []
+
+    def observe(self, method: str, route: str, status: int, timings: RequestTimings, seconds: float):
+        stats = self.routes.get((method, route))
+        if stats is None:
+            stats = self.routes[(method, route)] = RouteStats()
+        stats.observe(status, timings, seconds)
+
+    def collector(self, function):
+        """Register ``function`` to add samples to every scrape.
+
+        It returns ``(name, kind, help, value)`` tuples, one per metric.
+        """
+        self._collectors.append(function)
+        return function
+
+    def render(self):
+        lines = []
+
+        def family(name, kind, help, samples):
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for suffix, labels, value in samples:
+                lines.append(f"{name}{suffix}{_labels(labels)} {_value(value)}")
+
+        routes = sorted(self.routes.items())
+        family(
+            "dairy_http_requests_total", "counter", "HTTP requests by route and status.",
+            [
+                ("", dict(method=method, route=route, status=status), number)
+                for (method, route), stats in routes
+                for status, number in sorted(stats.statuses.items())
+            ],
+        )
+
+        samples = []
+        for (method, route), stats in routes:
+            labels = dict(method=method, route=route)
+            cumulative = 0
+            for bound, number in zip(BUCKETS, stats.buckets):
+                cumulative += number
+                samples.append(("_bucket", dict(labels, le=_value(bound)), cumulative))
+            samples.append(("_bucket", dict(labels, le="+Inf"), stats.count))
+            samples.append(("_sum", labels, stats.seconds))
+            samples.append(("_count", labels, stats.count))
+        family("dairy_http_request_duration_seconds", "histogram", "Time to serve a request.", samples)
+
+        for name, attribute, help in (
+            ("dairy_http_sql_queries_total", "queries", "SQL statements run while serving requests."),
+            ("dairy_http_sql_seconds_total", "sql", "Time spent in SQL while serving requests."),
+            ("dairy_http_serialize_seconds_total", "serialize", "Time spent encoding responses."),
+            ("dairy_http_password_seconds_total", "password", "Time spent waiting for password hashing."),
+        ):
+            family(
+                name, "counter", help,
+                [("", dict(method=method, route=route), getattr(stats, attribute)) for (method, route), stats in routes],
+            )
+
+        family("dairy_sql_queries_total", "counter", "SQL statements run.", [("", {}, self.queries)])
+        family("dairy_sql_seconds_total", "counter", "Time spent in SQL.", [("", {}, self.sql)])
+        family(
+            "dairy_sql_slow_queries_total", "counter", "Statements slower than slow_query_ms.",
+            [("", {}, self.slow_queries)],
+        )
+        family("dairy_profiles_total", "counter", "Requests profiled on demand.", [("", {}, self.profiles)])
+
+        for function in self._collectors:
+            for name, kind, help, value in function():
+                family(name, kind, help, [("", {}, value)])
+        return "\n".join(lines) + "\n"
+
+
+def _escape(value):
+    return str(value).replace("\\", r"\\").replace('"', r"\"").replace("\n", r"\n")
+
+
+def _labels(labels: dict):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels.items()) + "}"
+
+
+def _value(value):
+    if isinstance(value, float):
+        return repr(value) if value != int(value) else str(int(value))
+    return str(value)
+
+
+metrics = Metrics()
+
+
+#------------------------------------------------------------------SQL-----------------------------------------------------
+
+
+def instrument_engine(engine):
+    """Count and time every statement ``engine`` runs, and log slow ones."""
+    _sql.event.listen(engine, "before_cursor_execute", _before_execute)
+    _sql.event.listen(engine, "after_cursor_execute", _after_execute)
+    return engine
+
+
+def _before_execute(conn, cursor, statement, parameters, context, executemany):
+    context._query_started = time.perf_counter()
+
+
+def _after_execute(conn, cursor, statement, parameters, context, executemany):
+    started = getattr(context, "_query_started", None)
+    if started is None:
+        return
+    elapsed = time.perf_counter() - started
+    metrics.queries += 1
+    metrics.sql += elapsed
+
+    timings = _current.get()
+    if timings is not None:
+        timings.queries += 1
+        timings.sql += elapsed
+
+    if elapsed * 1000 >= _config.settings.slow_query_ms:
+        metrics.slow_queries += 1
+        # Parameters are left out: they carry customer names and emails.
+        logger.warning(
+            "slow query: %.1f ms in %s%s\n%s",
+            elapsed * 1000,
+            timings.route if timings is not None and timings.route else "no request",
+            f" ({len(parameters)} rows)" if executemany else "",
+            statement,
+        )
+
+
+#------------------------------------------------------------------Routes-----------------------------------------------------
+
+
+class TimedRoute(_routing.APIRoute):
+    """An APIRoute that names the current request's route and times encoding.
+
+    FastAPI validates an endpoint's return value against ``response_model``
+    and encodes it after the endpoint returns; the time from there to the
+    finished response is counted as serialization.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        call = self.dependant.call
+        if asyncio.iscoroutinefunction(call):
+
+            @functools.wraps(call)
+            async def endpoint(**values):
+                try:
+                    return await call(**values)
+                finally:
+                    _endpoint_finished()
+
+        else:
+
+            @functools.wraps(call)
+            def endpoint(**values):
+                try:
+                    return call(**values)
+                finally:
+                    _endpoint_finished()
+
+        self.dependant.call = endpoint
+
+    def get_route_handler(self):
+        handler = super().get_route_handler()
+        route = self.path
+
+        async def timed_handler(request):
+            timings = _current.get()
+            if timings is None:
+                return await handler(request)
+            timings.route = route
+            response = await handler(request)
+            if timings.endpoint_finished is not None:
+                timings.serialize += time.perf_counter() - timings.endpoint_finished
+            return response
+
+        return timed_handler
+
+
+def _endpoint_finished():
+    timings = _current.get()
+    if timings is not None:
+        timings.endpoint_finished = time.perf_counter()
+
+
+#------------------------------------------------------------------Middleware-----------------------------------------------------
+
+
+class TimingMiddleware:
+    """Time each HTTP request, send ``Server-Timing`` and update the metrics."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        timings = RequestTimings()
+        token = _current.set(timings)
+        profile = _start_profile(scope)
+        status = 500
+
+        async def send_with_timing(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                headers = MutableHeaders(scope=message)
+                headers.append("Server-Timing", timings.server_timing(time.perf_counter()))
+                if profile is not None:
+                    headers.append("X-Profile", os.path.basename(profile[1]))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _current.reset(token)
+            if profile is not None:
+                _finish_profile(*profile)
+            metrics.observe(
+                scope["method"],
+                timings.route or "unmatched",
+                status,
+                timings,
+                time.perf_counter() - timings.started,
+            )
+
+
+#------------------------------------------------------------------Profiling-----------------------------------------------------
+
+# cProfile hooks the whole thread, so only one request is profiled at a
+# time; its stats also include whatever else the event loop ran meanwhile.
+_profiling = False
+
+
+def _start_profile(scope):
+    global _profiling
+    settings = _config.settings
+    if not settings.profiling or _profiling:
+        return None
+    if dict(scope["headers"]).get(b"x-profile", b"").lower() not in (b"1", b"true", b"yes"):
+        return None
+
+    os.makedirs(settings.profile_dir, exist_ok=True)
+    name = re.sub(r"[^A-Za-z0-9]+", "-", scope["path"]).strip("-") or "root"
+    path = os.path.join(
+        settings.profile_dir,
+        f"{time.strftime('%Y%m%dT%H%M%S')}-{scope['method']}-{name}-{uuid.uuid4().hex[:8]}.prof",
+    )
+    profiler = cProfile.Profile()
+    _profiling = True
+    profiler.enable()
+    return profiler, path
+
+
+def _finish_profile(profiler, path: str):
+    global _profiling
+    profiler.disable()
+    _profiling = False
+    profiler.dump_stats(path)
+    metrics.profiles += 1
+    logger.info("profile written to %s", path)
@@ -0,0 +1,205 @@
+"""Background reports and exports.
+
+A report over a year of ledgers, or an export of every row, can take
+minutes. Run inside a request it holds a worker and a database connection
+for all that time, so POST /api/jobs queues it in the ``job`` table
+instead, and a dispatcher runs it. The client polls GET /api/jobs/{id} and
+downloads GET /api/jobs/{id}/result once it is done.
+
+Each API process runs a dispatcher, and ``python manage.py run-jobs`` runs
+one on its own (with DAIRY_JOB_WORKERS=0 on the API, only that one runs
+jobs). A dispatcher claims queued jobs while it has fewer than
+``job_workers`` running and starts each in a process of its own, niced so
+that requests get the CPU first. Cancelling a running job terminates its
+process. Jobs left running by a dispatcher that died are queued again
+when a dispatcher on the same host starts.
+"""
+import asyncio
+import contextlib
+import logging
+import multiprocessing
+import os
+import socket
+import time
+
+import config as _config, database as _database, instrumentation as _instrumentation
+import services as _services
+
+logger = logging.getLogger("dairy.jobs")
+
+# Added to a job process's niceness.
+JOB_NICENESS = 10
+PRUNE_SECONDS = 3600
+
+if "forkserver" in multiprocessing.get_all_start_methods():
+    # Forked from a server that has already imported the app, so a job
+    # starts without paying for the imports again. The server imports it by
+    # name from the directory it starts in, ahead of the app's sys.path, so
+    # only from the app's own directory: elsewhere a "jobs" directory would
+    # be imported in its place.
+    _context = multiprocessing.get_context("forkserver")
+    if os.path.dirname(os.path.abspath(__file__)) == os.getcwd():
+        _context.set_forkserver_preload(["jobs"])
+else:
+    _context = multiprocessing.get_context("spawn")
+
+
+async def _run(job_id: int):
+    try:
+        async with _database.AsyncSessionLocal() as db, _database.ReadSessionLocal() as read_db:
+            await _services.run_job(db, job_id, read_db)
+    finally:
+        await _database.async_engine.dispose()
+        await _database.read_engine.dispose()
+
+
+def _renice(pid: int):
+    if hasattr(os, "setpriority"):
+        niceness = min(os.getpriority(os.PRIO_PROCESS, 0) + JOB_NICENESS, 19)
+        with contextlib.suppress(OSError):
+            os.setpriority(os.PRIO_PROCESS, pid, niceness)
+
+
+def _work(job_id: int):
+    """A job process: run one job."""
+    try:
+        asyncio.run(_run(job_id))
+    except Exception:
+        logger.exception("job %s failed", job_id)
+        raise SystemExit(1)
+
+
+def _alive(worker: str):
+    """Whether the dispatcher named ``worker`` may still be running: any on
+    another host, one on this host only if its pid is."""
+    host, _, pid = (worker or "").rpartition(":")
+    if host != socket.gethostname():
+        return host != ""
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except (PermissionError, ValueError):
+        return True
+    return True
+
+
+class Dispatcher:
+    """Runs queued jobs, each in its own process, at most ``workers`` at once."""
+
+    def __init__(self, workers: int, poll_seconds: float):
+        self.workers = workers
+        self.poll_seconds = poll_seconds
+        self.worker = None
+        self.running = {}
+        self._wake = None
+        self._task = None
+        self.started = 0
+        self.failed = 0
+        self.cancelled = 0
+
+    def start(self):
+        """Start dispatching on the running event loop; a no-op with no workers."""
+        if self.workers and self._task is None:
+            self.worker = f"{socket.gethostname()}:{os.getpid()}"
+            self._wake = asyncio.Event()
+            self._task = asyncio.get_running_loop().create_task(self._loop())
+
+    def wake(self):
+        """Look at the queue now rather than at the next poll."""
+        if self._wake is not None:
+            self._wake.set()
+
+    async def stop(self):
+        """Stop dispatching, and terminate running jobs and queue them again."""
+        if self._task is None:
+            return
+        self._task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await self._task
+        self._task = None
+        if self.running:
+            for process in self.running.values():
+                process.terminate()
+            for process in self.running.values():
+                await asyncio.to_thread(process.join)
+            async with _database.AsyncSessionLocal() as db:
+                await _services.requeue_jobs(db, list(self.running))
+            self.running.clear()
+
+    async def _loop(self):
+        async with _database.AsyncSessionLocal() as db:
+            recovered = await _services.recover_jobs(db, _alive)
+        if recovered:
+            logger.warning("requeued %s jobs left running by a stopped worker", recovered)
+        pruned_at = 0.0
+        while True:
+            try:
+                async with _database.AsyncSessionLocal() as db:
+                    await self._reap(db)
+                    await self._claim(db)
+                    if time.monotonic() - pruned_at > PRUNE_SECONDS:
+                        pruned_at = time.monotonic()
+                        await _services.prune_jobs(db)
+            except Exception:
+                logger.exception("job dispatcher")
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._wake.wait(), self.poll_seconds)
+            self._wake.clear()
+
+    async def _reap(self, db):
+        for job_id, process in list(self.running.items()):
+            if process.is_alive():
+                continue
+            process.join()
+            del self.running[job_id]
+            if process.exitcode:
+                # A job that fails records so itself; this catches a process
+                # that died without doing so.
+                self.failed += 1
+                await _services.finish_job(
+                    db, job_id, "failed", f"job process exited with code {process.exitcode}"
+                )
+
+        for job_id in await _services.cancel_requested_jobs(db, list(self.running)):
+            process = self.running.pop(job_id)
+            process.terminate()
+            await asyncio.to_thread(process.join)
+            self.cancelled += 1
+            await _services.finish_job(db, job_id, "cancelled")
+
+    async def _claim(self, db):
+        free = self.workers - len(self.running)
+        if free <= 0:
+            return
+        for job_id in await _services.claim_jobs(db, free, self.worker):
+            process = _context.Process(target=_work, args=(job_id,), name=f"dairy-job-{job_id}", daemon=True)
+            # The first start also starts the fork server, which takes a while.
+            await asyncio.to_thread(process.start)
+            # At once, before the process sets up (it imports the main
+            # module again), so that requests get the CPU first throughout.
+            _renice(process.pid)
+            self.running[job_id] = process
+            self.started += 1
+
+    async def serve(self):
+        """Dispatch until cancelled, for ``python manage.py run-jobs``."""
+        self.start()
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await self.stop()
+
+
+dispatcher = Dispatcher(_config.settings.job_workers, _config.settings.job_poll_seconds)
+
+
+@_instrumentation.metrics.collector
+def _dispatcher_metrics():
+    return [
+        ("dairy_job_workers", "gauge", "Job processes allowed at once.", dispatcher.workers),
+        ("dairy_job_running", "gauge", "Job processes running.", len(dispatcher.running)),
+        ("dairy_job_started_total", "counter", "Job processes started.", dispatcher.started),
+        ("dairy_job_failed_total", "counter", "Job processes that exited with an error.", dispatcher.failed),
+        ("dairy_job_cancelled_total", "counter", "Running jobs terminated on request.", dispatcher.cancelled),
+    ]
@@ -1,13 +1,19 @@
-from typing import List
+import datetime as _dt
+from typing import List, Optional, Union
 import fastapi as _fastapi
 from fastapi import Depends, FastAPI
 import fastapi.security as _security
 from fastapi.middleware.cors import CORSMiddleware
-import sqlalchemy.orm as _orm
+from fastapi.responses import FileResponse, StreamingResponse
+import sqlalchemy.ext.asyncio as _asyncio
 
+import cache as _cache, compression as _compression, database as _database
+import instrumentation as _instrumentation, jobs as _jobs
+import passwords as _passwords
 import services as _services, schemas as _schemas
 
 app = FastAPI()
+app.router.route_class = _instrumentation.TimedRoute
 
 
 origins = [
@@ -20,12 +26,74 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "Server-Timing"],
 )
+# Inside the timing middleware, so that compressing counts in the timings.
+app.add_middleware(_compression.CompressionMiddleware)
+app.add_middleware(_instrumentation.TimingMiddleware)
+
+
+@app.on_event("startup")
+async def load_revoked_tokens():
+    await _services.load_revoked_tokens()
+
+
+@app.on_event("startup")
+def start_job_dispatcher():
+    _jobs.dispatcher.start()
+
+
+@app.on_event("startup")
+def start_archive_watch():
+    _services.archive_watch.start()
+
+
+@app.on_event("shutdown")
+async def stop_job_dispatcher():
+    await _jobs.dispatcher.stop()
+
+
+@app.on_event("shutdown")
+async def stop_archive_watch():
+    await _services.archive_watch.stop()
+
+
+@app.on_event("shutdown")
+def shutdown_password_pool():
+    _passwords.pool.shutdown()
+
+
+@app.on_event("shutdown")
+async def dispose_engines():
+    # Pooled aiosqlite connections each hold a worker thread that would
+    # otherwise keep the process alive after the server stops.
+    await _database.async_engine.dispose()
+    await _database.read_engine.dispose()
+
+
+def _json_page(body: bytes, next_cursor):
+    # List services return encoded JSON; response_model still documents it.
+    response = _fastapi.Response(content=body, media_type="application/json")
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return response
+
+
+def _export_response(name: str, fmt: str, chunks):
+    return StreamingResponse(
+        chunks,
+        media_type=_services.EXPORT_MEDIA_TYPES[fmt],
+        headers={"Content-Disposition": f'attachment; filename="{name}.{fmt}"'},
+    )
+
+
+async def _export_format(format: str = _fastapi.Query("ndjson", regex="^(ndjson|csv)$")):
+    return format
 
 
 @app.post("/api/users")
 async def create_user(
-    user: _schemas.UserCreate, db: _orm.Session = _fastapi.Depends(_services.get_db)
+    user: _schemas.UserCreate, db: _asyncio.AsyncSession = _fastapi.Depends(_services.get_db)
 ):
     db_user = await _services.get_user_by_email(user.email, db)
     if db_user:
@@ -39,7 +107,7 @@ async def create_user(
 @app.post("/api/token")
 async def generate_token(
     form_data: _security.OAuth2PasswordRequestForm = _fastapi.Depends(),
-    db: _orm.Session = _fastapi.Depends(_services.get_db),
+    db: _asyncio.AsyncSession = _fastapi.Depends(_services.get_db),
 ):
     user = await _services.authenticate_user(form_data.username, form_data.password, db)
 
@@ -49,38 +117,100 @@ async def generate_token(
     return await _services.create_token(user)
 
 
+@app.post("/api/token/revoke")
+async def revoke_token(
+    claims: _schemas.TokenClaims = _fastapi.Depends(_services.get_current_user),
+    db: _asyncio.AsyncSession = _fastapi.Depends(_services.get_db),
+):
+    await _services.revoke_token(claims, db)
+    return {"message": "Token revoked"}
+
+
 @app.get("/api/users/me", response_model=_schemas.User)
 async def get_user(user: _schemas.User = _fastapi.Depends(_services.get_current_user)):
     return user
 
 
-@app.get("/api/customers", response_model=List[_schemas.Customer])
+@app.get("/api/metrics/passwords")
+async def get_password_metrics(user: _schemas.User = _fastapi.Depends(_services.get_current_user)):
+    return _passwords.pool.metrics()
+
+
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics():
+    return _fastapi.Response(
+        content=_instrumentation.metrics.render(), media_type=_instrumentation.CONTENT_TYPE
+    )
+
+
+@app.get(
+    "/api/customers",
+    response_model=Union[List[_schemas.CustomerWithMilks], List[_schemas.Customer]],
+)
 async def get_customers(
-    db: _orm.Session = _fastapi.Depends(_services.get_db),
+    request: _fastapi.Request,
+    include: Optional[str] = _fastapi.Query(None, regex="^milks$"),
+    since: Optional[_dt.date] = None,
+    milk_limit: int = _fastapi.Query(
+        _services.DEFAULT_MILKS_PER_CUSTOMER, ge=1, le=_services.MAX_MILKS_PER_CUSTOMER
+    ),
+    page: _schemas.PageParams = _fastapi.Depends(_services.get_page_params),
+    db: _asyncio.AsyncSession = _fastapi.Depends(_services.get_read_db),
 ):
-    return await _services.get_customers(db=db)
+    async def produce():
+        if include == "milks":
+            body, next_cursor = await _services.get_customers_with_milks(
+                db=db, page=page, since=since, milk_limit=milk_limit
+            )
+        else:
+            body, next_cursor = await _services.get_customers(db=db, page=page)
+        return body, {"X-Next-Cursor": next_cursor} if next_cursor else {}
+
+    tags = ["customers", "milks"] if include == "milks" else ["customers"]
+    return await _cache.cached_json(request, tags, produce)
 
 
 @app.post("/api/customers", response_model=_schemas.Customer)
 async def create_customer(
     customer: _schemas.CustomerCreate,
-    db: _orm.Session = _fastapi.Depends(_services.get_db),
+    db: _asyncio.AsyncSession = _fastapi.Depends(_services.get_db),
 ):
     return await _services.create_customer(db=db, customer=customer)
 
 
+@app.get("/api/customers/export")
+async def export_customers(
+    fmt: str = _fastapi.Depends(_export_format),
+    db: _asyncio.AsyncSession = _fastapi.Depends(_services.get_read_db),
+):
+    return _export_response("customers", fmt, _services.export_customers(db, fmt))
+
+
+@app.get("/api/customers/search", response_model=List[_schemas.Customer])
+async def search_customers(
+    q: str = _fastapi.Query(..., min_length=1, max_length=100),
+    limit: int = _fastapi.Query(_services.DEFAULT_SEARCH_RESULTS, ge=1, le=_services.MAX_SEARCH_RESULTS),
+    db: _asyncio.AsyncSession = _fastapi.Depends(_services.get_read_db),
+):
+    return _json_page(await _services.search_customers(db, q, limit), None)
+
+
 @app.get("/api/customers/{customer_id}", status_code=200)
 async def get_customer(
     customer_id: int,
-    db: _orm.Session = _fastapi.Depends(_services.get_db),
+    request: _fastapi.Request,
+    db: _asyncio.AsyncSession = _fastapi.Depends(_services.get_read_db),
 ):
-    return await _services.get_customer(customer_id, db)
+    async def produce():
+        return await _services.get_customer(customer_id, db), {}
+
+    return await _cache.cached_json(request, [f"customer:{customer_id}"], produce)
 
 
 @app.delete("/api/customers/{customer_id}", status_code=200)
 async def delete_customer(
     customer_id: int,
-    db: _orm.Session = _fastapi.Depends(_services.get_db),
+    db: _asyncio.AsyncSession = _fastapi.Depends(_services.get_db),
 ):
     await _services.delete_customer(customer_id, db)
     return {"message", "Successfully Deleted"}
@@ -90,49 +220,117 @@ async def delete_customer(
 async def update_customer(
     customer_id: int,
     customer: _schemas.CustomerCreate,
-    db: _orm.Session = _fastapi.Depends(_services.get_db),
+    db: _asyncio.AsyncSession = _fastapi.Depends(_services.get_db),
 ):
     await _services.update_customer(customer_id, customer, db)
     return {"message", "Successfully Updated"}
 
 
+@app.patch("/api/customers/{customer_id}", response_model=_schemas.Customer)
+async def patch_customer(
+    customer_id: int,
+    customer: _schemas.CustomerUpdate,
+    db: _asyncio.AsyncSession = _fastapi.Depends(_services.get_db),
+):
+    return await _services.update_customer(customer_id, customer, db)
+
+
 @app.post("/api/milks", response_model=_schemas.Milk)
 async def create_milk(
     milk: _schemas.MilkCreate,
-    db: _orm.Session = _fastapi.Depends(_services.get_db),
+    db: _asyncio.AsyncSession = _fastapi.Depends(_services.get_db),
 ):
     return await _services.create_milk(db=db, milk=milk)
 
 
+@app.post("/api/milks/bulk", response_model=_schemas.BulkResult)
+async def create_milks_bulk(
+    request: _fastapi.Request,
+    db: _asyncio.AsyncSession = _fastapi.Depends(_services.get_db),
+):
+    records = await _services.read_bulk_records(request)
+    return await _services.create_milks_bulk(db=db, records=records)
+
+
+async def _idempotent_response(response: _fastapi.Response, call):
+    result, replayed = await call
+    if replayed:
+        response.headers["Idempotent-Replayed"] = "true"
+    return result
+
+
+@app.post("/api/milks/settle", response_model=_schemas.Settlement)
+async def settle_milks(
+    settlement: _schemas.MilkSettlementCreate,
+    response: _fastapi.Response,
+    idempotency_key: Optional[str] = _fastapi.Header(None, max_length=255),
+    db: _asyncio.AsyncSession = _fastapi.Depends(_services.get_db),
+):
+    return await _idempotent_response(
+        response, _services.settle_milks(db, settlement, idempotency_key)
+    )
+
+
 @app.get("/api/milks", response_model=List[_schemas.Milk])
 async def get_milks(
-    db: _orm.Session = _fastapi.Depends(_services.get_db),
+    page: _schemas.PageParams = _fastapi.Depends(_services.get_page_params),
+    filters: _schemas.MilkFilter = _fastapi.Depends(),
+    include_archived: bool = False,
+    db: _asyncio.AsyncSession = _fastapi.Depends(_services.get_read_db),
+):
+    body, next_cursor = await _services.get_milks(
+        db=db, page=page, filters=filters, include_archived=include_archived
+    )
+    return _json_page(body, next_cursor)
+
+
+@app.get("/api/milks/export")
+async def export_milks(
+    fmt: str = _fastapi.Depends(_export_format),
+    filters: _schemas.MilkFilter = _fastapi.Depends(),
+    include_archived: bool = False,
+    db: _asyncio.AsyncSession = _fastapi.Depends(_services.get_read_db),
 ):
-    return await _services.get_milks(db=db)
+    return _export_response("milks", fmt, _services.export_milks(db, fmt, filters, include_archived))
 
 
 @app.get("/api/milks/{milk_id}", status_code=200)
 async def get_milk(
     milk_id: int,
-    db: _orm.Session = _fastapi.Depends(_services.get_db),
+    request: _fastapi.Request,
+    include_archived: bool = False,
+    db: _asyncio.AsyncSession = _fastapi.Depends(_services.get_read_db),
 ):
-    return await _services.get_milk(milk_id, db)
+    async def produce():
+        return await _services.get_milk(milk_id, db, include_archived), {}
+
+    # milk-rows is bumped by writes that change many rows at once.
+    return await _cache.cached_json(request, [f"milk:{milk_id}", "milk-rows"], produce)
 
 
 @app.put("/api/milks/{milk_id}", status_code=200)
 async def update_milk(
     milk_id: int,
     milk: _schemas.MilkCreate,
-    db: _orm.Session = _fastapi.Depends(_services.get_db),
+    db: _asyncio.AsyncSession = _fastapi.Depends(_services.get_db),
 ):
     await _services.update_milk(milk_id, milk, db)
     return {"message", "Successfully Updated"}
 
 
+@app.patch("/api/milks/{milk_id}", response_model=_schemas.Milk)
+async def patch_milk(
+    milk_id: int,
+    milk: _schemas.MilkUpdate,
+    db: _asyncio.AsyncSession = _fastapi.Depends(_services.get_db),
+):
+    return await _services.update_milk(milk_id, milk, db)
+
+
 @app.delete("/api/milks/{milk_id}", status_code=200)
 async def delete_milk(
     milk_id: int,
-    db: _orm.Session = _fastapi.Depends(_services.get_db),
+    db: _asyncio.AsyncSession = _fastapi.Depends(_services.get_db),
 ):
     await _services.delete_milk(milk_id, db)
     return {"message", "Successfully Deleted"}
@@ -141,40 +339,78 @@ async def delete_milk(
 @app.post("/api/sales", response_model=_schemas.Sale)
 async def create_sale(
     sale: _schemas. SaleCreate,
-    db: _orm.Session = _fastapi.Depends(_services.get_db),
+    db: _asyncio.AsyncSession = _fastapi.Depends(_services.get_db),
 ):
     return await _services.create_sale(db=db, sale=sale)
 
 
+@app.post("/api/sales/settle", response_model=_schemas.Settlement)
+async def settle_sales(
+    settlement: _schemas.LedgerSettlementCreate,
+    response: _fastapi.Response,
+    idempotency_key: Optional[str] = _fastapi.Header(None, max_length=255),
+    db: _asyncio.AsyncSession = _fastapi.Depends(_services.get_db),
+):
+    return await _idempotent_response(
+        response, _services.settle_sales(db, settlement, idempotency_key)
+    )
+
+
 @app.get("/api/sales", response_model=List[_schemas.Sale])
 async def get_sales(
-    db: _orm.Session = _fastapi.Depends(_services.get_db),
+    page: _schemas.PageParams = _fastapi.Depends(_services.get_page_params),
+    filters: _schemas.SaleFilter = _fastapi.Depends(),
+    include_archived: bool = False,
+    db: _asyncio.AsyncSession = _fastapi.Depends(_services.get_read_db),
 ):
-    return await _services.get_sales(db=db)
+    body, next_cursor = await _services.get_sales(
+        db=db, page=page, filters=filters, include_archived=include_archived
+    )
+    return _json_page(body, next_cursor)
+
+
+@app.get("/api/sales/export")
+async def export_sales(
+    fmt: str = _fastapi.Depends(_export_format),
+    filters: _schemas.SaleFilter = _fastapi.Depends(),
+    include_archived: bool = False,
+    db: _asyncio.AsyncSession = _fastapi.Depends(_services.get_read_db),
+):
+    return _export_response("sales", fmt, _services.export_sales(db, fmt, filters, include_archived))
 
 
 @app.get("/api/sales/{sale_id}", status_code=200)
 async def get_sale(
     sale_id: int,
-    db: _orm.Session = _fastapi.Depends(_services.get_db),
+    include_archived: bool = False,
+    db: _asyncio.AsyncSession = _fastapi.Depends(_services.get_read_db),
 ):
-    return await _services.get_sale(sale_id, db)
+    return await _services.get_sale(sale_id, db, include_archived)
 
 
 @app.put("/api/sales/{sale_id}", status_code=200)
 async def update_sale(
     sale_id: int,
     sale: _schemas.SaleCreate,
-    db: _orm.Session = _fastapi.Depends(_services.get_db),
+    db: _asyncio.AsyncSession = _fastapi.Depends(_services.get_db),
 ):
     await _services.update_sale(sale_id, sale, db)
     return {"message", "Successfully Updated"}
 
 
+@app.patch("/api/sales/{sale_id}", response_model=_schemas.Sale)
+async def patch_sale(
+    sale_id: int,
+    sale: _schemas.SaleUpdate,
+    db: _asyncio.AsyncSession = _fastapi.Depends(_services.get_db),
+):
+    return await _services.update_sale(sale_id, sale, db)
+
+
 @app.delete("/api/sales/{sale_id}", status_code=200)
 async def delete_sale(
     sale_id: int,
-    db: _orm.Session = _fastapi.Depends(_services.get_db),
+    db: _asyncio.AsyncSession = _fastapi.Depends(_services.get_db),
 ):
     await _services.delete_sale(sale_id, db)
     return {"message", "Successfully Deleted"}
@@ -183,40 +419,78 @@ async def delete_sale(
 @app.post("/api/purchases", response_model=_schemas.Purchase)
 async def create_purchase(
     purchase: _schemas. PurchaseCreate,
-    db: _orm.Session = _fastapi.Depends(_services.get_db),
+    db: _asyncio.AsyncSession = _fastapi.Depends(_services.get_db),
 ):
     return await _services.create_purchase(db=db, purchase=purchase)
 
 
+@app.post("/api/purchases/settle", response_model=_schemas.Settlement)
+async def settle_purchases(
+    settlement: _schemas.LedgerSettlementCreate,
+    response: _fastapi.Response,
+    idempotency_key: Optional[str] = _fastapi.Header(None, max_length=255),
+    db: _asyncio.AsyncSession = _fastapi.Depends(_services.get_db),
+):
+    return await _idempotent_response(
+        response, _services.settle_purchases(db, settlement, idempotency_key)
+    )
+
+
 @app.get("/api/purchases", response_model=List[_schemas.Purchase])
 async def get_purchases(
-    db: _orm.Session = _fastapi.Depends(_services.get_db),
+    page: _schemas.PageParams = _fastapi.Depends(_services.get_page_params),
+    filters: _schemas.PurchaseFilter = _fastapi.Depends(),
+    include_archived: bool = False,
+    db: _asyncio.AsyncSession = _fastapi.Depends(_services.get_read_db),
 ):
-    return await _services.get_purchases(db=db)
+    body, next_cursor = await _services.get_purchases(
+        db=db, page=page, filters=filters, include_archived=include_archived
+    )
+    return _json_page(body, next_cursor)
+
+
+@app.get("/api/purchases/export")
+async def export_purchases(
+    fmt: str = _fastapi.Depends(_export_format),
+    filters: _schemas.PurchaseFilter = _fastapi.Depends(),
+    include_archived: bool = False,
+    db: _asyncio.AsyncSession = _fastapi.Depends(_services.get_read_db),
+):
+    return _export_response("purchases", fmt, _services.export_purchases(db, fmt, filters, include_archived))
 
 
 @app.get("/api/purchases/{purchase_id}", status_code=200)
 async def get_purchase(
     purchase_id: int,
-    db: _orm.Session = _fastapi.Depends(_services.get_db),
+    include_archived: bool = False,
+    db: _asyncio.AsyncSession = _fastapi.Depends(_services.get_read_db),
 ):
-    return await _services.get_purchase(purchase_id, db)
+    return await _services.get_purchase(purchase_id, db, include_archived)
 
 
 @app.put("/api/purchases/{purchase_id}", status_code=200)
 async def update_purchase(
     purchase_id: int,
     purchase: _schemas.PurchaseCreate,
-    db: _orm.Session = _fastapi.Depends(_services.get_db),
+    db: _asyncio.AsyncSession = _fastapi.Depends(_services.get_db),
 ):
     await _services.update_purchase(purchase_id, purchase, db)
     return {"message", "Successfully Updated"}
 
 
+@app.patch("/api/purchases/{purchase_id}", response_model=_schemas.Purchase)
+async def patch_purchase(
+    purchase_id: int,
+    purchase: _schemas.PurchaseUpdate,
+    db: _asyncio.AsyncSession = _fastapi.Depends(_services.get_db),
+):
+    return await _services.update_purchase(purchase_id, purchase, db)
+
+
 @app.delete("/api/purchases/{purchase_id}", status_code=200)
 async def delete_purchase(
     purchase_id: int,
-    db: _orm.Session = _fastapi.Depends(_services.get_db),
+    db: _asyncio.AsyncSession = _fastapi.Depends(_services.get_db),
 ):
     await _services.delete_purchase(purchase_id, db)
     return {"message", "Successfully Deleted"}
@@ -225,22 +499,34 @@ async def delete_purchase(
 @app.post("/api/expenses", response_model=_schemas.Expense)
 async def create_expense(
     expense: _schemas. ExpenseCreate,
-    db: _orm.Session = _fastapi.Depends(_services.get_db),
+    db: _asyncio.AsyncSession = _fastapi.Depends(_services.get_db),
 ):
     return await _services.create_expense(db=db, expense=expense)
 
 
 @app.get("/api/expenses", response_model=List[_schemas.Expense])
 async def get_expenses(
-    db: _orm.Session = _fastapi.Depends(_services.get_db),
+    page: _schemas.PageParams = _fastapi.Depends(_services.get_page_params),
+    filters: _schemas.ExpenseFilter = _fastapi.Depends(),
+    db: _asyncio.AsyncSession = _fastapi.Depends(_services.get_read_db),
 ):
-    return await _services.get_expenses(db=db)
+    body, next_cursor = await _services.get_expenses(db=db, page=page, filters=filters)
+    return _json_page(body, next_cursor)
+
+
+@app.get("/api/expenses/export")
+async def export_expenses(
+    fmt: str = _fastapi.Depends(_export_format),
+    filters: _schemas.ExpenseFilter = _fastapi.Depends(),
+    db: _asyncio.AsyncSession = _fastapi.Depends(_services.get_read_db),
+):
+    return _export_response("expenses", fmt, _services.export_expenses(db, fmt, filters))
 
 
 @app.get("/api/expenses/{expense_id}", status_code=200)
 async def get_expense(
     expense_id: int,
-    db: _orm.Session = _fastapi.Depends(_services.get_db),
+    db: _asyncio.AsyncSession = _fastapi.Depends(_services.get_read_db),
 ):
     return await _services.get_expense(expense_id, db)
 
@@ -249,21 +535,152 @@ async def get_expense(
 async def update_expense(
     expense_id: int,
     expense: _schemas.ExpenseCreate,
-    db: _orm.Session = _fastapi.Depends(_services.get_db),
+    db: _asyncio.AsyncSession = _fastapi.Depends(_services.get_db),
 ):
     await _services.update_expense(expense_id, expense, db)
     return {"message", "Successfully Updated"}
 
 
+@app.patch("/api/expenses/{expense_id}", response_model=_schemas.Expense)
+async def patch_expense(
+    expense_id: int,
+    expense: _schemas.ExpenseUpdate,
+    db: _asyncio.AsyncSession = _fastapi.Depends(_services.get_db),
+):
+    return await _services.update_expense(expense_id, expense, db)
+
+
 @app.delete("/api/expenses/{expense_id}", status_code=200)
 async def delete_expense(
     expense_id: int,
-    db: _orm.Session = _fastapi.Depends(_services.get_db),
+    db: _asyncio.AsyncSession = _fastapi.Depends(_services.get_db),
 ):
     await _services.delete_expense(expense_id, db)
     return {"message", "Successfully Deleted"}
 
 
+#--------------------------------------Reports----------------------------
+@app.get(
+    "/api/reports/milks",
+    response_model=List[_schemas.ReportRow],
+    response_model_exclude_none=True,
+)
+async def get_milk_report(
+    group_by: List[_schemas.ReportGroup] = _fastapi.Query([_schemas.ReportGroup.customer]),
+    filters: _schemas.MilkFilter = _fastapi.Depends(),
+    db: _asyncio.AsyncSession = _fastapi.Depends(_services.get_read_db),
+):
+    return await _services.get_milk_report(db=db, group_by=group_by, filters=filters)
+
+
+@app.get(
+    "/api/reports/sales",
+    response_model=List[_schemas.ReportRow],
+    response_model_exclude_none=True,
+)
+async def get_sale_report(
+    group_by: List[_schemas.ReportGroup] = _fastapi.Query([_schemas.ReportGroup.customer]),
+    filters: _schemas.SaleFilter = _fastapi.Depends(),
+    db: _asyncio.AsyncSession = _fastapi.Depends(_services.get_read_db),
+):
+    return await _services.get_sale_report(db=db, group_by=group_by, filters=filters)
+
+
+@app.get(
+    "/api/reports/purchases",
+    response_model=List[_schemas.ReportRow],
+    response_model_exclude_none=True,
+)
+async def get_purchase_report(
+    group_by: List[_schemas.ReportGroup] = _fastapi.Query([_schemas.ReportGroup.customer]),
+    filters: _schemas.PurchaseFilter = _fastapi.Depends(),
+    db: _asyncio.AsyncSession = _fastapi.Depends(_services.get_read_db),
+):
+    return await _services.get_purchase_report(db=db, group_by=group_by, filters=filters)
+
+
+@app.get("/api/settlements", response_model=List[_schemas.Settlement])
+async def get_settlements(
+    page: _schemas.PageParams = _fastapi.Depends(_services.get_page_params),
+    db: _asyncio.AsyncSession = _fastapi.Depends(_services.get_read_db),
+):
+    body, next_cursor = await _services.get_settlements(db=db, page=page)
+    return _json_page(body, next_cursor)
+
+
+@app.get("/api/reports/dues", response_model=_schemas.Dues, response_model_exclude_none=True)
+async def get_dues(
+    period: _schemas.ReportPeriod = _fastapi.Depends(),
+    db: _asyncio.AsyncSession = _fastapi.Depends(_services.get_read_db),
+):
+    return await _services.get_dues(db=db, period=period)
+
+
+@app.get("/api/reports/profit-loss", response_model=_schemas.ProfitLoss)
+async def get_profit_loss(
+    period: _schemas.ReportPeriod = _fastapi.Depends(),
+    db: _asyncio.AsyncSession = _fastapi.Depends(_services.get_read_db),
+):
+    return await _services.get_profit_loss(db=db, period=period)
+
+
+#--------------------------------------Sync----------------------------
+@app.get("/api/sync", response_model=_schemas.SyncChanges)
+async def get_sync_changes(
+    token: Optional[str] = None,
+    since: Optional[_dt.date] = None,
+    limit: int = _fastapi.Query(_services.DEFAULT_SYNC_ROWS, ge=1, le=_services.MAX_SYNC_ROWS),
+    db: _asyncio.AsyncSession = _fastapi.Depends(_services.get_read_db),
+):
+    return _json_page(await _services.get_sync_changes(db, token=token, since=since, limit=limit), None)
+
+
+@app.post("/api/sync/milks", response_model=_schemas.BulkResult)
+async def push_milks(
+    request: _fastapi.Request,
+    response: _fastapi.Response,
+    idempotency_key: Optional[str] = _fastapi.Header(None, max_length=255),
+    db: _asyncio.AsyncSession = _fastapi.Depends(_services.get_db),
+):
+    records = await _services.read_bulk_records(request)
+    return await _idempotent_response(response, _services.push_milks(db, records, idempotency_key))
+
+
+#--------------------------------------Rates----------------------------
+@app.get("/api/rate-chart", response_model=_schemas.RateChart)
+async def get_rate_chart():
+    return await _services.get_rate_chart()
+
+
+#--------------------------------------Jobs----------------------------
+@app.post("/api/jobs", response_model=_schemas.Job, status_code=202)
+async def create_job(
+    job: _schemas.JobCreate,
+    db: _asyncio.AsyncSession = _fastapi.Depends(_services.get_db),
+):
+    created = await _services.create_job(db, job)
+    _jobs.dispatcher.wake()
+    return created
+
+
+@app.get("/api/jobs/{job_id}", response_model=_schemas.Job)
+async def get_job(job_id: int, db: _asyncio.AsyncSession = _fastapi.Depends(_services.get_db)):
+    # From the primary: a replica could still show a finished job running.
+    return await _services.get_job(db, job_id)
+
+
+@app.post("/api/jobs/{job_id}/cancel", response_model=_schemas.Job)
+async def cancel_job(job_id: int, db: _asyncio.AsyncSession = _fastapi.Depends(_services.get_db)):
+    job = await _services.cancel_job(db, job_id)
+    _jobs.dispatcher.wake()
+    return job
+
+
+@app.get("/api/jobs/{job_id}/result")
+async def get_job_result(job_id: int, db: _asyncio.AsyncSession = _fastapi.Depends(_services.get_db)):
+    path, media_type, filename = await _services.get_job_result(db, job_id)
+    return FileResponse(path, media_type=media_type, filename=filename)
+
 
 # --------------------------------------------------------------------
 @app.get("/api")
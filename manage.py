@@ -0,0 +1,135 @@
+"""Maintenance commands for the dairy backend.
+
+    python manage.py create-database
+    python manage.py migrate [--batch-size N]
+    python manage.py rebuild-rollups [--chunk-size N]
+    python manage.py rebuild-search
+    python manage.py archive [--before YYYY-MM-DD] [--chunk-size N]
+    python manage.py run-jobs [--workers N]
+    python manage.py audit-queries
+"""
+import argparse
+import asyncio
+import datetime as _dt
+import json
+import sys
+
+import config as _config, database as _database, jobs as _jobs, migrations as _migrations, query_audit as _query_audit
+import services as _services
+
+
+def create_database(args):
+    _services.create_database()
+
+
+def migrate(args):
+    report = _migrations.migrate(batch_size=args.batch_size)
+    print(json.dumps(report, indent=2, default=str))
+
+
+async def _rebuild_rollups(chunk_size: int):
+    try:
+        async with _database.AsyncSessionLocal() as db:
+            return await _services.rebuild_milk_rollups(db, chunk_size=chunk_size)
+    finally:
+        await _database.async_engine.dispose()
+
+
+def rebuild_rollups(args):
+    days = asyncio.run(_rebuild_rollups(args.chunk_size))
+    print(f"milk_daily rebuilt: {days} customer-days")
+
+
+async def _rebuild_search():
+    try:
+        async with _database.AsyncSessionLocal() as db:
+            return await _services.rebuild_customer_search(db)
+    finally:
+        await _database.async_engine.dispose()
+
+
+def rebuild_search(args):
+    customers = asyncio.run(_rebuild_search())
+    print(f"customer_search rebuilt: {customers} customers")
+
+
+async def _archive(before, chunk_size: int):
+    try:
+        async with _database.AsyncSessionLocal() as db:
+            return await _services.archive_ledgers(db, before=before, chunk_size=chunk_size)
+    finally:
+        await _database.async_engine.dispose()
+
+
+def archive(args):
+    moved = asyncio.run(_archive(args.before, args.chunk_size))
+    print(json.dumps(moved, indent=2))
+
+
+async def _run_jobs(workers: int):
+    try:
+        await _jobs.Dispatcher(workers, _config.settings.job_poll_seconds).serve()
+    finally:
+        await _database.async_engine.dispose()
+        await _database.read_engine.dispose()
+
+
+def run_jobs(args):
+    try:
+        asyncio.run(_run_jobs(args.workers))
+    except KeyboardInterrupt:
+        pass
+
+
+def audit_queries(args):
+    if not _query_audit.report(_query_audit.run()):
+        sys.exit(1)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Dairy backend maintenance")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    command = commands.add_parser("create-database", help="create any missing tables")
+    command.set_defaults(handler=create_database)
+
+    command = commands.add_parser("migrate", help="upgrade an existing database in place")
+    command.add_argument("--batch-size", type=int, default=_migrations.BATCH_SIZE)
+    command.set_defaults(handler=migrate)
+
+    command = commands.add_parser("rebuild-rollups", help="recompute the daily milk rollups")
+    command.add_argument("--chunk-size", type=int, default=_services.ROLLUP_CHUNK_SIZE)
+    command.set_defaults(handler=rebuild_rollups)
+
+    command = commands.add_parser("rebuild-search", help="reindex customers for /api/customers/search")
+    command.set_defaults(handler=rebuild_search)
+
+    command = commands.add_parser("archive", help="move old paid ledger rows to the yearly archives")
+    command.add_argument(
+        "--before",
+        type=_dt.date.fromisoformat,
+        help="archive rows dated before this day (default: DAIRY_ARCHIVE_AFTER_DAYS ago)",
+    )
+    command.add_argument("--chunk-size", type=int, default=_services.ARCHIVE_CHUNK_SIZE)
+    command.set_defaults(handler=archive)
+
+    command = commands.add_parser("run-jobs", help="run queued report and export jobs until stopped")
+    command.add_argument(
+        "--workers",
+        type=int,
+        default=_config.settings.job_workers or 2,
+        help="jobs run at once (default: DAIRY_JOB_WORKERS, or 2 if that is 0)",
+    )
+    command.set_defaults(handler=run_jobs)
+
+    command = commands.add_parser(
+        "audit-queries", help="fail if a service query full-scans a ledger table"
+    )
+    command.set_defaults(handler=audit_queries)
+
+    args = parser.parse_args(argv)
+    args.handler(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,228 @@
+"""In-place schema upgrades for an existing dairy database.
+
+Every step checks the live schema before doing anything, so ``migrate`` can
+be run on any database, any number of times, and resumes where it stopped if
+it is interrupted. Stop the API while it runs: tables are rebuilt in batches
+and readers would see them half copied.
+"""
+import asyncio
+import decimal as _decimal
+import warnings
+
+import sqlalchemy as _sql
+
+import database as _database, models as _models, services as _services
+
+BATCH_SIZE = 10_000
+
+_LEGACY_SUFFIX = "__legacy"
+
+
+def _column_types(connection, table: str):
+    rows = connection.exec_driver_sql(f'PRAGMA table_info("{table}")')
+    return {row[1]: row[2].upper() for row in rows}
+
+
+def _table_exists(connection, table: str):
+    return bool(_column_types(connection, table))
+
+
+def _to_number(value):
+    if value is None or isinstance(value, (int, float)):
+        return value
+    value = str(value).strip().replace(",", "")
+    if not value:
+        return None
+    try:
+        number = _decimal.Decimal(value)
+    except _decimal.InvalidOperation:
+        raise ValueError(value)
+    if not number.is_finite():
+        raise ValueError(value)
+    return number
+
+
+def _to_paid(value):
+    if value is None or isinstance(value, (int, float)):
+        return bool(value)
+    return str(value).strip().lower() in ("yes", "true", "1")
+
+
+def _convert(row: dict, numbers, stats: dict):
+    for column in numbers:
+        try:
+            row[column] = _to_number(row[column])
+        except ValueError:
+            row[column] = None
+            stats["invalid"] += 1
+    if "is_paid" in row:
+        row["is_paid"] = _to_paid(row["is_paid"])
+    return row
+
+
+def _rebuild_typed(model, batch_size: int):
+    """Rebuild a table whose ledger columns were declared as strings.
+
+    SQLite cannot change a column's type, and values in a VARCHAR column keep
+    text affinity, so the table is renamed aside, recreated from the model and
+    copied back in primary-key batches, each committed on its own.
+    """
+    table = model.__table__
+    legacy = table.name + _LEGACY_SUFFIX
+    numbers = [
+        column.name
+        for column in table.columns
+        if isinstance(column.type, _models.LedgerNumber)
+    ]
+    stats = {"table": table.name, "copied": 0, "invalid": 0}
+
+    with _database.engine.begin() as connection:
+        if not _table_exists(connection, legacy):
+            if _column_types(connection, table.name).get(numbers[0]) != "VARCHAR":
+                return None
+            indexes = connection.exec_driver_sql(
+                "SELECT name FROM sqlite_master "
+                "WHERE type = 'index' AND tbl_name = ? AND sql IS NOT NULL",
+                (table.name,),
+            ).scalars().all()
+            for index in indexes:
+                connection.exec_driver_sql(f'DROP INDEX "{index}"')
+            connection.exec_driver_sql(f'ALTER TABLE "{table.name}" RENAME TO "{legacy}"')
+            table.create(connection)
+
+    columns = [column.name for column in table.columns]
+    select = _sql.text(
+        f'SELECT {", ".join(columns)} FROM "{legacy}" '
+        f"WHERE id > :last_id ORDER BY id LIMIT :limit"
+    ).columns(
+        **{
+            column.name: column.type
+            for column in table.columns
+            if isinstance(column.type, _sql.DateTime)
+        }
+    )
+    while True:
+        with _database.engine.begin() as connection:
+            last_id = connection.execute(_sql.select(_sql.func.max(table.c.id))).scalar() or 0
+            rows = connection.execute(
+                select, {"last_id": last_id, "limit": batch_size}
+            ).mappings().all()
+            if not rows:
+                break
+            connection.execute(
+                table.insert(), [_convert(dict(row), numbers, stats) for row in rows]
+            )
+            stats["copied"] += len(rows)
+
+    with _database.engine.begin() as connection:
+        connection.exec_driver_sql(f'DROP TABLE "{legacy}"')
+
+    return stats
+
+
+def typed_ledger_columns(batch_size: int = BATCH_SIZE):
+    """Store amounts, liters, fat and SNF as numbers and is_paid as a boolean."""
+    # Only SQLite files from before the numeric columns have string ones.
+    if _database.engine.dialect.name != "sqlite":
+        return []
+    results = []
+    for model in (_models.Milk, _models.Sale, _models.Purchase, _models.Expense):
+        stats = _rebuild_typed(model, batch_size)
+        if stats is not None:
+            results.append(stats)
+    return results
+
+
+def missing_indexes(batch_size: int = BATCH_SIZE):
+    """Create indexes added to the models after their tables were created."""
+    created = []
+    with _database.engine.begin() as connection:
+        inspector = _sql.inspect(connection)
+        existing = set(inspector.get_table_names())
+        for table in _database.Base.metadata.sorted_tables:
+            if table.name not in existing:
+                continue
+            with warnings.catch_warnings():
+                # PostgreSQL's expression index on customer (the search index)
+                # cannot be reflected; it is created by its own step.
+                warnings.filterwarnings("ignore", "Skipped unsupported reflection", _sql.exc.SAWarning)
+                names = {index["name"] for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in names:
+                    index.create(connection)
+                    created.append(index.name)
+    return created
+
+
+def customer_search(batch_size: int = BATCH_SIZE):
+    """Create the customer search index and fill it, if the database predates it."""
+    with _database.engine.begin() as connection:
+        if connection.dialect.name == "postgresql":
+            # An index on customer itself: nothing to fill.
+            connection.execute(_models.CUSTOMER_SEARCH_INDEX_DDL)
+            return None
+        if _table_exists(connection, _models.customer_search.name):
+            return None
+        connection.execute(_models.CUSTOMER_SEARCH_DDL)
+        customer = _models.Customer.__table__
+        result = connection.execute(
+            _models.customer_search.insert().from_select(
+                ["rowid", "name", "mobile"], _sql.select(customer.c.id, customer.c.name, customer.c.mobile)
+            )
+        )
+        return {"indexed": result.rowcount}
+
+
+def sync_timestamps(batch_size: int = BATCH_SIZE):
+    """Give rows without a date_last_updated their creation time, so that
+    delta sync, which walks that column, sends them."""
+    filled = {}
+    with _database.engine.begin() as connection:
+        for model in (_models.Customer, _models.Milk):
+            table = model.__table__
+            result = connection.execute(
+                table.update()
+                .where(table.c.date_last_updated.is_(None))
+                .values(date_last_updated=table.c.date_created)
+            )
+            if result.rowcount:
+                filled[table.name] = result.rowcount
+    return filled or None
+
+
+async def _fill_milk_rollups(batch_size: int):
+    try:
+        async with _database.AsyncSessionLocal() as db:
+            return await _services.rebuild_milk_rollups(db, chunk_size=batch_size, single_transaction=True)
+    finally:
+        await _database.async_engine.dispose()
+
+
+def milk_rollups(batch_size: int = BATCH_SIZE):
+    """Fill ``milk_daily`` from the ledger if the database predates it.
+
+    Milk reports, dues and profit/loss read the rollup rather than the
+    ledger, so it must not start out empty. It is filled in one transaction:
+    left empty by an interrupted run, it is filled on the next.
+    """
+    with _database.engine.connect() as connection:
+        if connection.execute(_sql.select(_models.MilkDaily.customer_id).limit(1)).first():
+            return None
+        milks = _sql.exists().where(_models.Milk.id.isnot(None))
+        archived = _sql.exists().where(_models.ArchiveDaily.ledger == _models.Milk.__tablename__)
+        if not connection.execute(_sql.select(milks | archived)).scalar():
+            return None
+    return {"days": asyncio.run(_fill_milk_rollups(batch_size))}
+
+
+STEPS = [typed_ledger_columns, missing_indexes, customer_search, sync_timestamps, milk_rollups]
+
+
+def migrate(batch_size: int = BATCH_SIZE):
+    """Bring the database up to the current models and report what changed."""
+    _database.Base.metadata.create_all(bind=_database.engine)
+
+    report = {}
+    for step in STEPS:
+        report[step.__name__] = step(batch_size=batch_size)
+    return report
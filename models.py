@@ -1,10 +1,62 @@
 import datetime as _dt
+import decimal as _decimal
+import functools as _functools
 
 import sqlalchemy as _sql
 import sqlalchemy.orm as _orm
-import passlib.hash as _hash
 
-import database as _database
+import database as _database, passwords as _passwords
+
+
+def to_decimal(value):
+    """Turn a wire or column value into a Decimal, or None when blank."""
+    if value is None or isinstance(value, _decimal.Decimal):
+        return value
+    value = str(value).strip().replace(",", "")
+    return _decimal.Decimal(value) if value else None
+
+
+def to_paid(value):
+    """Turn a "Yes"/"No" wire value or a column value into a bool."""
+    if isinstance(value, str):
+        return value.strip().lower() in ("yes", "true", "1")
+    return bool(value)
+
+
+class LedgerNumber(_sql.types.TypeDecorator):
+    """Numeric column that also binds the decimal strings used on the wire."""
+
+    impl = _sql.Numeric
+    cache_ok = True
+
+    def load_dialect_impl(self, dialect):
+        # SQLite stores these as REAL; read them back as floats and round to
+        # the column's scale here instead of having Numeric warn about it.
+        if dialect.supports_native_decimal:
+            return self.impl
+        return _sql.Numeric(self.impl.precision, self.impl.scale, asdecimal=False)
+
+    def process_bind_param(self, value, dialect):
+        if isinstance(value, str):
+            return to_decimal(value)
+        return value
+
+    def process_result_value(self, value, dialect):
+        if isinstance(value, (int, float)):
+            return _decimal.Decimal(f"{value:.{self.impl.scale}f}")
+        return value
+
+
+class PaidFlag(_sql.types.TypeDecorator):
+    """Boolean column that also binds the "Yes"/"No" strings used on the wire."""
+
+    impl = _sql.Boolean
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if isinstance(value, str):
+            return to_paid(value)
+        return value
 
 
 class User(_database.Base):
@@ -13,8 +65,8 @@ class User(_database.Base):
     email = _sql.Column(_sql.String, unique=True, index=True)
     hashed_password = _sql.Column(_sql.String)
 
-    def verify_password(self, password: str):
-        return _hash.bcrypt.verify(password, self.hashed_password)
+    async def verify_password(self, password: str):
+        return await _passwords.verify_password(password, self.hashed_password)
 
 
 class Customer(_database.Base):
@@ -28,7 +80,47 @@ class Customer(_database.Base):
     date_created = _sql.Column(_sql.DateTime, default=_dt.datetime.utcnow)
     date_last_updated = _sql.Column(_sql.DateTime, default=_dt.datetime.utcnow)
 
-    milks = _orm.relationship("Milk", back_populates="cust")
+    # Delta sync walks rows in change order.
+    __table_args__ = (_sql.Index("ix_customer_date_last_updated_id", "date_last_updated", "id"),)
+
+    # Never load a customer's ledger implicitly: one lazy load per customer is
+    # an N+1. Callers that need the rows load them in bulk (see
+    # services.get_customers_with_milks).
+    milks = _orm.relationship("Milk", back_populates="cust", lazy="raise_on_sql")
+
+
+# Prefix search over customer names and mobiles: an FTS5 table whose rowid is
+# the customer id. create_all cannot make virtual tables, so this Table stays
+# out of Base.metadata and only describes the columns for queries; the DDL
+# runs right after ``customer`` is created, and the customer services keep
+# the rows current (``migrate`` creates and fills it on older databases).
+customer_search = _sql.Table(
+    "customer_search",
+    _sql.MetaData(),
+    _sql.Column("rowid", _sql.Integer, primary_key=True),
+    _sql.Column("name", _sql.String),
+    _sql.Column("mobile", _sql.String),
+    _sql.Column("rank", _sql.Float),
+)
+
+CUSTOMER_SEARCH_DDL = _sql.DDL(
+    "CREATE VIRTUAL TABLE IF NOT EXISTS customer_search USING fts5("
+    "name, mobile, tokenize = 'unicode61 remove_diacritics 2', prefix = '1 2 3')"
+)
+
+_sql.event.listen(Customer.__table__, "after_create", CUSTOMER_SEARCH_DDL.execute_if(dialect="sqlite"))
+
+# PostgreSQL has no FTS5; the same search runs on a GIN index over this
+# expression, which queries must spell exactly the same way to use it.
+CUSTOMER_SEARCH_DOCUMENT = "to_tsvector('simple', coalesce(name, '') || ' ' || coalesce(mobile, ''))"
+
+CUSTOMER_SEARCH_INDEX_DDL = _sql.DDL(
+    f"CREATE INDEX IF NOT EXISTS ix_customer_search ON customer USING gin ({CUSTOMER_SEARCH_DOCUMENT})"
+)
+
+_sql.event.listen(
+    Customer.__table__, "after_create", CUSTOMER_SEARCH_INDEX_DDL.execute_if(dialect="postgresql")
+)
 
 
 class Milk(_database.Base):
@@ -37,46 +129,230 @@ class Milk(_database.Base):
     customer_id = _sql.Column(_sql.Integer, _sql.ForeignKey("customer.id"))
     customer_name = _sql.Column(_sql.String)
     milk_type = _sql.Column(_sql.String)
-    lit = _sql.Column(_sql.String)
-    fat = _sql.Column(_sql.String, default="")
-    snf = _sql.Column(_sql.String, default="")
-    amount = _sql.Column(_sql.String)
-    is_paid = _sql.Column(_sql.String, default="No")
+    lit = _sql.Column(LedgerNumber(10, 3))
+    fat = _sql.Column(LedgerNumber(5, 2))
+    snf = _sql.Column(LedgerNumber(5, 2))
+    amount = _sql.Column(LedgerNumber(12, 2))
+    is_paid = _sql.Column(PaidFlag, default=False)
     date_created = _sql.Column(_sql.DateTime, default=_dt.datetime.utcnow)
     date_last_updated = _sql.Column(_sql.DateTime, default=_dt.datetime.utcnow)
 
-    cust = _orm.relationship("Customer", back_populates="milks")
+    cust = _orm.relationship("Customer", back_populates="milks", lazy="raise_on_sql")
+
+    __table_args__ = (
+        _sql.Index("ix_milk_customer_id_date_created", "customer_id", "date_created"),
+        _sql.Index("ix_milk_is_paid_date_created", "is_paid", "date_created"),
+        _sql.Index("ix_milk_date_created", "date_created"),
+        _sql.Index("ix_milk_date_last_updated_id", "date_last_updated", "id"),
+    )
+
+
+class MilkDaily(_database.Base):
+    """Per-customer, per-day totals of the milk ledger.
+
+    Kept in step with ``milk`` by the service functions that write it, inside
+    the same transaction. Fat and SNF are stored as liter-weighted sums over
+    the liters that carried a reading, so averages can be recovered exactly.
+    """
+
+    __tablename__ = "milk_daily"
+    customer_id = _sql.Column(_sql.Integer, primary_key=True)
+    day = _sql.Column(_sql.Date, primary_key=True)
+    milk_type = _sql.Column(_sql.String, primary_key=True)
+    customer_name = _sql.Column(_sql.String)
+    entries = _sql.Column(_sql.Integer, default=0)
+    liters = _sql.Column(LedgerNumber(14, 3), default=0)
+    amount = _sql.Column(LedgerNumber(14, 2), default=0)
+    fat_weighted = _sql.Column(LedgerNumber(16, 4), default=0)
+    fat_liters = _sql.Column(LedgerNumber(14, 3), default=0)
+    snf_weighted = _sql.Column(LedgerNumber(16, 4), default=0)
+    snf_liters = _sql.Column(LedgerNumber(14, 3), default=0)
+    unpaid_entries = _sql.Column(_sql.Integer, default=0)
+    unpaid_liters = _sql.Column(LedgerNumber(14, 3), default=0)
+    unpaid_amount = _sql.Column(LedgerNumber(14, 2), default=0)
+
+    __table_args__ = (_sql.Index("ix_milk_daily_day", "day"),)
 
 #--------------------sales-----------------------
 class Sale(_database.Base):
     __tablename__ = "sale"
+    __table_args__ = (_sql.Index("ix_sale_date_created", "date_created"),)
     id = _sql.Column(_sql.Integer, primary_key=True, index=True)
     customername = _sql.Column(_sql.String, index=True)
     milk_type = _sql.Column(_sql.String)
-    lit = _sql.Column(_sql.String)
-    amount = _sql.Column(_sql.String)
-    is_paid = _sql.Column(_sql.String, default="No")
+    lit = _sql.Column(LedgerNumber(10, 3))
+    amount = _sql.Column(LedgerNumber(12, 2))
+    is_paid = _sql.Column(PaidFlag, default=False)
     date_created = _sql.Column(_sql.DateTime, default=_dt.datetime.utcnow)
     date_last_updated = _sql.Column(_sql.DateTime, default=_dt.datetime.utcnow)
 
 #--------------------------------------Purchase--------------------------
 class Purchase(_database.Base):
     __tablename__ = "purchase"
+    __table_args__ = (_sql.Index("ix_purchase_date_created", "date_created"),)
     id = _sql.Column(_sql.Integer, primary_key=True, index=True)
     customername = _sql.Column(_sql.String, index=True)
     milk_type = _sql.Column(_sql.String)
-    lit = _sql.Column(_sql.String)
-    amount = _sql.Column(_sql.String)
-    is_paid = _sql.Column(_sql.String, default="No")
+    lit = _sql.Column(LedgerNumber(10, 3))
+    amount = _sql.Column(LedgerNumber(12, 2))
+    is_paid = _sql.Column(PaidFlag, default=False)
     date_created = _sql.Column(_sql.DateTime, default=_dt.datetime.utcnow)
     date_last_updated = _sql.Column(_sql.DateTime, default=_dt.datetime.utcnow)
 
     #----------------------------Expenses------------------------------
 class Expense(_database.Base):
     __tablename__ = "expense"
+    __table_args__ = (_sql.Index("ix_expense_date_created", "date_created"),)
     id = _sql.Column(_sql.Integer, primary_key=True, index=True)
     remark = _sql.Column(_sql.String, index=True)
-    amount = _sql.Column(_sql.String)
+    amount = _sql.Column(LedgerNumber(12, 2))
     date_created = _sql.Column(_sql.DateTime, default=_dt.datetime.utcnow)
     date_last_updated = _sql.Column(_sql.DateTime, default=_dt.datetime.utcnow)
 
+    #----------------------------Tokens------------------------------
+class RevokedToken(_database.Base):
+    # Revoked before their expiry; rows can be pruned once expires_at passes.
+    __tablename__ = "revoked_token"
+    jti = _sql.Column(_sql.String, primary_key=True)
+    expires_at = _sql.Column(_sql.DateTime, nullable=False, index=True)
+
+    #----------------------------Settlements------------------------------
+class Settlement(_database.Base):
+    """One mark-as-paid run over a customer's ledger rows for a period.
+
+    ``idempotency_key`` is the client's Idempotency-Key header: a retried
+    request finds its settlement here and gets it back instead of settling
+    again.
+    """
+
+    __tablename__ = "settlement"
+    id = _sql.Column(_sql.Integer, primary_key=True, index=True)
+    ledger = _sql.Column(_sql.String, nullable=False)
+    idempotency_key = _sql.Column(_sql.String, unique=True)
+    customer_id = _sql.Column(_sql.Integer)
+    customername = _sql.Column(_sql.String)
+    milk_type = _sql.Column(_sql.String)
+    date_from = _sql.Column(_sql.Date, nullable=False)
+    date_to = _sql.Column(_sql.Date, nullable=False)
+    entries = _sql.Column(_sql.Integer, default=0)
+    liters = _sql.Column(LedgerNumber(14, 3), default=0)
+    amount = _sql.Column(LedgerNumber(14, 2), default=0)
+    date_created = _sql.Column(_sql.DateTime, default=_dt.datetime.utcnow)
+
+    #----------------------------Archive------------------------------
+class ArchiveDaily(_database.Base):
+    """Totals of the ledger rows moved out to the archive.
+
+    One row per ledger, day, shift, customer and milk type, written in the
+    same transaction that deletes the rows from the hot table, so reports
+    still count them without opening the archive. ``customer_id`` is 0 for
+    sales and purchases, which only carry a name; blanks are stored as ''
+    as in ``milk_daily``.
+    """
+
+    __tablename__ = "archive_daily"
+    ledger = _sql.Column(_sql.String, primary_key=True)
+    day = _sql.Column(_sql.Date, primary_key=True)
+    shift = _sql.Column(_sql.String, primary_key=True)
+    customer_id = _sql.Column(_sql.Integer, primary_key=True)
+    customer_name = _sql.Column(_sql.String, primary_key=True)
+    milk_type = _sql.Column(_sql.String, primary_key=True)
+    entries = _sql.Column(_sql.Integer, default=0)
+    liters = _sql.Column(LedgerNumber(14, 3), default=0)
+    amount = _sql.Column(LedgerNumber(14, 2), default=0)
+    fat_weighted = _sql.Column(LedgerNumber(16, 4), default=0)
+    fat_liters = _sql.Column(LedgerNumber(14, 3), default=0)
+    snf_weighted = _sql.Column(LedgerNumber(16, 4), default=0)
+    snf_liters = _sql.Column(LedgerNumber(14, 3), default=0)
+
+
+class ArchivePartition(_database.Base):
+    """Which ledgers have archived rows for which years, and how many."""
+
+    __tablename__ = "archive_partition"
+    ledger = _sql.Column(_sql.String, primary_key=True)
+    year = _sql.Column(_sql.Integer, primary_key=True)
+    rows = _sql.Column(_sql.Integer, default=0)
+
+
+ARCHIVED_LEDGERS = (Milk, Sale, Purchase)
+
+
+def archive_schema(year: int):
+    """Where a year's archived rows live: an attached SQLite file of that
+    name, or a schema on PostgreSQL."""
+    return f"archive_{year}"
+
+
+@_functools.lru_cache(maxsize=None)
+def archive_table(model, year: int):
+    """The table holding ``model``'s archived rows for ``year``.
+
+    Same columns and types as the hot table, without its foreign keys (the
+    customers stay in the main database) and with only the date index.
+    """
+    table = model.__table__
+    return _sql.Table(
+        table.name,
+        _sql.MetaData(),
+        *[_sql.Column(column.name, column.type, primary_key=column.primary_key) for column in table.columns],
+        _sql.Index(f"ix_{table.name}_date_created", "date_created"),
+        schema=archive_schema(year),
+    )
+
+
+    #----------------------------Sync------------------------------
+class SyncTombstone(_database.Base):
+    """A deleted customer or milk row, so that terminals syncing deltas can
+    drop their copy. ``kind`` is "customers" or "milks". Kept for
+    ``sync_tombstone_days``."""
+
+    __tablename__ = "sync_tombstone"
+    id = _sql.Column(_sql.Integer, primary_key=True)
+    kind = _sql.Column(_sql.String, nullable=False)
+    row_id = _sql.Column(_sql.Integer, nullable=False)
+    date_deleted = _sql.Column(_sql.DateTime, nullable=False, default=_dt.datetime.utcnow)
+
+    __table_args__ = (_sql.Index("ix_sync_tombstone_date_deleted_id", "date_deleted", "id"),)
+
+
+class SyncPush(_database.Base):
+    """A batch of offline entries pushed by a terminal.
+
+    Keyed by the push's Idempotency-Key, with a digest of the batch and the
+    result sent back, so a retried push gets the same answer instead of
+    inserting the entries twice.
+    """
+
+    __tablename__ = "sync_push"
+    idempotency_key = _sql.Column(_sql.String, primary_key=True)
+    digest = _sql.Column(_sql.String, nullable=False)
+    result = _sql.Column(_sql.String, nullable=False)
+    date_created = _sql.Column(_sql.DateTime, default=_dt.datetime.utcnow)
+
+
+
+    #----------------------------Jobs------------------------------
+class Job(_database.Base):
+    """A report or export run in the background (see jobs.py).
+
+    ``params`` holds the validated parameters as JSON. ``status`` goes from
+    "queued" to "running" (``worker`` names the host:pid that claimed it)
+    and ends as "done", "failed" or "cancelled"; ``cancel_requested`` asks
+    the worker to stop a running job.
+    """
+
+    __tablename__ = "job"
+    id = _sql.Column(_sql.Integer, primary_key=True)
+    kind = _sql.Column(_sql.String, nullable=False)
+    params = _sql.Column(_sql.String, nullable=False)
+    status = _sql.Column(_sql.String, nullable=False, default="queued")
+    cancel_requested = _sql.Column(_sql.Boolean, nullable=False, default=False)
+    worker = _sql.Column(_sql.String)
+    error = _sql.Column(_sql.String)
+    result_size = _sql.Column(_sql.Integer)
+    date_created = _sql.Column(_sql.DateTime, default=_dt.datetime.utcnow)
+    date_started = _sql.Column(_sql.DateTime)
+    date_finished = _sql.Column(_sql.DateTime)
+
+    __table_args__ = (_sql.Index("ix_job_status_id", "status", "id"),)
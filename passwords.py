@@ -0,0 +1,133 @@
+"""Password hashing and verification off the event loop.
+
+A bcrypt call costs a few hundred milliseconds of CPU. Run inline in an
+async handler it stalls every other request, so hashes are handed to a
+bounded worker pool instead. At most ``password_workers`` run at once, at
+most ``password_queue_limit`` more wait for a worker, and anything beyond
+that is refused with a 503 so a login burst cannot queue without limit.
+"""
+import asyncio
+import concurrent.futures as _futures
+import time
+
+import fastapi as _fastapi
+import passlib.hash as _hash
+
+import config as _config, instrumentation as _instrumentation
+
+
+def _timed(function, *args):
+    return time.monotonic(), function(*args)
+
+
+def _hash_password(password: str):
+    return _hash.bcrypt.hash(password)
+
+
+def _verify_password(password: str, hashed_password: str):
+    return _hash.bcrypt.verify(password, hashed_password)
+
+
+class PasswordPool:
+    """A capped executor for bcrypt work that keeps queueing metrics."""
+
+    def __init__(self, kind: str, workers: int, queue_limit: int):
+        self.kind = kind
+        self.workers = workers
+        self.queue_limit = queue_limit
+        self._executor = None
+        self.in_flight = 0
+        self.completed = 0
+        self.rejected = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.work_seconds = 0.0
+
+    def _get_executor(self):
+        if self._executor is None:
+            if self.kind == "process":
+                self._executor = _futures.ProcessPoolExecutor(max_workers=self.workers)
+            else:
+                self._executor = _futures.ThreadPoolExecutor(
+                    max_workers=self.workers, thread_name_prefix="passwords"
+                )
+        return self._executor
+
+    async def _run(self, function, *args):
+        if self.in_flight >= self.workers + self.queue_limit:
+            self.rejected += 1
+            raise _fastapi.HTTPException(
+                status_code=503,
+                detail="Too many logins in progress, try again shortly",
+                headers={"Retry-After": "1"},
+            )
+
+        self.in_flight += 1
+        submitted = time.monotonic()
+        try:
+            started, result = await asyncio.get_running_loop().run_in_executor(
+                self._get_executor(), _timed, function, *args
+            )
+        finally:
+            self.in_flight -= 1
+        finished = time.monotonic()
+        _instrumentation.record("password", finished - submitted)
+
+        waited = max(started - submitted, 0.0)
+        self.completed += 1
+        self.wait_seconds += waited
+        self.max_wait_seconds = max(self.max_wait_seconds, waited)
+        self.work_seconds += finished - started
+        return result
+
+    async def hash(self, password: str):
+        return await self._run(_hash_password, password)
+
+    async def verify(self, password: str, hashed_password: str):
+        return await self._run(_verify_password, password, hashed_password)
+
+    def metrics(self):
+        return {
+            "pool": self.kind,
+            "workers": self.workers,
+            "queue_limit": self.queue_limit,
+            "in_flight": self.in_flight,
+            "queued": max(self.in_flight - self.workers, 0),
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "avg_wait_ms": round(1000 * self.wait_seconds / self.completed, 3) if self.completed else 0.0,
+            "max_wait_ms": round(1000 * self.max_wait_seconds, 3),
+            "avg_work_ms": round(1000 * self.work_seconds / self.completed, 3) if self.completed else 0.0,
+        }
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+
+pool = PasswordPool(
+    _config.settings.password_pool,
+    _config.settings.password_workers,
+    _config.settings.password_queue_limit,
+)
+
+
+@_instrumentation.metrics.collector
+def _pool_metrics():
+    return [
+        ("dairy_password_workers", "gauge", "Password hashing workers.", pool.workers),
+        ("dairy_password_in_flight", "gauge", "Hashes running or queued.", pool.in_flight),
+        ("dairy_password_completed_total", "counter", "Hashes completed.", pool.completed),
+        ("dairy_password_rejected_total", "counter", "Hashes refused with a 503.", pool.rejected),
+        ("dairy_password_wait_seconds_total", "counter", "Time hashes waited for a worker.", pool.wait_seconds),
+        ("dairy_password_work_seconds_total", "counter", "Time spent hashing.", pool.work_seconds),
+    ]
+
+
+async def hash_password(password: str):
+    return await pool.hash(password)
+
+
+async def verify_password(password: str, hashed_password: str):
+    return await pool.verify(password, hashed_password)
@@ -0,0 +1,254 @@
+"""Query-plan audit for the service layer.
+
+Runs every service function against a scratch SQLite database while an
+engine hook asks SQLite for the ``EXPLAIN QUERY PLAN`` of each statement. A
+statement that scans a whole ledger table fails the audit, unless it is
+marked with the ``full_scan`` execution option (exports read whole tables on
+purpose) or is a ``LIMIT`` query that walks an index or the primary key in
+order, which stops after one page.
+
+    python manage.py audit-queries
+"""
+import asyncio
+import datetime as _dt
+import json
+import os
+import re
+import tempfile
+
+import sqlalchemy as _sql
+import sqlalchemy.ext.asyncio as _asyncio
+
+import config as _config, database as _database, schemas as _schemas, services as _services
+
+LEDGER_TABLES = {"milk", "sale", "purchase", "expense"}
+
+_SCAN = re.compile(r"^SCAN (\w+)")
+
+
+class QueryPlanAudit:
+    """Collect the plans of statements run on an engine and flag full scans."""
+
+    def __init__(self, engine, tables=LEDGER_TABLES):
+        self.engine = engine
+        self.tables = tables
+        self.statements = 0
+        self.findings = []
+
+    def __enter__(self):
+        _sql.event.listen(self.engine, "before_cursor_execute", self._explain)
+        return self
+
+    def __exit__(self, *exc_info):
+        _sql.event.remove(self.engine, "before_cursor_execute", self._explain)
+
+    def _explain(self, conn, cursor, statement, parameters, context, executemany):
+        if not statement.lstrip().upper().startswith(("SELECT", "UPDATE", "DELETE", "INSERT")):
+            return
+        if context is not None and context.execution_options.get("full_scan"):
+            return
+        if executemany:
+            parameters = parameters[0] if parameters else ()
+
+        explain = conn.connection.cursor()
+        try:
+            explain.execute("EXPLAIN QUERY PLAN " + statement, parameters)
+            plan = [row[3] for row in explain.fetchall()]
+        finally:
+            explain.close()
+        self.statements += 1
+
+        scans = [
+            detail
+            for detail in plan
+            if _SCAN.match(detail) and _SCAN.match(detail).group(1) in self.tables
+        ]
+        bounded = " LIMIT " in statement and not any("TEMP B-TREE" in detail for detail in plan)
+        if scans and not bounded:
+            self.findings.append((statement, plan))
+
+
+async def _exercise(db: _asyncio.AsyncSession):
+    """Call each service the way the routes do, with realistic arguments."""
+    today = _dt.date.today()
+    period = _schemas.ReportPeriod(date_from=today - _dt.timedelta(days=30), date_to=today)
+    first_page = _schemas.PageParams(limit=10)
+    next_page = _schemas.PageParams(cursor=_services.encode_cursor(1), limit=10)
+
+    customer = await _services.create_customer(
+        db,
+        _schemas.CustomerCreate(name="Audit", mobile="0", email="audit@example.com", pan="-", address="-"),
+    )
+    milk_in = _schemas.MilkCreate(
+        customer_id=customer.id,
+        customer_name=customer.name,
+        milk_type="Cow",
+        lit="10",
+        fat="4.1",
+        snf="8.5",
+        amount="300",
+        is_paid="No",
+    )
+    milk = await _services.create_milk(db, milk_in)
+    await _services.create_milks_bulk(db, [milk_in.dict()] * 3)
+    ledger = dict(customername=customer.name, milk_type="Cow", lit="5", amount="200", is_paid="No")
+    sale = await _services.create_sale(db, _schemas.SaleCreate(**ledger))
+    purchase = await _services.create_purchase(db, _schemas.PurchaseCreate(**ledger))
+    expense = await _services.create_expense(db, _schemas.ExpenseCreate(remark="Feed", amount="50"))
+
+    for page in (first_page, next_page):
+        await _services.get_customers(db, page)
+        await _services.get_customers_with_milks(db, page, since=period.date_from)
+        for filters in (
+            _schemas.MilkFilter(),
+            _schemas.MilkFilter(customer_id=customer.id),
+            _schemas.MilkFilter(customer_id=customer.id, **period.dict()),
+            _schemas.MilkFilter(is_paid="No", **period.dict()),
+            _schemas.MilkFilter(**period.dict()),
+        ):
+            await _services.get_milks(db, page, filters)
+        for filters in (
+            _schemas.SaleFilter(),
+            _schemas.SaleFilter(customername=customer.name),
+            _schemas.SaleFilter(**period.dict()),
+        ):
+            await _services.get_sales(db, page, filters)
+            await _services.get_purchases(db, page, _schemas.PurchaseFilter(**filters.dict()))
+        await _services.get_expenses(db, page, _schemas.ExpenseFilter(**period.dict()))
+
+    await _services.get_customer(customer.id, db)
+    for text in ("Aud", "au 0"):
+        await _services.search_customers(db, text)
+    await _services.get_milk(milk.id, db)
+    await _services.get_sale(sale.id, db)
+    await _services.get_purchase(purchase.id, db)
+    await _services.get_expense(expense.id, db)
+    await _services.update_customer(customer.id, _schemas.CustomerCreate(**customer.dict()), db)
+    await _services.update_milk(milk.id, _schemas.MilkCreate(**dict(milk_in.dict(), is_paid="Yes")), db)
+    await _services.update_customer(customer.id, _schemas.CustomerUpdate(mobile="1"), db)
+    await _services.update_milk(milk.id, _schemas.MilkUpdate(is_paid="No"), db)
+    await _services.update_sale(sale.id, _schemas.SaleUpdate(is_paid="Yes"), db)
+    await _services.update_purchase(purchase.id, _schemas.PurchaseUpdate(amount="150"), db)
+    await _services.update_expense(expense.id, _schemas.ExpenseUpdate(remark="Diesel"), db)
+
+    for key in ("audit", "audit"):
+        await _services.settle_milks(
+            db, _schemas.MilkSettlementCreate(customer_id=customer.id, **period.dict()), key
+        )
+    settlement = _schemas.LedgerSettlementCreate(customername=customer.name, milk_type="Cow", **period.dict())
+    await _services.settle_sales(db, settlement)
+    await _services.settle_purchases(db, settlement)
+    for page in (first_page, next_page):
+        await _services.get_settlements(db, page)
+
+    groups = list(_schemas.ReportGroup)
+    for group_by in [[group] for group in groups] + [groups]:
+        await _services.get_milk_report(db, group_by, _schemas.MilkFilter(**period.dict()))
+    await _services.get_milk_report(db, groups[:1], _schemas.MilkFilter(customer_id=customer.id))
+    await _services.get_sale_report(db, groups, _schemas.SaleFilter(**period.dict()))
+    await _services.get_purchase_report(db, groups, _schemas.PurchaseFilter(**period.dict()))
+    await _services.get_dues(db, period)
+    await _services.get_profit_loss(db, period)
+
+    for fmt in _services.EXPORT_MEDIA_TYPES:
+        for chunks in (
+            _services.export_customers(db, fmt),
+            _services.export_milks(db, fmt, _schemas.MilkFilter()),
+            _services.export_sales(db, fmt, _schemas.SaleFilter()),
+            _services.export_purchases(db, fmt, _schemas.PurchaseFilter()),
+            _services.export_expenses(db, fmt, _schemas.ExpenseFilter()),
+        ):
+            async for _ in chunks:
+                pass
+
+    await _services.rebuild_milk_rollups(db, chunk_size=2)
+
+    await _services.delete_milk(milk.id, db)
+    await _services.delete_sale(sale.id, db)
+    await _services.delete_purchase(purchase.id, db)
+    await _services.delete_expense(expense.id, db)
+
+    pushed = [dict(milk_in.dict(), date_created="2024-01-01T06:30:00+05:30"), milk_in.dict()]
+    for key in ("audit", "audit"):
+        await _services.push_milks(db, pushed, key)
+    changes = json.loads(await _services.get_sync_changes(db, limit=2))
+    await _services.get_sync_changes(db, token=changes["token"], limit=2)
+    await _services.get_sync_changes(db, since=period.date_from, limit=2)
+
+    milk = await _services.create_milk(db, _schemas.MilkCreate(**dict(milk_in.dict(), is_paid="Yes")))
+    sale = await _services.create_sale(db, _schemas.SaleCreate(**dict(ledger, is_paid="Yes")))
+    purchase = await _services.create_purchase(db, _schemas.PurchaseCreate(**dict(ledger, is_paid="Yes")))
+    await _services.archive_ledgers(db, before=today + _dt.timedelta(days=1), chunk_size=2)
+    for page in (first_page, next_page):
+        await _services.get_milks(db, page, _schemas.MilkFilter(**period.dict()), include_archived=True)
+        await _services.get_sales(db, page, _schemas.SaleFilter(), include_archived=True)
+        await _services.get_purchases(db, page, _schemas.PurchaseFilter(), include_archived=True)
+    await _services.get_milk(milk.id, db, include_archived=True)
+    await _services.get_sale(sale.id, db, include_archived=True)
+    await _services.get_purchase(purchase.id, db, include_archived=True)
+    await _services.get_milk_report(db, groups, _schemas.MilkFilter(**period.dict()))
+    await _services.get_sale_report(db, groups, _schemas.SaleFilter(**period.dict()))
+    await _services.get_purchase_report(db, groups[:1], _schemas.PurchaseFilter(is_paid="Yes", **period.dict()))
+    await _services.get_profit_loss(db, period)
+    async for _ in _services.export_milks(db, "csv", _schemas.MilkFilter(), include_archived=True):
+        pass
+    await _services.rebuild_milk_rollups(db, chunk_size=2)
+
+    for kind, params in [
+        ("milk-report", dict(group_by=["day"], **period.dict())),
+        ("dues", period.dict()),
+        ("sale-export", dict(format="csv", include_archived=True)),
+        ("profit-loss", {}),
+    ]:
+        job = await _services.create_job(db, _schemas.JobCreate(kind=kind, params=params))
+    await _services.cancel_job(db, job.id)
+    for job_id in await _services.claim_jobs(db, 4, "audit:0"):
+        await _services.run_job(db, job_id)
+        await _services.get_job(db, job_id)
+        await _services.get_job_result(db, job_id)
+    job = await _services.create_job(db, _schemas.JobCreate(kind="expense-export"))
+    await _services.claim_jobs(db, 1, "audit:0")
+    await _services.cancel_job(db, job.id)
+    for job_id in await _services.cancel_requested_jobs(db, [job.id]):
+        await _services.finish_job(db, job_id, "cancelled")
+    await _services.recover_jobs(db, lambda worker: False)
+    await _services.prune_jobs(db)
+
+    await _services.delete_customer(customer.id, db)
+
+
+async def _run(url: str):
+    engine = _asyncio.create_async_engine(url)
+    _database.use_sqlite_profile(engine.sync_engine)
+    try:
+        async with engine.begin() as connection:
+            await connection.run_sync(_database.Base.metadata.create_all)
+        with QueryPlanAudit(engine.sync_engine) as audit:
+            async with _asyncio.AsyncSession(engine, autoflush=False, expire_on_commit=False) as db:
+                await _exercise(db)
+    finally:
+        await engine.dispose()
+    return audit
+
+
+def run():
+    """Audit the services against a scratch database and return the audit."""
+    archive_dir, job_dir = _config.settings.archive_dir, _config.settings.job_dir
+    with tempfile.TemporaryDirectory() as directory:
+        # The archives and job results go next to the scratch database.
+        _config.settings.archive_dir = os.path.join(directory, "archive")
+        _config.settings.job_dir = os.path.join(directory, "job-results")
+        try:
+            return asyncio.run(_run(f"sqlite+aiosqlite:///{os.path.join(directory, 'audit.db')}"))
+        finally:
+            _config.settings.archive_dir, _config.settings.job_dir = archive_dir, job_dir
+
+
+def report(audit: QueryPlanAudit):
+    for statement, plan in audit.findings:
+        print(" ".join(statement.split()))
+        for detail in plan:
+            print(f"    {detail}")
+        print()
+    print(f"{audit.statements} statements explained, {len(audit.findings)} full ledger scans")
+    return not audit.findings
@@ -0,0 +1,246 @@
+"""Milk pricing from a fat x SNF rate chart.
+
+The chart is a JSON file (``DAIRY_RATE_CHART``) with one table per milk
+type, each giving the rate per liter at some fat and SNF readings::
+
+    {
+      "version": "2024-04",
+      "step": "0.1",
+      "milk_types": {
+        "Cow": {
+          "fat": ["3.0", "4.0", "5.0"],
+          "snf": ["8.0", "8.5", "9.0"],
+          "rates": [["38.00", "39.50", "41.00"],
+                    ["42.00", "43.50", "45.00"],
+                    ["46.00", "47.50", "49.00"]]
+        }
+      }
+    }
+
+``rates[i][j]`` is the rate at ``fat[i]`` and ``snf[j]``; the readings
+must lie on multiples of ``step`` (default 0.1) and increase. On loading,
+each table is filled in to every ``step`` of fat and SNF between its
+first and last readings by bilinear interpolation and kept as a flat
+array of rates in paise, so pricing an entry is two roundings and an
+index, however sparse the chart. Readings between steps are rounded to
+the nearest one; readings outside the table are refused rather than
+guessed. ``version`` defaults to a digest of the file.
+
+The file is reloaded when it changes, checked at most every
+``rate_chart_check_seconds``; a chart that fails to load is logged and the
+one before it stays in use.
+"""
+import array
+import bisect
+import datetime as _dt
+import decimal as _decimal
+import hashlib
+import json
+import logging
+import os
+import time
+
+import config as _config, instrumentation as _instrumentation
+
+logger = logging.getLogger("dairy.rates")
+
+_PAISE = _decimal.Decimal("0.01")
+_HALF_UP = _decimal.ROUND_HALF_UP
+_UNKNOWN = object()
+
+
+class RateTable:
+    """One milk type's rates, dense over fat and SNF."""
+
+    def __init__(self, milk_type: str, fat, snf, rates, step: _decimal.Decimal):
+        fat = [_decimal.Decimal(value) for value in fat]
+        snf = [_decimal.Decimal(value) for value in snf]
+        rates = [[_decimal.Decimal(rate) for rate in row] for row in rates]
+        if not fat or not snf:
+            raise ValueError(f"{milk_type}: fat and snf need at least one reading each")
+        if len(rates) != len(fat) or any(len(row) != len(snf) for row in rates):
+            raise ValueError(f"{milk_type}: rates must have a row per fat reading and a column per snf reading")
+        for name, readings in (("fat", fat), ("snf", snf)):
+            if any(low >= high for low, high in zip(readings, readings[1:])):
+                raise ValueError(f"{milk_type}: {name} readings must increase")
+            if any(reading % step for reading in readings):
+                raise ValueError(f"{milk_type}: {name} readings must be multiples of {step}")
+
+        self.milk_type = milk_type
+        self.step = step
+        self.fat_min, self.fat_max = fat[0], fat[-1]
+        self.snf_min, self.snf_max = snf[0], snf[-1]
+        self.fat_steps = int((self.fat_max - self.fat_min) / step) + 1
+        self.snf_steps = int((self.snf_max - self.snf_min) / step) + 1
+        # Row-major by fat, in paise.
+        self.rates = array.array("q", bytes(8 * self.fat_steps * self.snf_steps))
+        for i in range(self.fat_steps):
+            fat_weights = _weights(fat, self.fat_min + i * step)
+            for j in range(self.snf_steps):
+                snf_weights = _weights(snf, self.snf_min + j * step)
+                rate = sum(
+                    fat_weight * snf_weight * rates[row][column]
+                    for row, fat_weight in fat_weights
+                    for column, snf_weight in snf_weights
+                )
+                self.rates[i * self.snf_steps + j] = int(rate.quantize(_PAISE, _HALF_UP) * 100)
+
+    def _reading(self, name: str, value):
+        if value is None or value == "":
+            raise ValueError(f"{name} is needed to price {self.milk_type} milk")
+        try:
+            return _decimal.Decimal(value)
+        except _decimal.InvalidOperation:
+            raise ValueError(f"{name} is not a number")
+
+    def _position(self, name: str, value, low: _decimal.Decimal, steps: int):
+        position = int(((self._reading(name, value) - low) / self.step).to_integral_value(_HALF_UP))
+        if not 0 <= position < steps:
+            high = low + (steps - 1) * self.step
+            raise ValueError(f"{name} {value} is outside the {self.milk_type} rate chart ({low}-{high})")
+        return position
+
+    def rate(self, fat, snf):
+        """The rate per liter, in paise, at these readings."""
+        i = self._position("fat", fat, self.fat_min, self.fat_steps)
+        j = self._position("snf", snf, self.snf_min, self.snf_steps)
+        return self.rates[i * self.snf_steps + j]
+
+    def amount(self, lit, fat, snf):
+        """What ``lit`` liters at these readings cost, to the paisa."""
+        rate = self.rate(fat, snf)
+        return (self._reading("lit", lit) * rate / 100).quantize(_PAISE, _HALF_UP)
+
+
+def _weights(readings, value):
+    """The table rows ``value`` lies between, with their interpolation weights."""
+    upper = bisect.bisect_left(readings, value)
+    if readings[upper] == value:
+        return [(upper, _decimal.Decimal(1))]
+    lower = upper - 1
+    share = (value - readings[lower]) / (readings[upper] - readings[lower])
+    return [(lower, 1 - share), (upper, share)]
+
+
+class RateChart:
+    """The rate tables of every milk type the chart covers."""
+
+    def __init__(self, tables: dict, version: str):
+        self.tables = tables
+        self.version = version
+        self.date_loaded = _dt.datetime.utcnow()
+
+    @classmethod
+    def parse(cls, content: bytes):
+        chart = json.loads(content)
+        step = _decimal.Decimal(str(chart.get("step", "0.1")))
+        if step <= 0:
+            raise ValueError("step must be positive")
+        tables = {
+            milk_type: RateTable(milk_type, table["fat"], table["snf"], table["rates"], step)
+            for milk_type, table in chart["milk_types"].items()
+        }
+        version = str(chart.get("version") or hashlib.blake2b(content, digest_size=8).hexdigest())
+        return cls(tables, version)
+
+    def amount(self, milk: dict):
+        """The amount for one milk entry (a dict with milk_type, lit, fat and
+        snf), or None if the chart does not cover its milk type. Raises
+        ValueError when the entry cannot be priced."""
+        table = self.tables.get(milk["milk_type"])
+        if table is None:
+            return None
+        return table.amount(milk["lit"], milk["fat"], milk["snf"])
+
+    def amounts(self, milks):
+        """``amount`` for a batch of entries, with the ValueError in place of
+        the amount for those that cannot be priced.
+
+        A batch repeats the same few readings, so each milk type, fat and SNF
+        is looked up once and the rest is a multiplication per entry.
+        """
+        tables = self.tables
+        rates = {}
+        results = []
+        append = results.append
+        for milk in milks:
+            key = (milk["milk_type"], milk["fat"], milk["snf"])
+            rate = rates.get(key, _UNKNOWN)
+            if rate is _UNKNOWN:
+                table = tables.get(key[0])
+                try:
+                    rate = None if table is None else table.rate(key[1], key[2])
+                except ValueError as error:
+                    rate = error
+                rates[key] = rate
+            if rate is None or isinstance(rate, ValueError):
+                append(rate)
+                continue
+            lit = milk["lit"]
+            try:
+                append((_decimal.Decimal(lit) * rate / 100).quantize(_PAISE, _HALF_UP))
+            except (TypeError, _decimal.InvalidOperation):
+                append(ValueError(f"lit is needed to price {key[0]} milk" if lit in (None, "") else "lit is not a number"))
+        return results
+
+
+class RateChartFile:
+    """The chart in ``path``, reloaded when the file changes."""
+
+    def __init__(self, path: str, check_seconds: float):
+        self.path = path
+        self.check_seconds = check_seconds
+        self.chart = None
+        self.reloads = 0
+        self.failures = 0
+        self._stamp = None
+        self._checked = None
+
+    def current(self):
+        """The chart in use, or None while there is no chart file."""
+        now = time.monotonic()
+        if self._checked is None or now - self._checked >= self.check_seconds:
+            self._checked = now
+            self._reload()
+        return self.chart
+
+    def _reload(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            if self.chart is not None:
+                logger.warning("rate chart %s removed; amounts are taken as sent", self.path)
+            self.chart, self._stamp = None, None
+            return
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        if stamp == self._stamp:
+            return
+        self._stamp = stamp
+        try:
+            with open(self.path, "rb") as chart_file:
+                chart = RateChart.parse(chart_file.read())
+        except (OSError, ValueError, KeyError, TypeError, ArithmeticError) as error:
+            self.failures += 1
+            logger.error(
+                "rate chart %s not loaded (%s: %s); still using %s",
+                self.path,
+                type(error).__name__,
+                error,
+                f"version {self.chart.version}" if self.chart else "the amounts sent",
+            )
+            return
+        self.chart = chart
+        self.reloads += 1
+        logger.info("rate chart %s loaded, version %s", self.path, chart.version)
+
+
+charts = RateChartFile(_config.settings.rate_chart, _config.settings.rate_chart_check_seconds)
+
+
+@_instrumentation.metrics.collector
+def _chart_metrics():
+    return [
+        ("dairy_rate_chart_loaded", "gauge", "Whether a rate chart is in use.", int(charts.chart is not None)),
+        ("dairy_rate_chart_reloads_total", "counter", "Rate chart files loaded.", charts.reloads),
+        ("dairy_rate_chart_failures_total", "counter", "Rate chart files that failed to load.", charts.failures),
+    ]
@@ -1,8 +1,86 @@
 import datetime as _dt
+import decimal as _decimal
+import enum as _enum
+import json as _json
+from typing import Any, Dict, List, Optional
 
 import pydantic as _pydantic
 
 
+def format_number(value: _decimal.Decimal):
+    return format(value.normalize(), "f")
+
+
+def format_paid(value: bool):
+    return "Yes" if value else "No"
+
+
+def _none_to_blank(value):
+    return "" if value is None else value
+
+
+def _reject_null(value):
+    # In a sparse update a field left out is kept, so an explicit null
+    # cannot also mean "keep"; only the number fields have a blank.
+    if value is None:
+        raise ValueError("field may be left out but not null")
+    return value
+
+
+class Number(str):
+    """A decimal quantity carried as a string on the wire.
+
+    The ledger columns are numeric, so anything that is not a number (or
+    blank) is rejected here instead of failing inside the database.
+    """
+
+    @classmethod
+    def __get_validators__(cls):
+        yield cls.validate
+
+    @classmethod
+    def validate(cls, value):
+        if value is None:
+            return ""
+        if isinstance(value, _decimal.Decimal):
+            return format_number(value)
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            value = str(value)
+        if not isinstance(value, str):
+            raise TypeError("string required")
+
+        value = value.strip()
+        if value:
+            try:
+                if not _decimal.Decimal(value).is_finite():
+                    raise ValueError("value is not a valid number")
+            except _decimal.InvalidOperation:
+                raise ValueError("value is not a valid number")
+        return value
+
+
+class YesNo(str):
+    """The "Yes"/"No" paid flag as it appears on the wire."""
+
+    @classmethod
+    def __get_validators__(cls):
+        yield cls.validate
+
+    @classmethod
+    def validate(cls, value):
+        if isinstance(value, bool):
+            return format_paid(value)
+        if not isinstance(value, str):
+            raise TypeError("string required")
+
+        flag = value.strip().lower()
+        if flag in ("yes", "true", "1"):
+            return "Yes"
+        if flag in ("no", "false", "0", ""):
+            return "No"
+        raise ValueError("value must be Yes or No")
+
+
 class _UserBase(_pydantic.BaseModel):
     email: str
 
@@ -21,6 +99,11 @@ class User(_UserBase):
         orm_mode = True
 
 
+class TokenClaims(User):
+    jti: str
+    exp: int
+
+
 class _CustomerBase(_pydantic.BaseModel):
     name: str
     mobile: str
@@ -32,6 +115,18 @@ class CustomerCreate(_CustomerBase):
     pass
 
 
+class CustomerUpdate(_pydantic.BaseModel):
+    name: Optional[str] = None
+    mobile: Optional[str] = None
+    email: Optional[str] = None
+    pan: Optional[str] = None
+    address: Optional[str] = None
+
+    _required = _pydantic.validator(
+        "name", "mobile", "email", "pan", "address", pre=True, allow_reuse=True
+    )(_reject_null)
+
+
 class Customer(_CustomerBase):
     id: int
     date_created: _dt.datetime
@@ -45,37 +140,97 @@ class _MilkBase(_pydantic.BaseModel):
     customer_id: int
     customer_name: str
     milk_type: str
-    lit: str
-    fat: str
-    snf: str
-    amount: str
-    is_paid: str
+    lit: Number
+    fat: Number
+    snf: Number
+    amount: Number
+    is_paid: YesNo
+
+    _blank_numbers = _pydantic.validator(
+        "lit", "fat", "snf", "amount", pre=True, allow_reuse=True
+    )(_none_to_blank)
 
 
 class MilkCreate(_MilkBase):
-    pass
+    # Computed by the server for milk types the rate chart covers.
+    amount: Number = ""
+
+
+class MilkUpdate(_pydantic.BaseModel):
+    customer_id: Optional[int] = None
+    customer_name: Optional[str] = None
+    milk_type: Optional[str] = None
+    lit: Optional[Number] = None
+    fat: Optional[Number] = None
+    snf: Optional[Number] = None
+    amount: Optional[Number] = None
+    is_paid: Optional[YesNo] = None
+
+    _blank_numbers = _pydantic.validator(
+        "lit", "fat", "snf", "amount", pre=True, allow_reuse=True
+    )(_none_to_blank)
+    _required = _pydantic.validator(
+        "customer_id", "customer_name", "milk_type", "is_paid", pre=True, allow_reuse=True
+    )(_reject_null)
 
 
 class Milk(_MilkBase):
+    # None once the customer has been deleted.
+    customer_id: Optional[int]
     id: int
     date_created: _dt.datetime
     date_last_updated: _dt.datetime
 
     class Config:
         orm_mode = True
+
+
+class CustomerWithMilks(Customer):
+    milks: List[Milk]
+
+
+class BulkRowError(_pydantic.BaseModel):
+    index: int
+    errors: List[Dict[str, Any]]
+
+
+class BulkResult(_pydantic.BaseModel):
+    inserted: int
+    failed: int
+    ids: List[Optional[int]]
+    errors: List[BulkRowError]
 #-------------------------------------------------SALES
 class _SaleBase(_pydantic.BaseModel):
     customername: str
     milk_type: str
-    lit: str
-    amount: str
-    is_paid: str
+    lit: Number
+    amount: Number
+    is_paid: YesNo
+
+    _blank_numbers = _pydantic.validator(
+        "lit", "amount", pre=True, allow_reuse=True
+    )(_none_to_blank)
 
 
 class SaleCreate(_SaleBase):
     pass
 
 
+class SaleUpdate(_pydantic.BaseModel):
+    customername: Optional[str] = None
+    milk_type: Optional[str] = None
+    lit: Optional[Number] = None
+    amount: Optional[Number] = None
+    is_paid: Optional[YesNo] = None
+
+    _blank_numbers = _pydantic.validator(
+        "lit", "amount", pre=True, allow_reuse=True
+    )(_none_to_blank)
+    _required = _pydantic.validator(
+        "customername", "milk_type", "is_paid", pre=True, allow_reuse=True
+    )(_reject_null)
+
+
 class Sale(_SaleBase):
     id: int
     date_created: _dt.datetime
@@ -88,15 +243,34 @@ class Sale(_SaleBase):
 class _PurchaseBase(_pydantic.BaseModel):
     customername: str
     milk_type: str
-    lit: str
-    amount: str
-    is_paid: str
+    lit: Number
+    amount: Number
+    is_paid: YesNo
+
+    _blank_numbers = _pydantic.validator(
+        "lit", "amount", pre=True, allow_reuse=True
+    )(_none_to_blank)
 
 
 class PurchaseCreate(_PurchaseBase):
     pass
 
 
+class PurchaseUpdate(_pydantic.BaseModel):
+    customername: Optional[str] = None
+    milk_type: Optional[str] = None
+    lit: Optional[Number] = None
+    amount: Optional[Number] = None
+    is_paid: Optional[YesNo] = None
+
+    _blank_numbers = _pydantic.validator(
+        "lit", "amount", pre=True, allow_reuse=True
+    )(_none_to_blank)
+    _required = _pydantic.validator(
+        "customername", "milk_type", "is_paid", pre=True, allow_reuse=True
+    )(_reject_null)
+
+
 class Purchase(_PurchaseBase):
     id: int
     date_created: _dt.datetime
@@ -108,19 +282,293 @@ class Purchase(_PurchaseBase):
 #-----------------------------Expense--------------------------------
 class _ExpenseBase(_pydantic.BaseModel):
     remark: str
-    amount: str
-    
-    
+    amount: Number
+
+    _blank_numbers = _pydantic.validator(
+        "amount", pre=True, allow_reuse=True
+    )(_none_to_blank)
 
 
 class ExpenseCreate(_ExpenseBase):
     pass
 
 
+class ExpenseUpdate(_pydantic.BaseModel):
+    remark: Optional[str] = None
+    amount: Optional[Number] = None
+
+    _blank_numbers = _pydantic.validator(
+        "amount", pre=True, allow_reuse=True
+    )(_none_to_blank)
+    _required = _pydantic.validator("remark", pre=True, allow_reuse=True)(_reject_null)
+
+
 class Expense(_ExpenseBase):
     id: int
     date_created: _dt.datetime
     date_last_updated: _dt.datetime
 
     class Config:
-        orm_mode = True
\ No newline at end of file
+        orm_mode = True
+
+
+#-----------------------------Settlements--------------------------------
+class _SettlementBase(_pydantic.BaseModel):
+    date_from: _dt.date
+    date_to: _dt.date
+    milk_type: Optional[str] = None
+
+    @_pydantic.validator("date_to")
+    def _period_order(cls, value, values):
+        if "date_from" in values and value < values["date_from"]:
+            raise ValueError("date_to is before date_from")
+        return value
+
+
+class MilkSettlementCreate(_SettlementBase):
+    customer_id: int
+
+
+class LedgerSettlementCreate(_SettlementBase):
+    customername: str
+
+
+class Settlement(_pydantic.BaseModel):
+    id: int
+    ledger: str
+    idempotency_key: Optional[str] = None
+    customer_id: Optional[int] = None
+    customername: Optional[str] = None
+    milk_type: Optional[str] = None
+    date_from: _dt.date
+    date_to: _dt.date
+    entries: int
+    liters: Number
+    amount: Number
+    date_created: _dt.datetime
+
+    class Config:
+        orm_mode = True
+
+
+#-----------------------------Listing--------------------------------
+class PageParams(_pydantic.BaseModel):
+    cursor: Optional[str] = None
+    limit: int
+
+
+class _DateRangeFilter(_pydantic.BaseModel):
+    date_from: Optional[_dt.date] = None
+    date_to: Optional[_dt.date] = None
+
+
+class ExpenseFilter(_DateRangeFilter):
+    pass
+
+
+class _LedgerFilter(_DateRangeFilter):
+    is_paid: Optional[YesNo] = None
+    milk_type: Optional[str] = None
+
+
+class MilkFilter(_LedgerFilter):
+    customer_id: Optional[int] = None
+
+
+class SaleFilter(_LedgerFilter):
+    customername: Optional[str] = None
+
+
+class PurchaseFilter(_LedgerFilter):
+    customername: Optional[str] = None
+
+
+class ReportPeriod(_DateRangeFilter):
+    pass
+
+
+#-----------------------------Reports--------------------------------
+class ReportGroup(str, _enum.Enum):
+    customer = "customer"
+    day = "day"
+    shift = "shift"
+    milk_type = "milk_type"
+
+
+class ReportRow(_pydantic.BaseModel):
+    customer_id: Optional[int] = None
+    customer_name: Optional[str] = None
+    day: Optional[_dt.date] = None
+    shift: Optional[str] = None
+    milk_type: Optional[str] = None
+    entries: int
+    liters: Optional[Number] = None
+    amount: Number
+    avg_fat: Optional[Number] = None
+    avg_snf: Optional[Number] = None
+
+    class Config:
+        orm_mode = True
+
+
+class Dues(_pydantic.BaseModel):
+    milks: List[ReportRow]
+    sales: List[ReportRow]
+    purchases: List[ReportRow]
+
+
+class ProfitLoss(_pydantic.BaseModel):
+    sales: Number
+    milks: Number
+    purchases: Number
+    expenses: Number
+    profit: Number
+
+    class Config:
+        orm_mode = True
+
+
+#-----------------------------Sync--------------------------------
+class MilkPush(MilkCreate):
+    """A milk entry recorded offline, with the time the terminal took it."""
+
+    date_created: Optional[_dt.datetime] = None
+
+    @_pydantic.validator("date_created")
+    def _to_utc(cls, value):
+        # Stored naive, in UTC, like every other timestamp.
+        if value is not None and value.tzinfo is not None:
+            value = value.astimezone(_dt.timezone.utc).replace(tzinfo=None)
+        return value
+
+
+class SyncRows(_pydantic.BaseModel):
+    """Changed rows, each a list of values in ``columns`` order."""
+
+    columns: List[str]
+    rows: List[List[Any]]
+
+
+class SyncDeleted(_pydantic.BaseModel):
+    customers: List[int]
+    milks: List[int]
+
+
+class SyncChanges(_pydantic.BaseModel):
+    token: str
+    more: bool
+    customers: SyncRows
+    milks: SyncRows
+    deleted: SyncDeleted
+
+
+#-----------------------------Rates--------------------------------
+class RateTable(_pydantic.BaseModel):
+    """The readings one milk type's rates cover."""
+
+    fat_min: Number
+    fat_max: Number
+    snf_min: Number
+    snf_max: Number
+    step: Number
+
+
+class RateChart(_pydantic.BaseModel):
+    version: str
+    date_loaded: _dt.datetime
+    milk_types: Dict[str, RateTable]
+
+
+#-----------------------------Jobs--------------------------------
+class JobKind(str, _enum.Enum):
+    milk_report = "milk-report"
+    sale_report = "sale-report"
+    purchase_report = "purchase-report"
+    dues = "dues"
+    profit_loss = "profit-loss"
+    customer_export = "customer-export"
+    milk_export = "milk-export"
+    sale_export = "sale-export"
+    purchase_export = "purchase-export"
+    expense_export = "expense-export"
+
+
+# The parameters of each kind of job: the query parameters of the
+# matching report or export route.
+class _JobParams(_pydantic.BaseModel):
+    class Config:
+        extra = _pydantic.Extra.forbid
+
+
+class _ReportJob(_JobParams):
+    group_by: List[ReportGroup] = [ReportGroup.customer]
+
+
+class MilkReportJob(_ReportJob, MilkFilter):
+    pass
+
+
+class SaleReportJob(_ReportJob, SaleFilter):
+    pass
+
+
+class PurchaseReportJob(_ReportJob, PurchaseFilter):
+    pass
+
+
+class PeriodJob(_JobParams, ReportPeriod):
+    pass
+
+
+class _ExportJob(_JobParams):
+    format: str = _pydantic.Field("ndjson", regex="^(ndjson|csv)$")
+
+
+class CustomerExportJob(_ExportJob):
+    pass
+
+
+class _LedgerExportJob(_ExportJob):
+    include_archived: bool = False
+
+
+class MilkExportJob(_LedgerExportJob, MilkFilter):
+    pass
+
+
+class SaleExportJob(_LedgerExportJob, SaleFilter):
+    pass
+
+
+class PurchaseExportJob(_LedgerExportJob, PurchaseFilter):
+    pass
+
+
+class ExpenseExportJob(_ExportJob, ExpenseFilter):
+    pass
+
+
+class JobCreate(_pydantic.BaseModel):
+    kind: JobKind
+    params: Dict[str, Any] = {}
+
+
+class Job(_pydantic.BaseModel):
+    id: int
+    kind: JobKind
+    params: Dict[str, Any]
+    status: str
+    cancel_requested: bool
+    error: Optional[str] = None
+    result_size: Optional[int] = None
+    date_created: _dt.datetime
+    date_started: Optional[_dt.datetime] = None
+    date_finished: Optional[_dt.datetime] = None
+
+    @_pydantic.validator("params", pre=True)
+    def _from_json(cls, value):
+        # Stored as JSON text.
+        return _json.loads(value) if isinstance(value, str) else value
+
+    class Config:
+        orm_mode = True
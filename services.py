@@ -1,84 +1,373 @@
+import base64 as _base64
+import binascii as _binascii
+import csv as _csv
+import decimal as _decimal
+import io as _io
+import functools as _functools
+import hashlib as _hashlib
+import json as _json
+import os as _os
+from typing import Optional
 import fastapi as _fastapi
 import fastapi.security as _security
-import jwt as _jwt
+import orjson as _orjson
 import datetime as _dt
-import sqlalchemy.orm as _orm
-import passlib.hash as _hash
+import pydantic as _pydantic
+import sqlalchemy as _sql
+import sqlalchemy.dialects.postgresql as _postgresql
+import sqlalchemy.dialects.sqlite as _sqlite
+import sqlalchemy.ext.asyncio as _asyncio
 
-import database as _database, models as _models, schemas as _schemas
+import cache as _cache, config as _config, database as _database, instrumentation as _instrumentation
+import models as _models, passwords as _passwords, rates as _rates
+import schemas as _schemas, tokens as _tokens
 
 oauth2schema = _security.OAuth2PasswordBearer(tokenUrl="/api/token")
 
-JWT_SECRET = "myjwtsecret"
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+DEFAULT_SEARCH_RESULTS = 10
+MAX_SEARCH_RESULTS = 50
+SEARCH_RANK_LIMIT = 500
+
+DEFAULT_MILKS_PER_CUSTOMER = 50
+MAX_MILKS_PER_CUSTOMER = 500
+
+BULK_BATCH_SIZE = 5000
+MAX_BULK_ROWS = 100_000
+
+ROLLUP_CHUNK_SIZE = 50_000
+ARCHIVE_CHUNK_SIZE = 10_000
+
+DEFAULT_SYNC_ROWS = 1000
+MAX_SYNC_ROWS = 5000
+
+EXPORT_BATCH_SIZE = 1000
+EXPORT_MEDIA_TYPES = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
 
 
 def create_database():
     return _database.Base.metadata.create_all(bind=_database.engine)
 
 
-def get_db():
-    db = _database.SessionLocal()
-    try:
+def _backend(db: _asyncio.AsyncSession):
+    return db.bind.dialect.name
+
+
+def _insert(db: _asyncio.AsyncSession, table):
+    """An INSERT that takes ``on_conflict_*`` clauses on the session's database."""
+    dialect = _postgresql if _backend(db) == "postgresql" else _sqlite
+    return dialect.insert(table)
+
+
+async def get_db():
+    async with _database.AsyncSessionLocal() as db:
         yield db
-    finally:
-        db.close()
 
 
-async def get_user_by_email(email: str, db: _orm.Session):
-    return db.query(_models.User).filter(_models.User.email == email).first()
+async def get_read_db():
+    """A session on the read-only engine, for routes that never write."""
+    async with _database.ReadSessionLocal() as db:
+        yield db
 
 
-async def create_user(user: _schemas.UserCreate, db: _orm.Session):
+async def get_page_params(
+    cursor: Optional[str] = None,
+    limit: int = _fastapi.Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+):
+    return _schemas.PageParams(cursor=cursor, limit=limit)
+
+
+def encode_cursor(last_id: int):
+    return _base64.urlsafe_b64encode(str(last_id).encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str):
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        return int(_base64.urlsafe_b64decode(padded).decode())
+    except (ValueError, UnicodeDecodeError, _binascii.Error):
+        raise _fastapi.HTTPException(status_code=400, detail="Invalid cursor")
+
+
+async def _paginate(db: _asyncio.AsyncSession, query, model, page: _schemas.PageParams, archived=()):
+    """Keyset pagination on the primary key.
+
+    Rows are read in id order starting just after the cursor, so every page
+    is a range seek on the primary key no matter how deep it is. One extra
+    row is fetched to know whether another page follows. ``archived`` holds
+    (query, table) pairs over archive tables, merged in by id.
+    """
+    if page.cursor:
+        after = decode_cursor(page.cursor)
+        query = query.filter(model.id > after)
+        archived = [(archive.filter(table.c.id > after), table) for archive, table in archived]
+
+    if archived:
+        # Each branch walks its own primary key; the ORDER BY on the
+        # compound merges them rather than sorting.
+        archives = [archive for archive, _ in archived]
+        query = _sql.union_all(query, *archives).order_by(_sql.literal_column("id"))
+    else:
+        query = query.order_by(model.id)
+    result = await db.execute(query.limit(page.limit + 1))
+    rows = result.all()
+
+    next_cursor = None
+    if len(rows) > page.limit:
+        rows = rows[: page.limit]
+        next_cursor = encode_cursor(rows[-1].id)
+
+    return rows, next_cursor
+
+
+async def _update_returning(db: _asyncio.AsyncSession, model, row_id: int, values: dict, missing: str):
+    """Set ``values`` and ``date_last_updated`` on one row and return the row.
+
+    A single ``UPDATE ... WHERE id = ? RETURNING`` (SQLite 3.35+ and
+    PostgreSQL) in place of load, assign and refresh. SQLAlchemy 1.4 does
+    not compile RETURNING for SQLite, so the statement is written out, with
+    the columns' own types binding the values and reading the row back. No row means no such id,
+    which is a 404 with ``missing`` as the detail.
+    """
+    table = model.__table__
+    values = dict(values, date_last_updated=_dt.datetime.utcnow())
+    assignments = ", ".join(f'"{name}" = :{name}' for name in values)
+    returning = ", ".join(f'"{column.name}"' for column in table.columns)
+    statement = (
+        _sql.text(f'UPDATE "{table.name}" SET {assignments} WHERE id = :row_id RETURNING {returning}')
+        .bindparams(*[_sql.bindparam(name, type_=table.c[name].type) for name in values])
+        .columns(*table.columns)
+    )
+    row = (await db.execute(statement, dict(values, row_id=row_id))).mappings().first()
+    if row is None:
+        raise _fastapi.HTTPException(status_code=404, detail=missing)
+    return dict(row)
+
+
+def _day_start(day: _dt.date):
+    """When ``day`` starts on the dairy's clock, as a stored timestamp."""
+    return _database.utc_time(_dt.datetime.combine(day, _dt.time.min))
+
+
+def _apply_filters(query, model, filters):
+    for field, value in filters.dict(exclude_none=True).items():
+        if field == "date_from":
+            query = query.filter(model.date_created >= _day_start(value))
+        elif field == "date_to":
+            query = query.filter(model.date_created < _day_start(value + _dt.timedelta(days=1)))
+        else:
+            query = query.filter(getattr(model, field) == value)
+
+    return query
+
+
+def _export_value(value):
+    if isinstance(value, _dt.datetime):
+        return value.isoformat()
+    if isinstance(value, _decimal.Decimal):
+        return _schemas.format_number(value)
+    if isinstance(value, bool):
+        return _schemas.format_paid(value)
+    return value
+
+
+def _number_value(value):
+    return "" if value is None else _schemas.format_number(value)
+
+
+@_functools.lru_cache(maxsize=None)
+def _row_shape(schema):
+    """Field names of ``schema`` and converters for the ones not sent as stored.
+
+    Numbers and the paid flag are formatted exactly as the schema's wire
+    types format them; every other column is already in its JSON form.
+    """
+    fields = list(schema.__fields__)
+    converters = []
+    for name, field in schema.__fields__.items():
+        if field.type_ is _schemas.Number:
+            converters.append((name, _number_value))
+        elif field.type_ is _schemas.YesNo:
+            converters.append((name, _schemas.format_paid))
+    return fields, converters
+
+
+def _row_dicts(schema, rows):
+    """Column tuples selected in ``schema`` field order, as response dicts."""
+    fields, converters = _row_shape(schema)
+    dicts = []
+    for row in rows:
+        values = dict(zip(fields, row))
+        for name, convert in converters:
+            values[name] = convert(values[name])
+        dicts.append(values)
+    return dicts
+
+
+def _row_lists(schema, rows):
+    """Column tuples selected in ``schema`` field order, as value lists."""
+    fields, converters = _row_shape(schema)
+    converters = [(fields.index(name), convert) for name, convert in converters]
+    lists = []
+    for row in rows:
+        values = list(row)
+        for index, convert in converters:
+            values[index] = convert(values[index])
+        lists.append(values)
+    return lists
+
+
+def _schema_columns(model, schema):
+    return [getattr(model, field) for field in schema.__fields__]
+
+
+def _schema_query(model, schema, filters=None):
+    """The schema's columns of ``model``, or of an archive table's ``.c``."""
+    query = _sql.select(*_schema_columns(model, schema))
+    if filters is not None:
+        query = _apply_filters(query, model, filters)
+    return query
+
+
+async def _json_page(
+    db: _asyncio.AsyncSession, model, schema, page: _schemas.PageParams, filters=None, archives=()
+):
+    """A page of ``model`` rows encoded straight to JSON bytes.
+
+    Selects only the schema's columns as plain tuples and hands them to
+    orjson, skipping ORM instances and the pydantic models that FastAPI
+    would otherwise build and validate twice per row. The bytes are the
+    same as the response_model path would produce. Rows of the
+    ``archives`` tables are listed along with the hot ones.
+    """
+    query = _schema_query(model, schema, filters)
+    archived = [(_schema_query(table.c, schema, filters), table) for table in archives]
+    rows, next_cursor = await _paginate(db, query, model, page, archived)
+
+    with _instrumentation.timed("serialize"):
+        return _orjson.dumps(_row_dicts(schema, rows)), next_cursor
+
+
+async def _ndjson_chunks(fields, batches):
+    async for rows in batches:
+        yield "".join(
+            _json.dumps(
+                {field: _export_value(value) for field, value in zip(fields, row)},
+                ensure_ascii=False,
+            )
+            + "\n"
+            for row in rows
+        )
+
+
+async def _csv_chunks(fields, batches):
+    buffer = _io.StringIO()
+    # Writes None as an empty field; NDJSON keeps it as null.
+    writer = _csv.writer(buffer)
+    writer.writerow(fields)
+    async for rows in batches:
+        writer.writerows([_export_value(value) for value in row] for row in rows)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+async def _export(db: _asyncio.AsyncSession, model, schema, fmt: str, filters=None, include_archived=False):
+    """Stream every matching row as NDJSON or CSV text chunks.
+
+    Only the columns of the response schema are selected, and rows come off
+    a server-side cursor ``EXPORT_BATCH_SIZE`` at a time, so memory stays
+    flat however large the table is. Nothing runs until the generator is
+    iterated. Exports read whole tables on purpose, so the query is marked
+    ``full_scan`` for the plan audit. ``include_archived`` adds the
+    archived rows, in id order.
+    """
+    fields = list(schema.__fields__)
+    query = _schema_query(model, schema, filters)
+    tables = await _archive_tables(db, model, filters) if include_archived else []
+    if tables:
+        query = _sql.union_all(
+            query, *[_schema_query(table.c, schema, filters) for table in tables]
+        ).order_by(_sql.literal_column("id"))
+    else:
+        query = query.order_by(model.id)
+    query = query.execution_options(full_scan=True, yield_per=EXPORT_BATCH_SIZE)
+
+    result = await db.stream(query)
+    chunks = _csv_chunks if fmt == "csv" else _ndjson_chunks
+    async for chunk in chunks(fields, result.partitions()):
+        yield chunk
+
+
+async def get_user_by_email(email: str, db: _asyncio.AsyncSession):
+    result = await db.execute(_sql.select(_models.User).filter(_models.User.email == email))
+    return result.scalars().first()
+
+
+async def create_user(user: _schemas.UserCreate, db: _asyncio.AsyncSession):
     user_obj = _models.User(
-        email=user.email, hashed_password=_hash.bcrypt.hash(user.hashed_password)
+        email=user.email, hashed_password=await _passwords.hash_password(user.hashed_password)
     )
     db.add(user_obj)
-    db.commit()
-    db.refresh(user_obj)
+    await db.commit()
+    await db.refresh(user_obj)
     return user_obj
 
 
-async def authenticate_user(email: str, password: str, db: _orm.Session):
+async def authenticate_user(email: str, password: str, db: _asyncio.AsyncSession):
     user = await get_user_by_email(db=db, email=email)
 
     if not user:
         return False
 
-    if not user.verify_password(password):
+    if not await user.verify_password(password):
         return False
 
     return user
 
 
 async def create_token(user: _models.User):
-    user_obj = _schemas.User.from_orm(user)
+    return _tokens.issue(_schemas.User.from_orm(user))
 
-    token = _jwt.encode(user_obj.dict(), JWT_SECRET)
 
-    return dict(access_token=token, token_type="bearer")
+async def get_current_user(token: str = _fastapi.Depends(oauth2schema)):
+    """The signed-in user, taken from the token's claims without a query."""
+    return _tokens.verify(token)
 
 
-async def get_current_user(
-    db: _orm.Session = _fastapi.Depends(get_db),
-    token: str = _fastapi.Depends(oauth2schema),
-):
-    try:
-        payload = _jwt.decode(token, JWT_SECRET, algorithms=["HS256"])
-        user = db.query(_models.User).get(payload["id"])
-    except:
-        raise _fastapi.HTTPException(
-            status_code=401, detail="Invalid Email or Password"
+async def revoke_token(claims: _schemas.TokenClaims, db: _asyncio.AsyncSession):
+    expires_at = _dt.datetime.utcfromtimestamp(claims.exp)
+    upsert = _insert(db, _models.RevokedToken).values(jti=claims.jti, expires_at=expires_at)
+    await db.execute(upsert.on_conflict_do_nothing())
+    await db.execute(
+        _sql.delete(_models.RevokedToken).where(
+            _models.RevokedToken.expires_at < _dt.datetime.utcnow()
         )
+    )
+    await db.commit()
+    _tokens.revoke(claims.jti, claims.exp)
+
 
-    return _schemas.User.from_orm(user)
+async def load_revoked_tokens():
+    async with _database.async_engine.begin() as connection:
+        await connection.run_sync(_models.RevokedToken.__table__.create, checkfirst=True)
+        result = await connection.execute(
+            _sql.select(_models.RevokedToken.jti, _models.RevokedToken.expires_at).where(
+                _models.RevokedToken.expires_at >= _dt.datetime.utcnow()
+            )
+        )
+        _tokens.load_revoked(result.all())
 
 
-async def _customer_selector(customer_id: int, db: _orm.Session):
-    customer = (
-        db.query(_models.Customer)
-        .filter(_models.Customer.id == customer_id)
-        .first()
+async def _customer_selector(customer_id: int, db: _asyncio.AsyncSession):
+    result = await db.execute(
+        _sql.select(_models.Customer).filter(_models.Customer.id == customer_id)
     )
+    customer = result.scalars().first()
 
     if customer is None:
         raise _fastapi.HTTPException(status_code=404, detail="Customer does not exist")
@@ -86,55 +375,219 @@ async def _customer_selector(customer_id: int, db: _orm.Session):
     return customer
 
 
-async def get_customers(db: _orm.Session):
-    customers = db.query(_models.Customer)
-
-    return list(map(_schemas.Customer.from_orm, customers))
+async def get_customers(db: _asyncio.AsyncSession, page: _schemas.PageParams):
+    return await _json_page(db, _models.Customer, _schemas.Customer, page)
 
 
-async def create_customer(db: _orm.Session, customer: _schemas.CustomerCreate):
+async def create_customer(db: _asyncio.AsyncSession, customer: _schemas.CustomerCreate):
     customer = _models.Customer(**customer.dict())
     db.add(customer)
-    db.commit()
-    db.refresh(customer)
+    await db.flush()
+    await _index_customer(db, customer.id, customer.name, customer.mobile)
+    await db.commit()
+    await _cache.invalidate("customers")
+    await db.refresh(customer)
     return _schemas.Customer.from_orm(customer)
 
 
-async def get_customer(customer_id: int,  db: _orm.Session):
+async def get_customers_with_milks(
+    db: _asyncio.AsyncSession,
+    page: _schemas.PageParams,
+    since: Optional[_dt.date] = None,
+    milk_limit: int = DEFAULT_MILKS_PER_CUSTOMER,
+):
+    """A page of customers, each with its most recent milk entries.
+
+    Always two queries: the customer page, then every customer's latest
+    ``milk_limit`` entries at once, ranked per customer with a window
+    function so the cap is applied in SQL.
+    """
+    query = _sql.select(*_schema_columns(_models.Customer, _schemas.Customer))
+    rows, next_cursor = await _paginate(db, query, _models.Customer, page)
+    customers = _row_dicts(_schemas.Customer, rows)
+
+    milk = _models.Milk
+    rank = (
+        _sql.func.row_number()
+        .over(partition_by=milk.customer_id, order_by=(milk.date_created.desc(), milk.id.desc()))
+        .label("rank")
+    )
+    ranked = _sql.select(milk, rank).where(milk.customer_id.in_([c["id"] for c in customers]))
+    if since is not None:
+        ranked = ranked.where(milk.date_created >= _day_start(since))
+    ranked = ranked.subquery()
+
+    milks = {customer["id"]: [] for customer in customers}
+    if customers:
+        result = await db.execute(
+            _sql.select(*[ranked.c[field] for field in _schemas.Milk.__fields__])
+            .filter(ranked.c.rank <= milk_limit)
+            .order_by(ranked.c.customer_id, ranked.c.rank)
+        )
+        for row in _row_dicts(_schemas.Milk, result):
+            milks[row["customer_id"]].append(row)
+
+    for customer in customers:
+        customer["milks"] = milks[customer["id"]]
+
+    with _instrumentation.timed("serialize"):
+        return _orjson.dumps(customers), next_cursor
+
+
+def export_customers(db: _asyncio.AsyncSession, fmt: str):
+    return _export(db, _models.Customer, _schemas.Customer, fmt)
+
+
+async def get_customer(customer_id: int,  db: _asyncio.AsyncSession):
     customer = await _customer_selector(customer_id=customer_id, db=db)
 
     return _schemas.Customer.from_orm(customer)
 
 
-async def delete_customer(customer_id: int, db: _orm.Session):
+async def _detach_milks(db: _asyncio.AsyncSession, customer_id: int):
+    """Take ``customer_id`` off its milk rows, marking them changed."""
+    await db.execute(
+        _sql.update(_models.Milk)
+        .where(_models.Milk.customer_id == customer_id)
+        .values(customer_id=None, date_last_updated=_dt.datetime.utcnow())
+        .execution_options(synchronize_session=False)
+    )
+
+
+async def delete_customer(customer_id: int, db: _asyncio.AsyncSession):
     customer = await _customer_selector(customer_id, db)
 
-    db.delete(customer)
-    db.commit()
+    # Its milk rows stay, without a customer; so do their totals. Detached
+    # here rather than by the ORM so that delta sync sends them again.
+    await _detach_milks(db, customer_id)
+    await _detach_milk_totals(db, customer_id)
+    await db.delete(customer)
+    await _unindex_customer(db, customer_id)
+    await _add_tombstone(db, "customers", customer_id)
+    await db.commit()
+    await _cache.invalidate("customers", "milks", "milk-rows", f"customer:{customer_id}")
+
 
 
-async def update_customer(customer_id: int, customer: _schemas.CustomerCreate, db: _orm.Session):
-    customer_db = await _customer_selector(customer_id, db)
+async def update_customer(customer_id: int, customer, db: _asyncio.AsyncSession):
+    """Change the fields set on ``customer``: all of them for a
+    ``CustomerCreate``, only the ones sent for a ``CustomerUpdate``."""
+    values = customer.dict(exclude_unset=True)
+    row = await _update_returning(db, _models.Customer, customer_id, values, "Customer does not exist")
+    if "name" in values or "mobile" in values:
+        await _index_customer(db, customer_id, row["name"], row["mobile"])
+    response = _schemas.Customer.parse_obj(row)
+    await db.commit()
+    await _cache.invalidate("customers", f"customer:{customer_id}")
 
-    customer_db.name = customer.name
-    customer_db.mobile = customer.mobile
-    customer_db.email = customer.email
-    customer_db.pan = customer.pan
-    customer_db.mobile = customer.address
-    customer_db.date_last_updated = _dt.datetime.utcnow()
+    return response
 
-    db.commit()
-    db.refresh(customer_db)
 
-    return _schemas.Customer.from_orm(customer_db)
+#-----------------------------------------------------------SEARCH-----------------------------------------------------
+
+
+def _search_matches(db: _asyncio.AsyncSession, text: str):
+    """Ids of the customers with a name or mobile word starting with each
+    word typed, and the rank to sort them by (lower is better).
+
+    Every word is quoted, so query syntax and punctuation in the input are
+    matched as text rather than parsed. Returns None when no word is left.
+    """
+    words = text.replace('"', " ").split()
+    if not words:
+        return None
+
+    if _backend(db) == "postgresql":
+        document = _sql.literal_column(_models.CUSTOMER_SEARCH_DOCUMENT)
+        prefixes = " & ".join(
+            "'{}':*".format(word.replace("\\", "\\\\").replace("'", "''")) for word in words
+        )
+        query = _sql.func.to_tsquery(_sql.literal_column("'simple'"), prefixes)
+        matches = _sql.select(_models.Customer.id).where(document.op("@@")(query))
+        return matches, -_sql.func.ts_rank(document, query)
+
+    search = _models.customer_search
+    match = " ".join(f'"{word}"*' for word in words)
+    matches = _sql.select(search.c.rowid.label("id")).where(_sql.literal_column(search.name).op("MATCH")(match))
+    return matches, search.c.rank
+
+
+async def _index_customer(db: _asyncio.AsyncSession, customer_id: int, name, mobile):
+    # PostgreSQL's search index is on the customer table itself.
+    if _backend(db) == "sqlite":
+        await db.execute(
+            _sql.insert(_models.customer_search).prefix_with("OR REPLACE"),
+            {"rowid": customer_id, "name": name, "mobile": mobile},
+        )
+
+
+async def _unindex_customer(db: _asyncio.AsyncSession, customer_id: int):
+    if _backend(db) == "sqlite":
+        await db.execute(
+            _sql.delete(_models.customer_search).where(_models.customer_search.c.rowid == customer_id)
+        )
 
 
-async def _milk_selector(milk_id: int, db: _orm.Session):
-    milk = (
-        db.query(_models.Milk)
-        .filter(_models.Milk.id == milk_id)
-        .first()
+async def search_customers(db: _asyncio.AsyncSession, text: str, limit: int = DEFAULT_SEARCH_RESULTS):
+    """The ``limit`` best customers whose name or mobile words start with
+    the words typed, best first, encoded as JSON.
+
+    Ranking (bm25 in FTS5, ts_rank in PostgreSQL) has to score every match
+    before the best can be picked, which costs milliseconds per thousand
+    rows, while walking matches in id order stops after the first few. So
+    the matches are counted up to ``SEARCH_RANK_LIMIT`` in id order first:
+    a query that matches more than that (a letter or two) is too vague for
+    ranking to help and gets the oldest customers; otherwise the matches
+    are ranked and limited inside the search index. Either way only
+    ``limit`` ids are looked up in ``customer``.
+    """
+    search = _search_matches(db, text)
+    if search is None:
+        return b"[]"
+
+    matches, rank = search
+    found_id = matches.selected_columns.id
+    found = (
+        await db.execute(matches.order_by(found_id).limit(SEARCH_RANK_LIMIT + 1))
+    ).scalars().all()
+
+    customers = _sql.select(*_schema_columns(_models.Customer, _schemas.Customer))
+    if len(found) > SEARCH_RANK_LIMIT:
+        customers = customers.where(_models.Customer.id.in_(found[:limit])).order_by(_models.Customer.id)
+    else:
+        ranked = matches.add_columns(rank.label("rank")).order_by(rank).limit(limit).subquery()
+        customers = customers.join(ranked, ranked.c.id == _models.Customer.id).order_by(ranked.c.rank)
+    result = await db.execute(customers)
+
+    with _instrumentation.timed("serialize"):
+        return _orjson.dumps(_row_dicts(_schemas.Customer, result))
+
+
+async def rebuild_customer_search(db: _asyncio.AsyncSession):
+    """Refill the search index from ``customer``; returns the rows indexed."""
+    search = _models.customer_search
+    customer = _models.Customer
+    if _backend(db) == "postgresql":
+        await db.execute(_sql.text("REINDEX INDEX ix_customer_search"))
+        await db.commit()
+        return (await db.execute(_sql.select(_sql.func.count(customer.id)))).scalar()
+
+    await db.execute(_sql.delete(search))
+    result = await db.execute(
+        _sql.insert(search).from_select(
+            ["rowid", "name", "mobile"], _sql.select(customer.id, customer.name, customer.mobile)
+        )
     )
+    await db.execute(_sql.text("INSERT INTO customer_search (customer_search) VALUES ('optimize')"))
+    await db.commit()
+    return result.rowcount
+
+
+async def _milk_selector(milk_id: int, db: _asyncio.AsyncSession):
+    result = await db.execute(
+        _sql.select(_models.Milk).filter(_models.Milk.id == milk_id)
+    )
+    milk = result.scalars().first()
 
     if milk is None:
         raise _fastapi.HTTPException(status_code=404, detail="Milk record does not exist")
@@ -142,58 +595,549 @@ async def _milk_selector(milk_id: int, db: _orm.Session):
     return milk
 
 
-async def create_milk(db: _orm.Session, milk: _schemas.MilkCreate):
-    milk = _models.Milk(**milk.dict())
+_ROLLUP_SUMS = (
+    "entries",
+    "liters",
+    "amount",
+    "fat_weighted",
+    "fat_liters",
+    "snf_weighted",
+    "snf_liters",
+    "unpaid_entries",
+    "unpaid_liters",
+    "unpaid_amount",
+)
+
+
+def _milk_rollup_columns():
+    """The milk columns that ``_milk_rollup_delta`` reads."""
+    return [
+        getattr(_models.Milk, name)
+        for name in ("customer_id", "customer_name", "milk_type", "lit", "fat", "snf", "amount", "is_paid", "date_created")
+    ]
+
+
+def _milk_values(milk: _models.Milk):
+    return {column.name: getattr(milk, column.name) for column in _models.Milk.__table__.columns}
+
+
+def _milk_rollup_delta(milk: dict, sign: int):
+    """The change one milk row makes to its daily rollup row.
+
+    ``sign`` is 1 when the row is added and -1 when it is taken away, so an
+    update is its old values at -1 plus its new values at 1.
+    """
+    lit = _models.to_decimal(milk["lit"]) or 0
+    fat = _models.to_decimal(milk["fat"])
+    snf = _models.to_decimal(milk["snf"])
+    amount = _models.to_decimal(milk["amount"]) or 0
+    unpaid = 0 if _models.to_paid(milk["is_paid"]) else sign
+
+    return {
+        "customer_id": milk["customer_id"] or 0,
+        "day": _database.local_time(milk["date_created"]).date(),
+        "milk_type": milk["milk_type"] or "",
+        "customer_name": milk["customer_name"],
+        "entries": sign,
+        "liters": sign * lit,
+        "amount": sign * amount,
+        "fat_weighted": 0 if fat is None else sign * lit * fat,
+        "fat_liters": 0 if fat is None else sign * lit,
+        "snf_weighted": 0 if snf is None else sign * lit * snf,
+        "snf_liters": 0 if snf is None else sign * lit,
+        "unpaid_entries": unpaid,
+        "unpaid_liters": unpaid * lit,
+        "unpaid_amount": unpaid * amount,
+    }
+
+
+async def _apply_milk_rollups(db: _asyncio.AsyncSession, deltas):
+    """Add rollup deltas to ``milk_daily`` in the caller's transaction.
+
+    Deltas for the same day are merged first, then applied with a single
+    upsert. Days that lose their last entry are removed.
+    """
+    merged = {}
+    for delta in deltas:
+        key = (delta["customer_id"], delta["day"], delta["milk_type"])
+        row = merged.get(key)
+        if row is None:
+            merged[key] = dict(delta)
+        else:
+            for column in _ROLLUP_SUMS:
+                row[column] += delta[column]
+            row["customer_name"] = delta["customer_name"]
+
+    if not merged:
+        return
+
+    table = _models.MilkDaily.__table__
+    upsert = _insert(db, table)
+    upsert = upsert.on_conflict_do_update(
+        index_elements=[table.c.customer_id, table.c.day, table.c.milk_type],
+        set_=dict(
+            {column: table.c[column] + upsert.excluded[column] for column in _ROLLUP_SUMS},
+            customer_name=upsert.excluded.customer_name,
+        ),
+    )
+    await db.execute(upsert, list(merged.values()))
+
+    emptied = [row for row in merged.values() if row["entries"] < 0]
+    if emptied:
+        await db.execute(
+            table.delete().where(
+                table.c.customer_id == _sql.bindparam("b_customer_id"),
+                table.c.day == _sql.bindparam("b_day"),
+                table.c.milk_type == _sql.bindparam("b_milk_type"),
+                table.c.entries <= 0,
+            ),
+            [
+                {"b_customer_id": row["customer_id"], "b_day": row["day"], "b_milk_type": row["milk_type"]}
+                for row in emptied
+            ],
+        )
+
+
+async def _detach_milk_totals(db: _asyncio.AsyncSession, customer_id: int):
+    """Move a deleted customer's milk totals to customer 0, where milk rows
+    without a customer are counted, in the caller's transaction."""
+    daily = _models.MilkDaily.__table__
+    archived = _models.ArchiveDaily.__table__
+    for table, sums, where in (
+        (daily, _ROLLUP_SUMS, daily.c.customer_id == customer_id),
+        (
+            archived,
+            ("entries", "liters", "amount", "fat_weighted", "fat_liters", "snf_weighted", "snf_liters"),
+            _sql.and_(archived.c.ledger == _models.Milk.__tablename__, archived.c.customer_id == customer_id),
+        ),
+    ):
+        columns = [column.name for column in table.columns]
+        select = _sql.select(
+            *[_sql.literal_column("0") if name == "customer_id" else table.c[name] for name in columns]
+        ).where(where)
+        upsert = _insert(db, table).from_select(columns, select)
+        upsert = upsert.on_conflict_do_update(
+            index_elements=list(table.primary_key.columns),
+            set_={column: table.c[column] + upsert.excluded[column] for column in sums},
+        )
+        await db.execute(upsert)
+        await db.execute(table.delete().where(where))
+
+
+async def _rollup_ledger_range(db: _asyncio.AsyncSession, after_id: int, through_id: int, ids=None):
+    """Fold the milk rows with ids in (after_id, through_id] into ``milk_daily``.
+
+    One INSERT ... SELECT ... GROUP BY, merged into existing days by upsert.
+    ``ids`` narrows the range to those rows, for ranges other writers may
+    have inserted into (PostgreSQL).
+    """
+    milk = _models.Milk
+    table = _models.MilkDaily.__table__
+    paid = milk.is_paid.is_(_sql.true())
+    tested_fat = _sql.case((milk.fat.isnot(None), milk.lit), else_=0)
+    tested_snf = _sql.case((milk.snf.isnot(None), milk.lit), else_=0)
+    day = _sql.func.date(_database.local_timestamp(milk.date_created))
+    # Constants inline: PostgreSQL only matches a GROUP BY expression to the
+    # selected one when neither carries its own bound parameter.
+    customer_id = _sql.func.coalesce(milk.customer_id, _sql.literal_column("0"))
+    milk_type = _sql.func.coalesce(milk.milk_type, _sql.literal_column("''"))
+
+    select = (
+        _sql.select(
+            customer_id,
+            day,
+            milk_type,
+            _sql.func.max(milk.customer_name),
+            _sql.func.count(milk.id),
+            _sql.func.coalesce(_sql.func.sum(milk.lit), 0),
+            _sql.func.coalesce(_sql.func.sum(milk.amount), 0),
+            _sql.func.coalesce(_sql.func.sum(milk.lit * milk.fat), 0),
+            _sql.func.coalesce(_sql.func.sum(tested_fat), 0),
+            _sql.func.coalesce(_sql.func.sum(milk.lit * milk.snf), 0),
+            _sql.func.coalesce(_sql.func.sum(tested_snf), 0),
+            _sql.func.sum(_sql.case((paid, 0), else_=1)),
+            _sql.func.coalesce(_sql.func.sum(_sql.case((paid, 0), else_=milk.lit)), 0),
+            _sql.func.coalesce(_sql.func.sum(_sql.case((paid, 0), else_=milk.amount)), 0),
+        )
+        .where(milk.id > after_id, milk.id <= through_id)
+        .group_by(customer_id, day, milk_type)
+    )
+    if ids is not None:
+        # One array parameter however many rows; bound parameters run out.
+        ids = _sql.bindparam("ids", ids, type_=_postgresql.ARRAY(_sql.Integer))
+        select = select.where(milk.id == _sql.any_(ids))
+    upsert = _insert(db, table).from_select(
+        ["customer_id", "day", "milk_type", "customer_name", *_ROLLUP_SUMS], select
+    )
+    upsert = upsert.on_conflict_do_update(
+        index_elements=[table.c.customer_id, table.c.day, table.c.milk_type],
+        set_={column: table.c[column] + upsert.excluded[column] for column in _ROLLUP_SUMS},
+    )
+    await db.execute(upsert)
+
+
+async def rebuild_milk_rollups(
+    db: _asyncio.AsyncSession, chunk_size: int = ROLLUP_CHUNK_SIZE, single_transaction: bool = False
+):
+    """Recompute ``milk_daily`` from the whole milk ledger.
+
+    The table is emptied and refilled one primary-key range at a time, each
+    range committed on its own, or all in one transaction with
+    ``single_transaction``, so that an interrupted rebuild leaves the table
+    as it was. Pause collection writes while this runs: a delta applied to a
+    row that has not been reached yet would be counted twice.
+    """
+    table = _models.MilkDaily.__table__
+
+    async def commit():
+        if not single_transaction:
+            await db.commit()
+
+    await db.execute(table.delete())
+    last_id = (await db.execute(_sql.select(_sql.func.max(_models.Milk.id)))).scalar() or 0
+    await commit()
+
+    for start in range(0, last_id, chunk_size):
+        await _rollup_ledger_range(db, start, min(start + chunk_size, last_id))
+        await commit()
+    await _rollup_archived_milks(db)
+    await db.commit()
+
+    return (await db.execute(_sql.select(_sql.func.count()).select_from(table))).scalar()
+
+
+async def _rollup_archived_milks(db: _asyncio.AsyncSession):
+    """Fold the archived milk totals back into ``milk_daily``.
+
+    Archived rows are all paid, so they add nothing to the unpaid counters.
+    """
+    daily = _models.ArchiveDaily
+    table = _models.MilkDaily.__table__
+    sums = ("entries", "liters", "amount", "fat_weighted", "fat_liters", "snf_weighted", "snf_liters")
+    select = (
+        _sql.select(
+            daily.customer_id,
+            daily.day,
+            daily.milk_type,
+            _sql.func.nullif(_sql.func.max(daily.customer_name), ""),
+            *[_sql.func.sum(getattr(daily, name)) for name in sums],
+        )
+        .where(daily.ledger == _models.Milk.__tablename__)
+        .group_by(daily.customer_id, daily.day, daily.milk_type)
+    )
+    upsert = _insert(db, table).from_select(["customer_id", "day", "milk_type", "customer_name", *sums], select)
+    upsert = upsert.on_conflict_do_update(
+        index_elements=[table.c.customer_id, table.c.day, table.c.milk_type],
+        set_={column: table.c[column] + upsert.excluded[column] for column in sums},
+    )
+    await db.execute(upsert)
+
+
+def _rate_chart_error(error: ValueError, loc=("amount",)):
+    return {"loc": list(loc), "msg": str(error), "type": "value_error.rate_chart"}
+
+
+def _price_milk(milk: dict):
+    """The amount of a milk entry by the rate chart, or None if no chart
+    covers its milk type. An entry that cannot be priced is a 422."""
+    chart = _rates.charts.current()
+    if chart is None:
+        return None
+    try:
+        return chart.amount(milk)
+    except ValueError as error:
+        raise _fastapi.HTTPException(status_code=422, detail=[_rate_chart_error(error, ("body", "amount"))])
+
+
+async def create_milk(db: _asyncio.AsyncSession, milk: _schemas.MilkCreate):
+    milk = milk.dict()
+    amount = _price_milk(milk)
+    if amount is not None:
+        milk["amount"] = amount
+    milk = _models.Milk(**milk)
     db.add(milk)
-    db.commit()
-    db.refresh(milk)
+    await db.flush()
+    await _apply_milk_rollups(db, [_milk_rollup_delta(_milk_values(milk), 1)])
+    await db.commit()
+    await _cache.invalidate("milks")
+    await db.refresh(milk)
     return _schemas.Milk.from_orm(milk)
 
 
-async def get_milks(db: _orm.Session):
-    milks = db.query(_models.Milk)
+async def read_bulk_records(request: _fastapi.Request):
+    """Read a bulk payload sent as a JSON array or as NDJSON.
+
+    NDJSON bodies are parsed line by line while they stream in. A line that
+    is not valid JSON becomes ``None`` so that it is reported as a failed
+    row rather than rejecting the whole batch.
+    """
+    records = []
+
+    if request.headers.get("content-type", "").startswith("application/x-ndjson"):
+        buffer = b""
+        async for chunk in request.stream():
+            buffer += chunk
+            *lines, buffer = buffer.split(b"\n")
+            records.extend(_parse_ndjson_line(line) for line in lines if line.strip())
+            if len(records) > MAX_BULK_ROWS:
+                break
+        if buffer.strip():
+            records.append(_parse_ndjson_line(buffer))
+    else:
+        try:
+            records = await request.json()
+        except ValueError:
+            raise _fastapi.HTTPException(status_code=400, detail="Body is not valid JSON")
+        if not isinstance(records, list):
+            raise _fastapi.HTTPException(status_code=400, detail="Expected a JSON array")
+
+    if len(records) > MAX_BULK_ROWS:
+        raise _fastapi.HTTPException(
+            status_code=413, detail=f"At most {MAX_BULK_ROWS} rows per request"
+        )
+
+    return records
 
-    return list(map(_schemas.Milk.from_orm, milks))
 
+def _parse_ndjson_line(line: bytes):
+    try:
+        return _json.loads(line)
+    except ValueError:
+        return None
+
+
+async def _insert_many(db: _asyncio.AsyncSession, model, rows: list):
+    """Insert rows with one executemany per batch and return their ids.
+
+    The statement is compiled once and the rows are handed to the driver as
+    plain tuples, which skips the per-row parameter handling of an ORM or
+    Core insert. The caller's transaction holds SQLite's write lock for the
+    whole insert, so the rowids handed out are consecutive and end at
+    last_insert_rowid(). PostgreSQL loads with COPY instead (``_copy_many``).
+    """
+    connection = await db.connection()
+    if connection.dialect.name == "postgresql":
+        return await _copy_many(connection, model, rows)
+    table = model.__table__
+    compiled = table.insert().compile(dialect=connection.dialect, column_keys=list(rows[0]))
+    columns = [
+        (key, table.c[key].type.bind_processor(connection.dialect))
+        for key in compiled.positiontup
+    ]
+    params = [
+        tuple(process(row[key]) if process else row[key] for key, process in columns)
+        for row in rows
+    ]
+
+    for start in range(0, len(params), BULK_BATCH_SIZE):
+        await connection.exec_driver_sql(compiled.string, params[start : start + BULK_BATCH_SIZE])
+
+    result = await connection.exec_driver_sql("SELECT last_insert_rowid()")
+    last_id = result.scalar()
+    return list(range(last_id - len(rows) + 1, last_id + 1))
+
+
+async def _copy_many(connection: _asyncio.AsyncConnection, model, rows: list):
+    """Load rows into PostgreSQL with COPY (asyncpg) and return their ids.
+
+    COPY cannot return the ids it assigns, so they are drawn from the
+    table's sequence first, in one query, and copied in with the rows. That
+    query also opens the transaction the COPY then runs in. Other writers
+    draw from the same sequence meanwhile, so the ids need not be
+    consecutive.
+    """
+    table = model.__table__
+    sequence = _sql.func.pg_get_serial_sequence(table.name, "id")
+    ids = (
+        await connection.execute(
+            _sql.select(_sql.func.nextval(sequence)).select_from(_sql.func.generate_series(1, len(rows)))
+        )
+    ).scalars().all()
+
+    columns = [(key, table.c[key].type.bind_processor(connection.dialect)) for key in rows[0]]
+    records = [
+        (row_id, *(process(row[key]) if process else row[key] for key, process in columns))
+        for row_id, row in zip(ids, rows)
+    ]
+    raw = await connection.get_raw_connection()
+    await raw.driver_connection.copy_records_to_table(
+        table.name, records=records, columns=["id", *(key for key, _ in columns)]
+    )
+    return ids
+
+
+def _fast_validate(record, fields):
+    """Validate a raw record without building a model, or return None.
+
+    Records whose plain fields already have exactly the schema's types
+    would pass pydantic unchanged, so only the wire types (numbers, the
+    paid flag) need running. Anything else returns None and goes through
+    the full model so that errors are reported the usual way.
+    """
+    if not isinstance(record, dict) or not record.keys() <= fields.keys():
+        return None
+
+    clean = {}
+    for name, field in fields.items():
+        if name not in record:
+            if field.required:
+                return None
+            clean[name] = field.get_default()
+            continue
+        value = record[name]
+        if field.type_ in (int, str):
+            if type(value) is not field.type_:
+                return None
+        elif not hasattr(field.type_, "validate"):
+            return None
+        else:
+            try:
+                value = field.type_.validate(value)
+            except (TypeError, ValueError):
+                return None
+        clean[name] = value
+
+    return clean
+
+
+async def _insert_milks(db: _asyncio.AsyncSession, records: list, schema=_schemas.MilkCreate):
+    """Validate ``records`` as ``schema`` and insert the valid ones, with
+    their rollups, in the caller's transaction.
+
+    Entries without a ``date_created`` of their own are stamped now, and
+    those the rate chart covers are priced by it, in one pass over the
+    batch.
+    """
+    fields = schema.__fields__
+    now = _dt.datetime.utcnow()
+    valid = []
+    rows = []
+    positions = []
+    errors = []
+
+    for index, record in enumerate(records):
+        milk = _fast_validate(record, fields)
+        if milk is None:
+            try:
+                milk = schema.parse_obj(record).dict()
+            except _pydantic.ValidationError as e:
+                errors.append(_schemas.BulkRowError(index=index, errors=e.errors()))
+                continue
+        valid.append((index, milk))
+
+    chart = _rates.charts.current()
+    amounts = chart.amounts([milk for _, milk in valid]) if chart is not None else [None] * len(valid)
+    for (index, milk), amount in zip(valid, amounts):
+        if isinstance(amount, ValueError):
+            errors.append(_schemas.BulkRowError(index=index, errors=[_rate_chart_error(amount)]))
+            continue
+        if amount is not None:
+            milk["amount"] = amount
+        positions.append(index)
+        rows.append(dict(milk, date_created=milk.get("date_created") or now, date_last_updated=now))
+    errors.sort(key=lambda error: error.index)
+
+    ids = [None] * len(records)
+    if rows:
+        new_ids = await _insert_many(db, _models.Milk, rows)
+        for index, milk_id in zip(positions, new_ids):
+            ids[index] = milk_id
+        consecutive = _backend(db) == "sqlite"
+        await _rollup_ledger_range(
+            db, min(new_ids) - 1, max(new_ids), ids=None if consecutive else new_ids
+        )
+
+    return _schemas.BulkResult(
+        inserted=len(rows), failed=len(errors), ids=ids, errors=errors
+    )
 
-async def get_milk(milk_id: int,  db: _orm.Session):
-    milk = await _milk_selector(milk_id=milk_id, db=db)
+
+async def create_milks_bulk(db: _asyncio.AsyncSession, records: list):
+    try:
+        result = await _insert_milks(db, records)
+        await db.commit()
+    except:
+        await db.rollback()
+        raise
+    if result.inserted:
+        await _cache.invalidate("milks")
+
+    return result
+
+
+async def get_milks(
+    db: _asyncio.AsyncSession,
+    page: _schemas.PageParams,
+    filters: _schemas.MilkFilter,
+    include_archived: bool = False,
+):
+    archives = await _archive_tables(db, _models.Milk, filters) if include_archived else ()
+    return await _json_page(db, _models.Milk, _schemas.Milk, page, filters, archives)
+
+
+def export_milks(
+    db: _asyncio.AsyncSession, fmt: str, filters: _schemas.MilkFilter, include_archived: bool = False
+):
+    return _export(db, _models.Milk, _schemas.Milk, fmt, filters, include_archived)
+
+
+async def get_milk(milk_id: int,  db: _asyncio.AsyncSession, include_archived: bool = False):
+    try:
+        milk = await _milk_selector(milk_id=milk_id, db=db)
+    except _fastapi.HTTPException as missing:
+        if not include_archived:
+            raise
+        return await _archived_row(db, _models.Milk, _schemas.Milk, milk_id, missing)
 
     return _schemas.Milk.from_orm(milk)
 
 
-async def update_milk(milk_id: int, milk: _schemas.MilkCreate, db: _orm.Session):
-    milk_db = await _milk_selector(milk_id, db)
+async def update_milk(milk_id: int, milk, db: _asyncio.AsyncSession):
+    """Change the fields set on ``milk`` and move the rollup with them.
 
-    milk_db.customer_id = milk.customer_id
-    milk_db.customer_name = milk.customer_name
-    milk_db.milk_type = milk.milk_type
-    milk_db.lit = milk.lit
-    milk_db.fat = milk.fat
-    milk_db.snf = milk.snf
-    milk_db.amount = milk.amount
-    milk_db.is_paid = milk.is_paid
-    milk_db.date_last_updated = _dt.datetime.utcnow()
+    The rollup needs the row's old values, which RETURNING cannot give, so
+    they are read first: one narrow SELECT, the UPDATE, and the rollup
+    upsert. A change to what the entry is priced on reprices it by the rate
+    chart, from those same old values.
+    """
+    result = await db.execute(
+        _sql.select(*_milk_rollup_columns()).filter(_models.Milk.id == milk_id)
+    )
+    previous = result.mappings().first()
+    if previous is None:
+        raise _fastapi.HTTPException(status_code=404, detail="Milk record does not exist")
 
-    db.commit()
-    db.refresh(milk_db)
+    values = milk.dict(exclude_unset=True)
+    if values.keys() & {"milk_type", "lit", "fat", "snf", "amount"}:
+        amount = _price_milk(dict(previous, **values))
+        if amount is not None:
+            values["amount"] = amount
+    row = await _update_returning(db, _models.Milk, milk_id, values, "Milk record does not exist")
+    await _apply_milk_rollups(db, [_milk_rollup_delta(previous, -1), _milk_rollup_delta(row, 1)])
+    # Before committing, so that a row the response cannot describe is not
+    # left changed behind an error.
+    response = _schemas.Milk.parse_obj(row)
+    await db.commit()
+    await _cache.invalidate("milks", f"milk:{milk_id}")
 
-    return _schemas.Milk.from_orm(milk_db)
+    return response
 
 
-async def delete_milk(milk_id: int, db: _orm.Session):
+async def delete_milk(milk_id: int, db: _asyncio.AsyncSession):
     milk = await _milk_selector(milk_id, db)
 
-    db.delete(milk)
-    db.commit()
+    await _apply_milk_rollups(db, [_milk_rollup_delta(_milk_values(milk), -1)])
+    await db.delete(milk)
+    await _add_tombstone(db, "milks", milk_id)
+    await db.commit()
+    await _cache.invalidate("milks", f"milk:{milk_id}")
 
     #---------------------------------------------------------sales
-async def _sale_selector(sale_id: int, db: _orm.Session):
-    sale = (
-        db.query(_models.Sale)
-        .filter(_models.Sale.id == sale_id)
-        .first()
+async def _sale_selector(sale_id: int, db: _asyncio.AsyncSession):
+    result = await db.execute(
+        _sql.select(_models.Sale).filter(_models.Sale.id == sale_id)
     )
+    sale = result.scalars().first()
 
     if sale is None:
         raise _fastapi.HTTPException(status_code=404, detail="Sale record does not exist")
@@ -201,52 +1145,61 @@ async def _sale_selector(sale_id: int, db: _orm.Session):
     return sale
 
 
-async def create_sale(db: _orm.Session, sale: _schemas.SaleCreate):
+async def create_sale(db: _asyncio.AsyncSession, sale: _schemas.SaleCreate):
     sale = _models.Sale(**sale.dict())
     db.add(sale)
-    db.commit()
-    db.refresh(sale)
+    await db.commit()
+    await db.refresh(sale)
     return _schemas.Sale.from_orm(sale)
 
-async def get_sales(db: _orm.Session):
-    sales = db.query(_models.Sale)
+async def get_sales(
+    db: _asyncio.AsyncSession,
+    page: _schemas.PageParams,
+    filters: _schemas.SaleFilter,
+    include_archived: bool = False,
+):
+    archives = await _archive_tables(db, _models.Sale, filters) if include_archived else ()
+    return await _json_page(db, _models.Sale, _schemas.Sale, page, filters, archives)
+
 
-    return list(map(_schemas.Sale.from_orm, sales))
+def export_sales(
+    db: _asyncio.AsyncSession, fmt: str, filters: _schemas.SaleFilter, include_archived: bool = False
+):
+    return _export(db, _models.Sale, _schemas.Sale, fmt, filters, include_archived)
 
 
-async def get_sale(sale_id: int,  db: _orm.Session):
-    sale = await _sale_selector(sale_id=sale_id, db=db)
+async def get_sale(sale_id: int,  db: _asyncio.AsyncSession, include_archived: bool = False):
+    try:
+        sale = await _sale_selector(sale_id=sale_id, db=db)
+    except _fastapi.HTTPException as missing:
+        if not include_archived:
+            raise
+        return await _archived_row(db, _models.Sale, _schemas.Sale, sale_id, missing)
 
     return _schemas.Sale.from_orm(sale)
 
 
-async def update_sale(sale_id: int, sale: _schemas.SaleCreate, db: _orm.Session):
-    sale_db = await _sale_selector(sale_id, db)
-
-    sale_db.customer_id = sale.customer_id
-    sale_db.customername = sale.customername
-    sale_db.milk_type = sale.milk_type
-    sale_db.lit = sale.lit
-    sale_db.amount = sale.amount
-    sale_db.is_paid = sale.is_paid
-    db.commit()
-    db.refresh(sale_db)
+async def update_sale(sale_id: int, sale, db: _asyncio.AsyncSession):
+    row = await _update_returning(
+        db, _models.Sale, sale_id, sale.dict(exclude_unset=True), "Sale record does not exist"
+    )
+    response = _schemas.Sale.parse_obj(row)
+    await db.commit()
 
-    return _schemas.Sale.from_orm(sale_db)
+    return response
 
 
-async def delete_sale(sale_id: int, db: _orm.Session):
+async def delete_sale(sale_id: int, db: _asyncio.AsyncSession):
     sale = await _sale_selector(sale_id, db)
 
-    db.delete(sale)
-    db.commit()
+    await db.delete(sale)
+    await db.commit()
 #---------------------------------purchase__________________________________
-async def _purchase_selector(purchase_id: int, db: _orm.Session):
-    purchase = (
-        db.query(_models.Purchase)
-        .filter(_models.Purchase.id ==purchase_id)
-        .first()
+async def _purchase_selector(purchase_id: int, db: _asyncio.AsyncSession):
+    result = await db.execute(
+        _sql.select(_models.Purchase).filter(_models.Purchase.id ==purchase_id)
     )
+    purchase = result.scalars().first()
 
     if purchase is None:
         raise _fastapi.HTTPException(status_code=404, detail="Purchase record does not exist")
@@ -254,53 +1207,62 @@ async def _purchase_selector(purchase_id: int, db: _orm.Session):
     return purchase
 
 
-async def create_purchase(db: _orm.Session, purchase: _schemas.PurchaseCreate):
+async def create_purchase(db: _asyncio.AsyncSession, purchase: _schemas.PurchaseCreate):
     purchase = _models.Purchase(**purchase.dict())
     db.add(purchase)
-    db.commit()
-    db.refresh(purchase)
+    await db.commit()
+    await db.refresh(purchase)
     return _schemas.Purchase.from_orm(purchase)
 
-async def get_purchases(db: _orm.Session):
-    purchases = db.query(_models.Purchase)
+async def get_purchases(
+    db: _asyncio.AsyncSession,
+    page: _schemas.PageParams,
+    filters: _schemas.PurchaseFilter,
+    include_archived: bool = False,
+):
+    archives = await _archive_tables(db, _models.Purchase, filters) if include_archived else ()
+    return await _json_page(db, _models.Purchase, _schemas.Purchase, page, filters, archives)
 
-    return list(map(_schemas.Purchase.from_orm, purchases))
 
+def export_purchases(
+    db: _asyncio.AsyncSession, fmt: str, filters: _schemas.PurchaseFilter, include_archived: bool = False
+):
+    return _export(db, _models.Purchase, _schemas.Purchase, fmt, filters, include_archived)
 
-async def get_purchase(purchase_id: int,  db: _orm.Session):
-    purchase = await _purchase_selector(purchase_id=purchase_id, db=db)
 
-    return _schemas.Purchase.from_orm(purchase)
+async def get_purchase(purchase_id: int,  db: _asyncio.AsyncSession, include_archived: bool = False):
+    try:
+        purchase = await _purchase_selector(purchase_id=purchase_id, db=db)
+    except _fastapi.HTTPException as missing:
+        if not include_archived:
+            raise
+        return await _archived_row(db, _models.Purchase, _schemas.Purchase, purchase_id, missing)
 
+    return _schemas.Purchase.from_orm(purchase)
 
-async def update_purchase(purchase_id: int, purchase: _schemas.PurchaseCreate, db: _orm.Session):
-    purchase_db = await _purchase_selector(purchase_id, db)
 
-    purchase_db.customer_id = purchase.customer_id
-    purchase_db.customername = purchase.customername
-    purchase_db.milk_type = purchase.milk_type
-    purchase_db.lit = purchase.lit
-    purchase_db.amount = purchase.amount
-    purchase_db.is_paid = purchase.is_paid
-    db.commit()
-    db.refresh(purchase_db)
+async def update_purchase(purchase_id: int, purchase, db: _asyncio.AsyncSession):
+    row = await _update_returning(
+        db, _models.Purchase, purchase_id, purchase.dict(exclude_unset=True), "Purchase record does not exist"
+    )
+    response = _schemas.Purchase.parse_obj(row)
+    await db.commit()
 
-    return _schemas.Purchase.from_orm(purchase_db)
+    return response
 
 
-async def delete_purchase(purchase_id: int, db: _orm.Session):
+async def delete_purchase(purchase_id: int, db: _asyncio.AsyncSession):
     purchase = await _purchase_selector(purchase_id, db)
 
-    db.delete(purchase)
-    db.commit()
+    await db.delete(purchase)
+    await db.commit()
 
 #-----------------------------------------EXPENSES--------------------------------------
-async def _expense_selector(expense_id: int, db: _orm.Session):
-    expense = (
-        db.query(_models.Expense)
-        .filter(_models.Expense.id == expense_id)
-        .first()
+async def _expense_selector(expense_id: int, db: _asyncio.AsyncSession):
+    result = await db.execute(
+        _sql.select(_models.Expense).filter(_models.Expense.id == expense_id)
     )
+    expense = result.scalars().first()
 
     if expense is None:
         raise _fastapi.HTTPException(status_code=404, detail="Expense record does not exist")
@@ -308,39 +1270,1259 @@ async def _expense_selector(expense_id: int, db: _orm.Session):
     return expense
 
 
-async def create_expense(db: _orm.Session, expense: _schemas.ExpenseCreate):
+async def create_expense(db: _asyncio.AsyncSession, expense: _schemas.ExpenseCreate):
     expense = _models.Expense(**expense.dict())
     db.add(expense)
-    db.commit()
-    db.refresh(expense)
+    await db.commit()
+    await db.refresh(expense)
     return _schemas.Expense.from_orm(expense)
 
-async def get_expenses(db: _orm.Session):
-    expenses = db.query(_models.Expense)
+async def get_expenses(
+    db: _asyncio.AsyncSession,
+    page: _schemas.PageParams,
+    filters: _schemas.ExpenseFilter,
+):
+    return await _json_page(db, _models.Expense, _schemas.Expense, page, filters)
+
 
-    return list(map(_schemas.Expense.from_orm, expenses))
+def export_expenses(db: _asyncio.AsyncSession, fmt: str, filters: _schemas.ExpenseFilter):
+    return _export(db, _models.Expense, _schemas.Expense, fmt, filters)
 
 
-async def get_expense(expense_id: int,  db: _orm.Session):
+async def get_expense(expense_id: int,  db: _asyncio.AsyncSession):
     expense = await _expense_selector(expense_id=expense_id, db=db)
 
     return _schemas.Expense.from_orm(expense)
 
 
-async def update_expense(expense_id: int, expense: _schemas.ExpenseCreate, db: _orm.Session):
-    expense_db = await _expense_selector(expense_id, db)
-
-    expense_db.customer_id = expense.customer_id
-    expense_db.remark = expense.remark
-    expense_db.amount = expense.amount
-    db.commit()
-    db.refresh(expense_db)
+async def update_expense(expense_id: int, expense, db: _asyncio.AsyncSession):
+    row = await _update_returning(
+        db, _models.Expense, expense_id, expense.dict(exclude_unset=True), "Expense record does not exist"
+    )
+    response = _schemas.Expense.parse_obj(row)
+    await db.commit()
 
-    return _schemas.Expense.from_orm(expense_db)
+    return response
 
 
-async def delete_expense(expense_id: int, db: _orm.Session):
+async def delete_expense(expense_id: int, db: _asyncio.AsyncSession):
     expense = await _expense_selector(expense_id, db)
 
-    db.delete(expense)
-    db.commit()
\ No newline at end of file
+    await db.delete(expense)
+    await db.commit()
+
+#-----------------------------------------SETTLEMENTS--------------------------------------
+async def _settlement_by_key(db: _asyncio.AsyncSession, idempotency_key: str):
+    result = await db.execute(
+        _sql.select(_models.Settlement).filter(_models.Settlement.idempotency_key == idempotency_key)
+    )
+    return result.scalars().first()
+
+
+def _replay_settlement(existing: _models.Settlement, ledger: str, settlement):
+    requested = dict(settlement.dict(), ledger=ledger)
+    if any(getattr(existing, field) != value for field, value in requested.items()):
+        raise _fastapi.HTTPException(
+            status_code=409, detail="Idempotency-Key was already used for a different settlement"
+        )
+    return _schemas.Settlement.from_orm(existing)
+
+
+async def _settle(
+    db: _asyncio.AsyncSession, model, ledger: str, settlement, idempotency_key, columns=(), group_by=()
+):
+    """Mark every unpaid row of ``model`` matching ``settlement`` as paid.
+
+    The rows are totalled in SQL, per ``group_by`` for whatever the caller
+    keeps in step with them (``columns`` adds to what is selected), then
+    flipped with a single UPDATE; the settlement is recorded in the same
+    transaction. Returns the totals (entries, liters, amount) and the
+    settlement, or a stored settlement and no totals when ``idempotency_key``
+    has been seen before.
+    """
+    if idempotency_key is not None:
+        existing = await _settlement_by_key(db, idempotency_key)
+        if existing is not None:
+            return None, _replay_settlement(existing, ledger, settlement)
+
+    unpaid = model.is_paid.isnot(_sql.true())
+    query = _sql.select(
+        *columns,
+        _sql.func.count(model.id).label("entries"),
+        _sql.func.coalesce(_sql.func.sum(model.lit), 0).label("liters"),
+        _sql.func.coalesce(_sql.func.sum(model.amount), 0).label("amount"),
+    )
+    query = _apply_filters(query, model, settlement).filter(unpaid)
+    if group_by:
+        query = query.group_by(*group_by)
+    totals = (await db.execute(query)).mappings().all()
+    entries = sum(row["entries"] for row in totals)
+
+    update = (
+        _apply_filters(_sql.update(model), model, settlement)
+        .filter(unpaid)
+        .values(is_paid=True, date_last_updated=_dt.datetime.utcnow())
+        .execution_options(synchronize_session=False)
+    )
+    result = await db.execute(update)
+    if result.rowcount != entries:
+        await db.rollback()
+        raise _fastapi.HTTPException(status_code=409, detail="Ledger changed while settling, try again")
+
+    record = _models.Settlement(
+        ledger=ledger,
+        idempotency_key=idempotency_key,
+        entries=entries,
+        liters=sum(_models.to_decimal(row["liters"]) for row in totals),
+        amount=sum(_models.to_decimal(row["amount"]) for row in totals),
+        **settlement.dict(),
+    )
+    db.add(record)
+    return totals, record
+
+
+async def _commit_settlement(db: _asyncio.AsyncSession, ledger: str, settlement, idempotency_key, record):
+    try:
+        await db.commit()
+    except _sql.exc.IntegrityError:
+        # A concurrent request with the same key committed first.
+        await db.rollback()
+        existing = await _settlement_by_key(db, idempotency_key)
+        if existing is None:
+            raise
+        return _replay_settlement(existing, ledger, settlement), True
+    return _schemas.Settlement.from_orm(record), False
+
+
+async def settle_milks(
+    db: _asyncio.AsyncSession, settlement: _schemas.MilkSettlementCreate, idempotency_key: Optional[str] = None
+):
+    """Mark a customer's unpaid milk entries for a period as paid.
+
+    Returns the settlement and whether it was replayed for a repeated
+    ``idempotency_key``. The rollups' unpaid counters move with the rows.
+    """
+    milk = _models.Milk
+    # Grouped as in milk_daily, constants inline as in _rollup_ledger_range.
+    keys = [
+        _sql.func.coalesce(milk.customer_id, _sql.literal_column("0")).label("customer_id"),
+        _sql.func.date(_database.local_timestamp(milk.date_created), type_=_sql.Date).label("day"),
+        _sql.func.coalesce(milk.milk_type, _sql.literal_column("''")).label("milk_type"),
+    ]
+    columns = [*keys, _sql.func.max(milk.customer_name).label("customer_name")]
+    totals, record = await _settle(db, milk, "milk", settlement, idempotency_key, columns=columns, group_by=keys)
+    if totals is None:
+        return record, True
+
+    # Paying takes the rows off the unpaid counters and nothing else.
+    deltas = []
+    for row in totals:
+        delta = dict(row, **{column: 0 for column in _ROLLUP_SUMS})
+        delta["unpaid_entries"] = -row["entries"]
+        delta["unpaid_liters"] = -_models.to_decimal(row["liters"])
+        delta["unpaid_amount"] = -_models.to_decimal(row["amount"])
+        deltas.append(delta)
+    await _apply_milk_rollups(db, deltas)
+
+    result = await _commit_settlement(db, "milk", settlement, idempotency_key, record)
+    if record.entries:
+        # One tag for every single-row response, however many rows were paid.
+        await _cache.invalidate("milks", "milk-rows")
+    return result
+
+
+async def _settle_trades(db: _asyncio.AsyncSession, model, ledger: str, settlement, idempotency_key):
+    totals, record = await _settle(db, model, ledger, settlement, idempotency_key)
+    if totals is None:
+        return record, True
+    return await _commit_settlement(db, ledger, settlement, idempotency_key, record)
+
+
+async def settle_sales(
+    db: _asyncio.AsyncSession, settlement: _schemas.LedgerSettlementCreate, idempotency_key: Optional[str] = None
+):
+    return await _settle_trades(db, _models.Sale, "sale", settlement, idempotency_key)
+
+
+async def settle_purchases(
+    db: _asyncio.AsyncSession, settlement: _schemas.LedgerSettlementCreate, idempotency_key: Optional[str] = None
+):
+    return await _settle_trades(db, _models.Purchase, "purchase", settlement, idempotency_key)
+
+
+async def get_settlements(db: _asyncio.AsyncSession, page: _schemas.PageParams):
+    return await _json_page(db, _models.Settlement, _schemas.Settlement, page)
+
+
+#-----------------------------------------REPORTS--------------------------------------
+def _shift(date_created):
+    """Morning or evening, by the hour on the dairy's clock."""
+    # Constants inline, so PostgreSQL sees the same expression in GROUP BY.
+    morning_ends = _config.settings.morning_shift_ends
+    return _sql.case(
+        (
+            _sql.extract("hour", _database.local_timestamp(date_created)) < _sql.literal_column(str(morning_ends)),
+            _sql.literal_column("'morning'"),
+        ),
+        else_=_sql.literal_column("'evening'"),
+    )
+
+
+def _report_dimensions(model):
+    """Map each report grouping to its (selected columns, GROUP BY columns)."""
+    shift = _shift(model.date_created).label("shift")
+    day = _sql.func.date(_database.local_timestamp(model.date_created)).label("day")
+
+    if model is _models.Milk:
+        customer = (
+            [model.customer_id, _sql.func.max(model.customer_name).label("customer_name")],
+            [model.customer_id],
+        )
+    else:
+        customer_name = model.customername.label("customer_name")
+        customer = ([customer_name], [model.customername])
+
+    return {
+        _schemas.ReportGroup.customer: customer,
+        _schemas.ReportGroup.day: ([day], [day]),
+        _schemas.ReportGroup.shift: ([shift], [shift]),
+        _schemas.ReportGroup.milk_type: ([model.milk_type], [model.milk_type]),
+    }
+
+
+async def _grouped_report(db: _asyncio.AsyncSession, model, group_by, filters):
+    """Liters and amount per group, computed by one GROUP BY query."""
+    if model in _models.ARCHIVED_LEDGERS and await _archive_years(db, model, filters):
+        return await _archived_report(db, model, group_by, filters)
+
+    dimensions = _report_dimensions(model)
+    columns = []
+    groups = []
+    for group in dict.fromkeys(group_by):
+        selected, grouped = dimensions[group]
+        columns.extend(selected)
+        groups.extend(grouped)
+
+    columns.extend(
+        [
+            _sql.func.count(model.id).label("entries"),
+            _sql.func.coalesce(_sql.func.sum(model.lit), 0).label("liters"),
+            _sql.func.coalesce(_sql.func.sum(model.amount), 0).label("amount"),
+        ]
+    )
+    if model is _models.Milk:
+        tested_fat = _sql.case((model.fat.isnot(None), model.lit))
+        tested_snf = _sql.case((model.snf.isnot(None), model.lit))
+        columns.extend(
+            [
+                _average(_sql.func.sum(model.lit * model.fat), _sql.func.sum(tested_fat), "avg_fat"),
+                _average(_sql.func.sum(model.lit * model.snf), _sql.func.sum(tested_snf), "avg_snf"),
+            ]
+        )
+
+    query = _apply_filters(_sql.select(*columns), model, filters)
+    result = await db.execute(query.group_by(*groups).order_by(*groups))
+
+    return list(map(_schemas.ReportRow.from_orm, result))
+
+
+def _archive_dimensions(model):
+    """``_report_dimensions`` over the ``archive_daily`` totals of ``model``."""
+    daily = _models.ArchiveDaily
+    customer_name = _sql.func.nullif(daily.customer_name, "")
+    if model is _models.Milk:
+        customer = (
+            [daily.customer_id, _sql.func.max(customer_name).label("customer_name")],
+            [daily.customer_id],
+        )
+    else:
+        customer = ([customer_name.label("customer_name")], [daily.customer_name])
+
+    return {
+        _schemas.ReportGroup.customer: customer,
+        _schemas.ReportGroup.day: ([daily.day], [daily.day]),
+        _schemas.ReportGroup.shift: ([daily.shift], [daily.shift]),
+        _schemas.ReportGroup.milk_type: (
+            [_sql.func.nullif(daily.milk_type, "").label("milk_type")],
+            [daily.milk_type],
+        ),
+    }
+
+
+def _archive_filters(query, model, filters):
+    daily = _models.ArchiveDaily
+    query = query.filter(daily.ledger == model.__tablename__)
+    if filters.date_from is not None:
+        query = query.filter(daily.day >= filters.date_from)
+    if filters.date_to is not None:
+        query = query.filter(daily.day <= filters.date_to)
+    if filters.milk_type is not None:
+        query = query.filter(daily.milk_type == filters.milk_type)
+    if getattr(filters, "customer_id", None) is not None:
+        query = query.filter(daily.customer_id == filters.customer_id)
+    if getattr(filters, "customername", None) is not None:
+        query = query.filter(daily.customer_name == filters.customername)
+    return query
+
+
+async def _archived_report(db: _asyncio.AsyncSession, model, group_by, filters):
+    """``_grouped_report`` for a period that reaches archived rows.
+
+    The hot rows and the ``archive_daily`` totals are grouped separately
+    into the same columns, then added up per group, so the archive files
+    themselves are never opened. Averages are recomputed from the summed
+    liter-weighted readings.
+    """
+    daily = _models.ArchiveDaily
+    hot_dimensions = _report_dimensions(model)
+    archive_dimensions = _archive_dimensions(model)
+    hot_columns, hot_groups, archive_columns, archive_groups = [], [], [], []
+    for group in dict.fromkeys(group_by):
+        selected, grouped = hot_dimensions[group]
+        hot_columns.extend(selected)
+        hot_groups.extend(grouped)
+        selected, grouped = archive_dimensions[group]
+        archive_columns.extend(selected)
+        archive_groups.extend(grouped)
+
+    hot_columns.extend(
+        [
+            _sql.func.count(model.id).label("entries"),
+            _sql.func.coalesce(_sql.func.sum(model.lit), 0).label("liters"),
+            _sql.func.coalesce(_sql.func.sum(model.amount), 0).label("amount"),
+        ]
+    )
+    archive_columns.extend(
+        [
+            _sql.func.sum(daily.entries).label("entries"),
+            _sql.func.sum(daily.liters).label("liters"),
+            _sql.func.sum(daily.amount).label("amount"),
+        ]
+    )
+    if model is _models.Milk:
+        tested_fat = _sql.case((model.fat.isnot(None), model.lit))
+        tested_snf = _sql.case((model.snf.isnot(None), model.lit))
+        hot_columns.extend(
+            [
+                _sql.func.sum(model.lit * model.fat).label("fat_weighted"),
+                _sql.func.sum(tested_fat).label("fat_liters"),
+                _sql.func.sum(model.lit * model.snf).label("snf_weighted"),
+                _sql.func.sum(tested_snf).label("snf_liters"),
+            ]
+        )
+        archive_columns.extend(
+            _sql.func.sum(getattr(daily, name)).label(name)
+            for name in ("fat_weighted", "fat_liters", "snf_weighted", "snf_liters")
+        )
+
+    hot = _apply_filters(_sql.select(*hot_columns), model, filters).group_by(*hot_groups)
+    archived = _archive_filters(_sql.select(*archive_columns), model, filters).group_by(*archive_groups)
+    both = _sql.union_all(hot, archived).subquery()
+
+    columns = []
+    groups = []
+    for group in dict.fromkeys(group_by):
+        if group is _schemas.ReportGroup.customer and model is _models.Milk:
+            columns.extend([both.c.customer_id, _sql.func.max(both.c.customer_name).label("customer_name")])
+            groups.append(both.c.customer_id)
+        else:
+            name = "customer_name" if group is _schemas.ReportGroup.customer else group.value
+            columns.append(both.c[name])
+            groups.append(both.c[name])
+    columns.extend(
+        [
+            _sql.func.sum(both.c.entries).label("entries"),
+            _sql.func.sum(both.c.liters).label("liters"),
+            _sql.func.sum(both.c.amount).label("amount"),
+        ]
+    )
+    if model is _models.Milk:
+        columns.extend(
+            [
+                _average(_sql.func.sum(both.c.fat_weighted), _sql.func.sum(both.c.fat_liters), "avg_fat"),
+                _average(_sql.func.sum(both.c.snf_weighted), _sql.func.sum(both.c.snf_liters), "avg_snf"),
+            ]
+        )
+
+    result = await db.execute(_sql.select(*columns).group_by(*groups).order_by(*groups))
+
+    return list(map(_schemas.ReportRow.from_orm, result))
+
+
+def _average(weighted, liters, label: str):
+    # Whole-number sums come back from SQLite as integers; divide as floats.
+    return _sql.type_coerce(
+        _sql.cast(weighted, _sql.Float) / _sql.func.nullif(liters, 0),
+        _models.LedgerNumber(5, 2),
+    ).label(label)
+
+
+def _rollup_filters(query, filters: _schemas.MilkFilter):
+    daily = _models.MilkDaily
+    if filters.customer_id is not None:
+        query = query.filter(daily.customer_id == filters.customer_id)
+    if filters.milk_type is not None:
+        query = query.filter(daily.milk_type == filters.milk_type)
+    if filters.date_from is not None:
+        query = query.filter(daily.day >= filters.date_from)
+    if filters.date_to is not None:
+        query = query.filter(daily.day <= filters.date_to)
+    return query
+
+
+async def _rollup_report(db: _asyncio.AsyncSession, group_by, filters: _schemas.MilkFilter, unpaid=False):
+    """The milk report read from ``milk_daily`` instead of the ledger.
+
+    With ``unpaid`` the unpaid counters are summed, which is how outstanding
+    dues are answered without touching ``milk``.
+    """
+    daily = _models.MilkDaily
+    milk_type = _sql.func.nullif(daily.milk_type, "").label("milk_type")
+    dimensions = {
+        _schemas.ReportGroup.customer: (
+            [daily.customer_id, _sql.func.max(daily.customer_name).label("customer_name")],
+            [daily.customer_id],
+        ),
+        _schemas.ReportGroup.day: ([daily.day], [daily.day]),
+        _schemas.ReportGroup.milk_type: ([milk_type], [daily.milk_type]),
+    }
+    columns = []
+    groups = []
+    for group in dict.fromkeys(group_by):
+        selected, grouped = dimensions[group]
+        columns.extend(selected)
+        groups.extend(grouped)
+
+    if unpaid:
+        entries = _sql.func.sum(daily.unpaid_entries)
+        columns.extend(
+            [
+                entries.label("entries"),
+                _sql.func.sum(daily.unpaid_liters).label("liters"),
+                _sql.func.sum(daily.unpaid_amount).label("amount"),
+            ]
+        )
+    else:
+        entries = _sql.func.sum(daily.entries)
+        columns.extend(
+            [
+                entries.label("entries"),
+                _sql.func.sum(daily.liters).label("liters"),
+                _sql.func.sum(daily.amount).label("amount"),
+                _average(_sql.func.sum(daily.fat_weighted), _sql.func.sum(daily.fat_liters), "avg_fat"),
+                _average(_sql.func.sum(daily.snf_weighted), _sql.func.sum(daily.snf_liters), "avg_snf"),
+            ]
+        )
+
+    query = _rollup_filters(_sql.select(*columns), filters)
+    result = await db.execute(query.group_by(*groups).having(entries > 0).order_by(*groups))
+
+    return list(map(_schemas.ReportRow.from_orm, result))
+
+
+async def get_milk_report(db: _asyncio.AsyncSession, group_by, filters: _schemas.MilkFilter):
+    if _schemas.ReportGroup.shift in group_by or filters.is_paid is not None:
+        return await _grouped_report(db, _models.Milk, group_by, filters)
+    return await _rollup_report(db, group_by, filters)
+
+
+async def get_sale_report(db: _asyncio.AsyncSession, group_by, filters: _schemas.SaleFilter):
+    return await _grouped_report(db, _models.Sale, group_by, filters)
+
+
+async def get_purchase_report(db: _asyncio.AsyncSession, group_by, filters: _schemas.PurchaseFilter):
+    return await _grouped_report(db, _models.Purchase, group_by, filters)
+
+
+async def get_dues(db: _asyncio.AsyncSession, period: _schemas.ReportPeriod):
+    """Unpaid amounts per customer on each side of the ledger."""
+    by_customer = [_schemas.ReportGroup.customer]
+    unpaid = dict(period.dict(), is_paid="No")
+
+    return _schemas.Dues(
+        milks=await _rollup_report(db, by_customer, _schemas.MilkFilter(**period.dict()), unpaid=True),
+        sales=await _grouped_report(db, _models.Sale, by_customer, _schemas.SaleFilter(**unpaid)),
+        purchases=await _grouped_report(
+            db, _models.Purchase, by_customer, _schemas.PurchaseFilter(**unpaid)
+        ),
+    )
+
+
+def _total_amount(model, period: _schemas.ReportPeriod):
+    query = _sql.select(_sql.func.coalesce(_sql.func.sum(model.amount), 0))
+    if model is _models.MilkDaily:
+        query = _rollup_filters(query, _schemas.MilkFilter(**period.dict()))
+    else:
+        query = _apply_filters(query, model, period)
+    return query.scalar_subquery()
+
+
+def _archived_amount(model, period: _schemas.ReportPeriod):
+    daily = _models.ArchiveDaily
+    query = _sql.select(_sql.func.coalesce(_sql.func.sum(daily.amount), 0))
+    return _archive_filters(query, model, _schemas.SaleFilter(**period.dict())).scalar_subquery()
+
+
+async def get_profit_loss(db: _asyncio.AsyncSession, period: _schemas.ReportPeriod):
+    """Sales against milk collected, purchases and expenses in one statement.
+
+    Milk comes from ``milk_daily``, which still counts archived rows; sales
+    and purchases add their archived totals from ``archive_daily``.
+    """
+    sales = _total_amount(_models.Sale, period) + _archived_amount(_models.Sale, period)
+    milks = _total_amount(_models.MilkDaily, period)
+    purchases = _total_amount(_models.Purchase, period) + _archived_amount(_models.Purchase, period)
+    expenses = _total_amount(_models.Expense, period)
+
+    result = await db.execute(
+        _sql.select(
+            sales.label("sales"),
+            milks.label("milks"),
+            purchases.label("purchases"),
+            expenses.label("expenses"),
+            (sales - milks - purchases - expenses).label("profit"),
+        )
+    )
+    totals = result.one()
+
+    return _schemas.ProfitLoss.from_orm(totals)
+
+
+#-----------------------------------------ARCHIVE--------------------------------------
+def _archive_path(year: int):
+    return _os.path.join(_config.settings.archive_dir, f"{year}.db")
+
+
+async def _attach_archives(db: _asyncio.AsyncSession, years, create=False):
+    """Make the archives of ``years`` readable on ``db``'s connection.
+
+    On SQLite each year is a file attached under its schema name. Pooled
+    connections keep what they attached; other years are detached first,
+    since a connection holds at most ten. On PostgreSQL the schemas are in
+    the database already; ``create`` makes missing files and schemas.
+    """
+    schemas = {_models.archive_schema(year): year for year in years}
+    if _backend(db) != "sqlite":
+        for schema in schemas if create else ():
+            await db.execute(_sql.text(f'CREATE SCHEMA IF NOT EXISTS "{schema}"'))
+        return
+
+    attached = {row[1] for row in await db.execute(_sql.text("PRAGMA database_list"))}
+    for schema in attached - set(schemas):
+        if schema.startswith(_models.archive_schema("")):
+            await db.execute(_sql.text(f'DETACH DATABASE "{schema}"'))
+    if create:
+        _os.makedirs(_config.settings.archive_dir, exist_ok=True)
+    for schema, year in schemas.items():
+        if schema in attached:
+            continue
+        path = _archive_path(year)
+        if not create and not _os.path.exists(path):
+            raise _fastapi.HTTPException(status_code=503, detail=f"Archive for {year} is not available")
+        await db.execute(_sql.text(f'ATTACH DATABASE :path AS "{schema}"'), {"path": path})
+
+
+async def _archive_years(db: _asyncio.AsyncSession, model, filters=None):
+    """The years with archived ``model`` rows that ``filters`` can match."""
+    if filters is not None and getattr(filters, "is_paid", None) is not None:
+        if not _models.to_paid(filters.is_paid):
+            return []  # only paid rows are archived
+    partition = _models.ArchivePartition
+    query = _sql.select(partition.year).filter(partition.ledger == model.__tablename__, partition.rows > 0)
+    # Partitions go by the year of the stored (UTC) timestamp.
+    if filters is not None and filters.date_from is not None:
+        query = query.filter(partition.year >= _day_start(filters.date_from).year)
+    if filters is not None and filters.date_to is not None:
+        last = _day_start(filters.date_to + _dt.timedelta(days=1)) - _dt.timedelta(microseconds=1)
+        query = query.filter(partition.year <= last.year)
+    return list((await db.execute(query.order_by(partition.year))).scalars())
+
+
+async def _archive_tables(db: _asyncio.AsyncSession, model, filters=None):
+    """The archive tables of ``model`` that ``filters`` can match, attached."""
+    years = await _archive_years(db, model, filters)
+    await _attach_archives(db, years)
+    return [_models.archive_table(model, year) for year in years]
+
+
+async def _archived_row(db: _asyncio.AsyncSession, model, schema, row_id: int, missing):
+    """One archived row by id as ``schema``, or raise ``missing``."""
+    for table in await _archive_tables(db, model):
+        row = (await db.execute(_schema_query(table.c, schema).filter(table.c.id == row_id))).first()
+        if row is not None:
+            return schema.parse_obj(row._mapping)
+    raise missing
+
+
+async def _add_archive_totals(db: _asyncio.AsyncSession, model, rows):
+    """Add the totals of the ``model`` rows matching ``rows`` to ``archive_daily``."""
+    table = _models.ArchiveDaily.__table__
+    if model is _models.Milk:
+        customer_id = _sql.func.coalesce(model.customer_id, _sql.literal_column("0"))
+        customer_name = _sql.func.coalesce(model.customer_name, _sql.literal_column("''"))
+        tested_fat = _sql.case((model.fat.isnot(None), model.lit), else_=0)
+        tested_snf = _sql.case((model.snf.isnot(None), model.lit), else_=0)
+        readings = [
+            _sql.func.coalesce(_sql.func.sum(model.lit * model.fat), 0),
+            _sql.func.coalesce(_sql.func.sum(tested_fat), 0),
+            _sql.func.coalesce(_sql.func.sum(model.lit * model.snf), 0),
+            _sql.func.coalesce(_sql.func.sum(tested_snf), 0),
+        ]
+    else:
+        customer_id = _sql.literal_column("0")
+        customer_name = _sql.func.coalesce(model.customername, _sql.literal_column("''"))
+        readings = [_sql.literal_column("0")] * 4
+    day = _sql.func.date(_database.local_timestamp(model.date_created))
+    shift = _shift(model.date_created)
+    milk_type = _sql.func.coalesce(model.milk_type, _sql.literal_column("''"))
+    keys = [day, shift, customer_id, customer_name, milk_type]
+    # Not the constant customer id of sales and purchases: SQLite reads a
+    # bare number in GROUP BY as a column position.
+    groups = [key for key in keys if model is _models.Milk or key is not customer_id]
+
+    select = (
+        _sql.select(
+            _sql.literal_column(f"'{model.__tablename__}'"),
+            *keys,
+            _sql.func.count(model.id),
+            _sql.func.coalesce(_sql.func.sum(model.lit), 0),
+            _sql.func.coalesce(_sql.func.sum(model.amount), 0),
+            *readings,
+        )
+        .where(*rows)
+        .group_by(*groups)
+    )
+    sums = ["entries", "liters", "amount", "fat_weighted", "fat_liters", "snf_weighted", "snf_liters"]
+    upsert = _insert(db, table).from_select(
+        ["ledger", "day", "shift", "customer_id", "customer_name", "milk_type", *sums], select
+    )
+    upsert = upsert.on_conflict_do_update(
+        index_elements=[column for column in table.primary_key],
+        set_={column: table.c[column] + upsert.excluded[column] for column in sums},
+    )
+    await db.execute(upsert)
+
+
+async def _archive_ledger(db: _asyncio.AsyncSession, model, before: _dt.datetime, chunk_size: int):
+    ledger = model.__tablename__
+    last_id = (
+        await db.execute(_sql.select(_sql.func.max(model.id)).filter(model.date_created < before))
+    ).scalar() or 0
+    await db.commit()
+
+    year = _sql.extract("year", model.date_created)
+    created = set()
+    moved = 0
+    for start in range(0, last_id, chunk_size):
+        in_range = [
+            model.id > start,
+            model.id <= min(start + chunk_size, last_id),
+            model.is_paid.is_(_sql.true()),
+            model.date_created < before,
+        ]
+        counts = {
+            int(row_year): count
+            for row_year, count in await db.execute(
+                _sql.select(year, _sql.func.count()).filter(*in_range).group_by(year)
+            )
+        }
+        if not counts:
+            await db.commit()
+            continue
+        await _attach_archives(db, counts, create=True)
+        for row_year in counts.keys() - created:
+            table = _models.archive_table(model, row_year)
+            await db.run_sync(lambda session: table.create(session.connection(), checkfirst=True))
+            created.add(row_year)
+
+        if _backend(db) == "postgresql":
+            # Hold off writers to the ledger between reading the rows and
+            # deleting them. SQLite's first write below does the same.
+            await db.execute(_sql.text(f'LOCK TABLE "{ledger}" IN EXCLUSIVE MODE'))
+        rows = in_range + [year.in_(list(counts))]
+        await _add_archive_totals(db, model, rows)
+        columns = [column.name for column in model.__table__.columns]
+        for row_year in counts:
+            table = _models.archive_table(model, row_year)
+            copy = _insert(db, table).from_select(
+                columns, _sql.select(*model.__table__.columns).where(*in_range, year == row_year)
+            )
+            await db.execute(copy.on_conflict_do_nothing())
+        await db.execute(_sql.delete(model.__table__).where(*rows))
+
+        partition = _models.ArchivePartition.__table__
+        upsert = _insert(db, partition)
+        upsert = upsert.on_conflict_do_update(
+            index_elements=[partition.c.ledger, partition.c.year],
+            set_={"rows": partition.c.rows + upsert.excluded.rows},
+        )
+        await db.execute(
+            upsert, [{"ledger": ledger, "year": row_year, "rows": count} for row_year, count in counts.items()]
+        )
+        await db.commit()
+        moved += sum(counts.values())
+
+    return moved
+
+
+async def archive_ledgers(
+    db: _asyncio.AsyncSession, before: Optional[_dt.date] = None, chunk_size: int = ARCHIVE_CHUNK_SIZE
+):
+    """Move paid milk, sale and purchase rows dated before ``before`` (by
+    default ``archive_after_days`` ago) out of the hot tables.
+
+    Rows go to the archive table of their year, one primary-key range at a
+    time. Each range's totals are added to ``archive_daily`` and the rows
+    deleted in the same transaction, so reports and ``milk_daily`` keep
+    counting them. On SQLite the archive file and the main database commit
+    separately; the copy skips rows already archived, so running again
+    after an interruption finishes the job. Returns the rows moved per
+    ledger.
+    """
+    if before is None:
+        before = _database.local_today() - _dt.timedelta(days=_config.settings.archive_after_days)
+    cutoff = _day_start(before)
+
+    moved = {}
+    for model in _models.ARCHIVED_LEDGERS:
+        moved[model.__tablename__] = await _archive_ledger(db, model, cutoff, chunk_size)
+    # Reaches a shared cache; API processes with their own cache have
+    # archive_watch.
+    await _cache.invalidate(*ARCHIVE_TAGS)
+    return moved
+
+
+async def _archived_rows():
+    async with _database.ReadSessionLocal() as db:
+        partition = _models.ArchivePartition
+        return (await db.execute(_sql.select(_sql.func.coalesce(_sql.func.sum(partition.rows), 0)))).scalar()
+
+
+# Archiving runs in python manage.py archive, so a per-process cache learns
+# of it from archive_partition, whose row counts only grow.
+ARCHIVE_TAGS = ("milks", "milk-rows")
+archive_watch = _cache.Watch(_archived_rows, ARCHIVE_TAGS, _config.settings.cache_watch_seconds)
+
+
+#-----------------------------------------SYNC--------------------------------------
+# What terminals sync, under the names used in responses, tokens and
+# tombstones.
+_SYNCED = {
+    "customers": (_models.Customer, _schemas.Customer),
+    "milks": (_models.Milk, _schemas.Milk),
+}
+
+
+async def _add_tombstone(db: _asyncio.AsyncSession, kind: str, row_id: int):
+    """Record a deleted row for ``get_sync_changes``, in the caller's
+    transaction, and forget the ones older than ``sync_tombstone_days``."""
+    tombstone = _models.SyncTombstone
+    now = _dt.datetime.utcnow()
+    await db.execute(_sql.insert(tombstone).values(kind=kind, row_id=row_id, date_deleted=now))
+    await db.execute(
+        _sql.delete(tombstone).where(
+            tombstone.date_deleted < now - _dt.timedelta(days=_config.settings.sync_tombstone_days)
+        )
+    )
+
+
+def _encode_sync_token(since, positions: dict):
+    token = _orjson.dumps({"since": since, **positions})
+    return _base64.urlsafe_b64encode(token).decode().rstrip("=")
+
+
+def _decode_sync_token(token: str):
+    try:
+        padded = token + "=" * (-len(token) % 4)
+        state = _orjson.loads(_base64.urlsafe_b64decode(padded))
+        since = _dt.date.fromisoformat(state["since"]) if state["since"] else None
+        positions = {
+            name: (_dt.datetime.fromisoformat(state[name][0]), int(state[name][1]))
+            for name in (*_SYNCED, "deleted")
+        }
+    except (ValueError, TypeError, KeyError, IndexError, _binascii.Error):
+        raise _fastapi.HTTPException(status_code=400, detail="Invalid sync token")
+    return since, positions
+
+
+async def _sync_rows(db: _asyncio.AsyncSession, model, schema, position, until, limit: int, since=None):
+    """Up to ``limit`` rows of ``model`` changed after ``position`` and
+    before ``until``, in (date_last_updated, id) order.
+
+    Returns the rows, the position to carry on from and whether the limit
+    cut them short. ``since`` keeps to rows created from that day on; a
+    row is never changed before it is created, so it also bounds the index
+    range walked.
+    """
+    changed = model.date_last_updated
+    query = _sql.select(*_schema_columns(model, schema)).where(changed < until)
+    if position is not None:
+        query = query.where(_sql.tuple_(changed, model.id) > tuple(position))
+    if since is not None:
+        start = _day_start(since)
+        query = query.where(changed >= start, model.date_created >= start)
+    rows = (await db.execute(query.order_by(changed, model.id).limit(limit + 1))).all()
+
+    if len(rows) > limit:
+        rows = rows[:limit]
+        return rows, (rows[-1].date_last_updated, rows[-1].id), True
+    # Everything before ``until`` has been sent.
+    return rows, (until, 0), False
+
+
+async def _sync_deletes(db: _asyncio.AsyncSession, position, until, limit: int):
+    """Like ``_sync_rows``, for the tombstones."""
+    tombstone = _models.SyncTombstone
+    # SQLite hands the highest id out again once its row is deleted, so a
+    # tombstone whose id is in use again is left out; the new row comes
+    # through as a change instead.
+    reused = _sql.or_(
+        *[
+            _sql.and_(tombstone.kind == kind, _sql.exists().where(model.id == tombstone.row_id))
+            for kind, (model, _) in _SYNCED.items()
+        ]
+    )
+    query = (
+        _sql.select(tombstone.id, tombstone.kind, tombstone.row_id, tombstone.date_deleted)
+        .where(
+            tombstone.date_deleted < until,
+            _sql.tuple_(tombstone.date_deleted, tombstone.id) > tuple(position),
+            ~reused,
+        )
+        .order_by(tombstone.date_deleted, tombstone.id)
+        .limit(limit + 1)
+    )
+    rows = (await db.execute(query)).all()
+
+    if len(rows) > limit:
+        rows = rows[:limit]
+        return rows, (rows[-1].date_deleted, rows[-1].id), True
+    return rows, (until, 0), False
+
+
+async def get_sync_changes(
+    db: _asyncio.AsyncSession,
+    token: Optional[str] = None,
+    since: Optional[_dt.date] = None,
+    limit: int = DEFAULT_SYNC_ROWS,
+):
+    """The customers and milk entries changed since ``token``, and the ids
+    of the ones deleted, encoded as compact JSON.
+
+    Without a token this is a terminal's first sync: every customer, and
+    the milk entries created from ``since`` on (all of them without it).
+    Each kind is walked on its own, at most ``limit`` rows per call, on the
+    (date_last_updated, id) indexes; rows come as value lists under one
+    list of column names. While ``more`` is true the terminal calls again
+    with the new token straight away. Changes younger than
+    ``sync_settle_seconds`` are left for the next sync, and a token older
+    than ``sync_tombstone_days`` is refused with a 410.
+    """
+    settings = _config.settings
+    now = _dt.datetime.utcnow()
+    until = now - _dt.timedelta(seconds=settings.sync_settle_seconds)
+    if token is None:
+        # Whatever was deleted before now is simply not in the first sync.
+        positions = dict.fromkeys(_SYNCED)
+        positions["deleted"] = (until, 0)
+    else:
+        since, positions = _decode_sync_token(token)
+        if positions["deleted"][0] < now - _dt.timedelta(days=settings.sync_tombstone_days):
+            raise _fastapi.HTTPException(status_code=410, detail="Sync token has expired, sync again without one")
+
+    changes = {}
+    more = False
+    for kind, (model, schema) in _SYNCED.items():
+        rows, positions[kind], cut = await _sync_rows(
+            db, model, schema, positions[kind], until, limit, since if model is _models.Milk else None
+        )
+        changes[kind] = {"columns": list(schema.__fields__), "rows": _row_lists(schema, rows)}
+        more = more or cut
+
+    tombstones, positions["deleted"], cut = await _sync_deletes(db, positions["deleted"], until, limit)
+    deleted = {kind: [] for kind in _SYNCED}
+    for tombstone in tombstones:
+        deleted[tombstone.kind].append(tombstone.row_id)
+
+    with _instrumentation.timed("serialize"):
+        return _orjson.dumps(
+            {
+                "token": _encode_sync_token(since, positions),
+                "more": more or cut,
+                **changes,
+                "deleted": deleted,
+            }
+        )
+
+
+async def _push_by_key(db: _asyncio.AsyncSession, idempotency_key: str):
+    result = await db.execute(
+        _sql.select(_models.SyncPush).filter(_models.SyncPush.idempotency_key == idempotency_key)
+    )
+    return result.scalars().first()
+
+
+def _replay_push(existing: _models.SyncPush, digest: str):
+    if existing.digest != digest:
+        raise _fastapi.HTTPException(
+            status_code=409, detail="Idempotency-Key was already used for a different push"
+        )
+    return _schemas.BulkResult.parse_raw(existing.result)
+
+
+async def push_milks(db: _asyncio.AsyncSession, records: list, idempotency_key: Optional[str] = None):
+    """Insert a batch of milk entries a terminal recorded while offline.
+
+    Works like ``create_milks_bulk``, except that each entry may carry the
+    ``date_created`` it was taken at, and that a push repeated with the
+    same ``idempotency_key`` gets the first push's result back instead of
+    inserting again. Returns the result and whether it was replayed.
+    """
+    body = _json.dumps(records, sort_keys=True, separators=(",", ":")).encode()
+    digest = _hashlib.blake2b(body, digest_size=16).hexdigest()
+    if idempotency_key is not None:
+        existing = await _push_by_key(db, idempotency_key)
+        if existing is not None:
+            return _replay_push(existing, digest), True
+
+    try:
+        result = await _insert_milks(db, records, _schemas.MilkPush)
+        if idempotency_key is not None:
+            db.add(_models.SyncPush(idempotency_key=idempotency_key, digest=digest, result=result.json()))
+        await db.commit()
+    except _sql.exc.IntegrityError:
+        # A concurrent push with the same key committed first.
+        await db.rollback()
+        existing = await _push_by_key(db, idempotency_key) if idempotency_key is not None else None
+        if existing is None:
+            raise
+        return _replay_push(existing, digest), True
+    except:
+        await db.rollback()
+        raise
+    if result.inserted:
+        await _cache.invalidate("milks")
+
+    return result, False
+
+
+#-----------------------------------------JOBS--------------------------------------
+# Reports and exports run in the background by jobs.py. Each kind of job
+# is a route's query run with the same parameters, its result written to a
+# file in job_dir: reports as the route's JSON, exports in their format.
+JOB_MEDIA_TYPES = dict(EXPORT_MEDIA_TYPES, json="application/json")
+_FINISHED_JOBS = ("done", "failed", "cancelled")
+
+
+def _filters(schema, params):
+    return schema(**params.dict(include=set(schema.__fields__)))
+
+
+def _report_job(report, filter_schema):
+    async def write(db, params, out):
+        rows = await report(db, params.group_by, _filters(filter_schema, params))
+        out.write(_orjson.dumps([row.dict(exclude_none=True) for row in rows]))
+
+    return write
+
+
+def _period_job(report):
+    async def write(db, params, out):
+        result = await report(db, _filters(_schemas.ReportPeriod, params))
+        out.write(_orjson.dumps(result.dict(exclude_none=True)))
+
+    return write
+
+
+def _export_job(export, filter_schema=None):
+    async def write(db, params, out):
+        args = [db, params.format]
+        if filter_schema is not None:
+            args.append(_filters(filter_schema, params))
+        if "include_archived" in params.__fields__:
+            args.append(params.include_archived)
+        async for chunk in export(*args):
+            out.write(chunk.encode())
+
+    return write
+
+
+JOB_KINDS = {
+    _schemas.JobKind.milk_report: (_schemas.MilkReportJob, _report_job(get_milk_report, _schemas.MilkFilter)),
+    _schemas.JobKind.sale_report: (_schemas.SaleReportJob, _report_job(get_sale_report, _schemas.SaleFilter)),
+    _schemas.JobKind.purchase_report: (
+        _schemas.PurchaseReportJob,
+        _report_job(get_purchase_report, _schemas.PurchaseFilter),
+    ),
+    _schemas.JobKind.dues: (_schemas.PeriodJob, _period_job(get_dues)),
+    _schemas.JobKind.profit_loss: (_schemas.PeriodJob, _period_job(get_profit_loss)),
+    _schemas.JobKind.customer_export: (_schemas.CustomerExportJob, _export_job(export_customers)),
+    _schemas.JobKind.milk_export: (_schemas.MilkExportJob, _export_job(export_milks, _schemas.MilkFilter)),
+    _schemas.JobKind.sale_export: (_schemas.SaleExportJob, _export_job(export_sales, _schemas.SaleFilter)),
+    _schemas.JobKind.purchase_export: (
+        _schemas.PurchaseExportJob,
+        _export_job(export_purchases, _schemas.PurchaseFilter),
+    ),
+    _schemas.JobKind.expense_export: (
+        _schemas.ExpenseExportJob,
+        _export_job(export_expenses, _schemas.ExpenseFilter),
+    ),
+}
+
+
+def _job_format(job: _models.Job):
+    return _json.loads(job.params).get("format", "json")
+
+
+def _job_path(job: _models.Job):
+    return _os.path.join(_config.settings.job_dir, f"{job.id}.{_job_format(job)}")
+
+
+def _job_partial_path(job_id: int):
+    # Where a running job writes; renamed to its result when complete.
+    return _os.path.join(_config.settings.job_dir, f"{job_id}.part")
+
+
+def _remove_file(path: str):
+    try:
+        _os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+async def _job_selector(job_id: int, db: _asyncio.AsyncSession):
+    result = await db.execute(_sql.select(_models.Job).filter(_models.Job.id == job_id))
+    job = result.scalars().first()
+
+    if job is None:
+        raise _fastapi.HTTPException(status_code=404, detail="Job does not exist")
+
+    return job
+
+
+async def create_job(db: _asyncio.AsyncSession, job: _schemas.JobCreate):
+    """Queue a job, with its parameters checked now rather than when it runs."""
+    schema, _ = JOB_KINDS[job.kind]
+    try:
+        params = schema.parse_obj(job.params)
+    except _pydantic.ValidationError as invalid:
+        errors = [dict(error, loc=("body", "params", *error["loc"])) for error in invalid.errors()]
+        raise _fastapi.HTTPException(status_code=422, detail=errors)
+
+    queued = (
+        await db.execute(
+            _sql.select(_sql.func.count()).select_from(_models.Job).filter(_models.Job.status == "queued")
+        )
+    ).scalar()
+    if queued >= _config.settings.job_queue_limit:
+        raise _fastapi.HTTPException(
+            status_code=503,
+            detail="Too many jobs queued, try again later",
+            headers={"Retry-After": "60"},
+        )
+
+    job = _models.Job(
+        kind=job.kind.value,
+        params=params.json(exclude_none=True),
+        status="queued",
+        cancel_requested=False,
+    )
+    db.add(job)
+    await db.commit()
+    await db.refresh(job)
+    return _schemas.Job.from_orm(job)
+
+
+async def get_job(db: _asyncio.AsyncSession, job_id: int):
+    return _schemas.Job.from_orm(await _job_selector(job_id, db))
+
+
+async def cancel_job(db: _asyncio.AsyncSession, job_id: int):
+    """Cancel a queued job at once, or ask the worker to stop a running one.
+
+    Both are conditional updates, so a job that moved on meanwhile is
+    looked at again in its new state.
+    """
+    job = await _job_selector(job_id, db)
+    table = _models.Job
+    if job.status == "queued":
+        values = dict(status="cancelled", cancel_requested=True, date_finished=_dt.datetime.utcnow())
+    elif job.status == "running":
+        values = dict(cancel_requested=True)
+    else:
+        raise _fastapi.HTTPException(status_code=409, detail=f"Job is already {job.status}")
+
+    result = await db.execute(
+        _sql.update(table).where(table.id == job_id, table.status == job.status).values(**values)
+    )
+    await db.commit()
+    if not result.rowcount:
+        return await cancel_job(db, job_id)
+    await db.refresh(job)
+    return _schemas.Job.from_orm(job)
+
+
+async def get_job_result(db: _asyncio.AsyncSession, job_id: int):
+    """The result file of a finished job, as (path, media type, filename)."""
+    job = await _job_selector(job_id, db)
+    if job.status != "done":
+        raise _fastapi.HTTPException(status_code=409, detail=f"Job is {job.status}")
+
+    path = _job_path(job)
+    if not _os.path.exists(path):
+        raise _fastapi.HTTPException(status_code=404, detail="Job result is no longer available")
+    fmt = _job_format(job)
+    return path, JOB_MEDIA_TYPES[fmt], f"{job.kind}-{job.id}.{fmt}"
+
+
+async def claim_jobs(db: _asyncio.AsyncSession, limit: int, worker: str):
+    """Mark up to ``limit`` queued jobs, oldest first, as running on
+    ``worker`` and return their ids.
+
+    One ``UPDATE ... RETURNING`` that rechecks the status, so two workers
+    never claim the same job.
+    """
+    statement = _sql.text(
+        "UPDATE job SET status = 'running', worker = :worker, date_started = :now "
+        "WHERE status = 'queued' AND id IN "
+        "(SELECT id FROM job WHERE status = 'queued' ORDER BY id LIMIT :limit) "
+        "RETURNING id"
+    ).bindparams(_sql.bindparam("now", type_=_models.Job.date_started.type))
+    result = await db.execute(statement, dict(worker=worker, now=_dt.datetime.utcnow(), limit=limit))
+    claimed = sorted(result.scalars().all())
+    await db.commit()
+    return claimed
+
+
+async def run_job(db: _asyncio.AsyncSession, job_id: int, read_db: Optional[_asyncio.AsyncSession] = None):
+    """Run a claimed job and record how it ended.
+
+    The query runs on ``read_db`` (default ``db``) and its result goes to a
+    partial file, renamed into place once complete. The outcome is recorded
+    only if the job is still running, not cancelled or requeued meanwhile.
+    A failed job keeps its error and the exception is raised again.
+    """
+    job = await _job_selector(job_id, db)
+    schema, write = JOB_KINDS[_schemas.JobKind(job.kind)]
+    params = schema.parse_raw(job.params)
+    path = _job_path(job)
+    # The query can take minutes; no transaction stays open on db meanwhile.
+    await db.commit()
+
+    partial = _job_partial_path(job_id)
+    failure = None
+    try:
+        _os.makedirs(_config.settings.job_dir, exist_ok=True)
+        with open(partial, "wb") as out:
+            await write(read_db or db, params, out)
+        await (read_db or db).rollback()
+        _os.replace(partial, path)
+        values = dict(status="done", result_size=_os.path.getsize(path))
+    except Exception as error:
+        failure = error
+        await (read_db or db).rollback()
+        _remove_file(partial)
+        detail = error.detail if isinstance(error, _fastapi.HTTPException) else f"{type(error).__name__}: {error}"
+        values = dict(status="failed", error=str(detail)[:1000])
+
+    table = _models.Job
+    result = await db.execute(
+        _sql.update(table)
+        .where(table.id == job_id, table.status == "running")
+        .values(date_finished=_dt.datetime.utcnow(), **values)
+    )
+    await db.commit()
+    if not result.rowcount:
+        _remove_file(path)
+    if failure is not None:
+        raise failure
+    return values["status"]
+
+
+async def cancel_requested_jobs(db: _asyncio.AsyncSession, job_ids):
+    """Those of ``job_ids`` that are running and asked to stop."""
+    if not job_ids:
+        return []
+    table = _models.Job
+    result = await db.execute(
+        _sql.select(table.id).filter(
+            table.id.in_(job_ids), table.status == "running", table.cancel_requested.is_(True)
+        )
+    )
+    return result.scalars().all()
+
+
+async def finish_job(db: _asyncio.AsyncSession, job_id: int, status: str, error: Optional[str] = None):
+    """Record the end of a job whose process stopped without doing so:
+    cancelled, or crashed."""
+    table = _models.Job
+    await db.execute(
+        _sql.update(table)
+        .where(table.id == job_id, table.status == "running")
+        .values(status=status, error=error, date_finished=_dt.datetime.utcnow())
+    )
+    await db.commit()
+    _remove_file(_job_partial_path(job_id))
+
+
+async def requeue_jobs(db: _asyncio.AsyncSession, job_ids):
+    """Put running jobs back in the queue, to start over, when their worker
+    stops or has died."""
+    if not job_ids:
+        return 0
+    table = _models.Job
+    result = await db.execute(
+        _sql.update(table)
+        .where(table.id.in_(job_ids), table.status == "running")
+        .values(status="queued", worker=None, date_started=None)
+    )
+    await db.commit()
+    for job_id in job_ids:
+        _remove_file(_job_partial_path(job_id))
+    return result.rowcount
+
+
+async def recover_jobs(db: _asyncio.AsyncSession, alive):
+    """Requeue the running jobs whose worker, by ``alive(worker)``, is gone."""
+    table = _models.Job
+    result = await db.execute(_sql.select(table.id, table.worker).filter(table.status == "running"))
+    orphans = [job_id for job_id, worker in result.all() if not alive(worker)]
+    return await requeue_jobs(db, orphans)
+
+
+async def prune_jobs(db: _asyncio.AsyncSession):
+    """Delete jobs, and their results, finished more than
+    ``job_retention_days`` ago."""
+    table = _models.Job
+    cutoff = _dt.datetime.utcnow() - _dt.timedelta(days=_config.settings.job_retention_days)
+    result = await db.execute(
+        _sql.select(table).filter(table.status.in_(_FINISHED_JOBS), table.date_finished < cutoff)
+    )
+    jobs = result.scalars().all()
+    for job in jobs:
+        _remove_file(_job_path(job))
+    if jobs:
+        await db.execute(_sql.delete(table).where(table.id.in_([job.id for job in jobs])))
+    await db.commit()
+    return len(jobs)
+
+
+#-----------------------------------------RATES--------------------------------------
+async def get_rate_chart():
+    chart = _rates.charts.current()
+    if chart is None:
+        raise _fastapi.HTTPException(status_code=404, detail="No rate chart is loaded")
+    return _schemas.RateChart(
+        version=chart.version,
+        date_loaded=chart.date_loaded,
+        milk_types={
+            milk_type: _schemas.RateTable(
+                fat_min=table.fat_min,
+                fat_max=table.fat_max,
+                snf_min=table.snf_min,
+                snf_max=table.snf_max,
+                step=table.step,
+            )
+            for milk_type, table in chart.tables.items()
+        },
+    )
@@ -0,0 +1,142 @@
+"""Checks of the paths that differ between SQLite and PostgreSQL.
+
+    DAIRY_DATABASE_URL=... python tests/backend_checks.py bulk_insert
+
+The app builds its engines from DAIRY_DATABASE_URL when it is imported, so
+test_backends.py runs each check in a process of its own, once per
+backend. A check raises (and the process exits non-zero) when it fails.
+"""
+import asyncio
+import datetime as _dt
+import sys
+
+import fastapi as _fastapi
+import sqlalchemy as _sql
+
+import database as _database, migrations as _migrations, models as _models
+import schemas as _schemas, services as _services
+
+CUSTOMER = dict(name="Asha", mobile="9876543210", email="asha@example.com", pan="ABCDE1234F", address="Anand")
+
+
+def _milk(customer_id, **values):
+    milk = dict(
+        customer_id=customer_id, customer_name="Asha", milk_type="Cow",
+        lit="2.5", fat="4.1", snf="8.5", amount="105.5", is_paid="No",
+    )
+    milk.update(values)
+    return milk
+
+
+async def _count(db, table: str):
+    return (await db.execute(_sql.text(f"SELECT count(*) FROM {table}"))).scalar()
+
+
+async def _milk_totals(db):
+    rows = await _services.get_milk_report(db, [_schemas.ReportGroup.day], _schemas.MilkFilter())
+    return [row.dict() for row in rows]
+
+
+async def bulk_insert(db):
+    """Bulk milk entries: executemany on SQLite, COPY on PostgreSQL."""
+    customer = await _services.create_customer(db, _schemas.CustomerCreate(**CUSTOMER))
+    records = [_milk(customer.id, lit=f"{liters}.5") for liters in range(1, 6)]
+    records.insert(2, _milk(customer.id, lit="not a number"))
+
+    result = await _services.create_milks_bulk(db, records)
+    assert (result.inserted, result.failed) == (5, 1), result
+    assert result.ids[2] is None and [error.index for error in result.errors] == [2]
+    for record, milk_id in zip(records, result.ids):
+        if milk_id is not None:
+            milk = await _services.get_milk(milk_id, db)
+            assert (milk.customer_id, milk.lit) == (customer.id, record["lit"]), milk
+
+    # A second batch draws fresh ids, and the rollup counts both.
+    again = await _services.create_milks_bulk(db, [_milk(customer.id)])
+    assert again.ids[0] not in result.ids
+    assert await _count(db, "milk") == 6
+    assert sum(row["entries"] for row in await _milk_totals(db)) == 6
+
+
+async def update_returning(db):
+    """Updates that read the changed row back with RETURNING."""
+    customer = await _services.create_customer(db, _schemas.CustomerCreate(**CUSTOMER))
+    updated = await _services.update_customer(customer.id, _schemas.CustomerUpdate(address="Nadiad"), db)
+    assert (updated.id, updated.name, updated.address) == (customer.id, "Asha", "Nadiad"), updated
+
+    milk = await _services.create_milk(db, _schemas.MilkCreate(**_milk(customer.id)))
+    updated = await _services.update_milk(milk.id, _schemas.MilkUpdate(lit="3.25", is_paid="Yes"), db)
+    assert (updated.lit, updated.is_paid, updated.milk_type) == ("3.25", "Yes", "Cow"), updated
+    assert (await _services.get_milk(milk.id, db)).lit == "3.25"
+    [row] = await _milk_totals(db)
+    assert (row["entries"], row["liters"]) == (1, "3.25"), row
+
+    for update in (
+        _services.update_customer(customer.id + 1, _schemas.CustomerUpdate(name="Nobody"), db),
+        _services.update_milk(milk.id + 1, _schemas.MilkUpdate(lit="1"), db),
+    ):
+        try:
+            await update
+        except _fastapi.HTTPException as missing:
+            assert missing.status_code == 404
+            await db.rollback()
+        else:
+            raise AssertionError("updated a row that does not exist")
+
+
+async def archive(db):
+    """Archiving, which locks each ledger on PostgreSQL while it moves rows."""
+    customer = await _services.create_customer(db, _schemas.CustomerCreate(**CUSTOMER))
+    old = _dt.datetime(2020, 3, 1, 6)
+    rows = [
+        dict(
+            customer_id=customer.id, customer_name="Asha", milk_type="Cow", lit="2.5", fat="4.1", snf="8.5",
+            amount="105.5", is_paid=day % 4 != 0, date_created=old + _dt.timedelta(days=day), date_last_updated=old,
+        )
+        for day in range(0, 400, 10)
+    ]
+    await db.execute(_sql.insert(_models.Milk), rows)
+    await db.execute(
+        _sql.insert(_models.Sale),
+        [dict(customername="Mehta", milk_type="Cow", lit="10", amount="400", is_paid=True, date_created=old)],
+    )
+    await db.commit()
+    await _services.rebuild_milk_rollups(db)
+    before = await _milk_totals(db)
+    sales = await _services.get_sale_report(db, [], _schemas.SaleFilter())
+
+    moved = await _services.archive_ledgers(db, before=_dt.date(2021, 1, 1), chunk_size=7)
+    paid = sum(1 for row in rows if row["is_paid"] and row["date_created"] < _dt.datetime(2021, 1, 1))
+    assert moved == {"milk": paid, "sale": 1, "purchase": 0}, moved
+    assert await _services.archive_ledgers(db, before=_dt.date(2021, 1, 1)) == {"milk": 0, "sale": 0, "purchase": 0}
+
+    assert await _count(db, "milk") == len(rows) - paid
+    assert await _milk_totals(db) == before
+    assert await _services.get_sale_report(db, [], _schemas.SaleFilter()) == sales
+
+    first = rows.index(next(row for row in rows if row["is_paid"])) + 1
+    try:
+        await _services.get_milk(first, db)
+    except _fastapi.HTTPException as missing:
+        assert missing.status_code == 404
+    else:
+        raise AssertionError("archived row is still in the ledger")
+    milk = await _services.get_milk(first, db, include_archived=True)
+    assert (milk.id, milk.is_paid) == (first, "Yes"), milk
+
+
+CHECKS = {check.__name__: check for check in (bulk_insert, update_returning, archive)}
+
+
+async def _run(check):
+    try:
+        async with _database.AsyncSessionLocal() as db:
+            await check(db)
+    finally:
+        await _database.async_engine.dispose()
+        await _database.read_engine.dispose()
+
+
+if __name__ == "__main__":
+    _migrations.migrate()
+    asyncio.run(_run(CHECKS[sys.argv[1]]))
@@ -0,0 +1,73 @@
+"""Runs each backend test against SQLite and against PostgreSQL.
+
+PostgreSQL is the server at DAIRY_TEST_POSTGRES_URL, or else a throwaway
+one started with benchmarks.postgres (binaries on PATH or in PG_BIN; initdb
+will not run as root). Without either the PostgreSQL cases are skipped.
+
+    python -m pytest tests
+"""
+import os
+import subprocess
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+@pytest.fixture(scope="session")
+def postgres_url(tmp_path_factory):
+    url = os.environ.get("DAIRY_TEST_POSTGRES_URL")
+    if url:
+        yield url
+        return
+    if os.geteuid() == 0:
+        pytest.skip("initdb will not run as root; set DAIRY_TEST_POSTGRES_URL")
+    pytest.importorskip("asyncpg")
+    pytest.importorskip("psycopg2")
+    from benchmarks import postgres as _postgres
+
+    server = _postgres.server(str(tmp_path_factory.mktemp("postgres")))
+    try:
+        url = server.__enter__()
+    except RuntimeError as error:
+        pytest.skip(str(error))
+    try:
+        yield url
+    finally:
+        server.__exit__(None, None, None)
+
+
+@pytest.fixture(params=["sqlite", "postgresql"])
+def database_url(request, tmp_path):
+    """A fresh, empty database of each backend."""
+    if request.param == "sqlite":
+        return f"sqlite+aiosqlite:///{tmp_path / 'dairy.db'}"
+    from benchmarks import postgres as _postgres
+
+    url = request.getfixturevalue("postgres_url")
+    _postgres._recreate(url)
+    return url
+
+
+@pytest.fixture
+def run_check(database_url, tmp_path):
+    """Run a check from backend_checks.py in its own process against ``database_url``."""
+
+    def run(name: str):
+        env = dict(
+            os.environ,
+            DAIRY_DATABASE_URL=database_url,
+            DAIRY_ARCHIVE_DIR=str(tmp_path / "archive"),
+            DAIRY_JOB_DIR=str(tmp_path / "job-results"),
+            PYTHONPATH=ROOT,
+        )
+        env.pop("DAIRY_READ_DATABASE_URL", None)
+        result = subprocess.run(
+            [sys.executable, os.path.join(ROOT, "tests", "backend_checks.py"), name],
+            cwd=tmp_path, env=env, capture_output=True, text=True, timeout=300,
+        )
+        assert result.returncode == 0, result.stdout + result.stderr
+
+    return run
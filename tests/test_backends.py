@@ -0,0 +1,13 @@
+"""Smoke tests of the paths where PostgreSQL and SQLite take different code."""
+
+
+def test_bulk_insert(run_check):
+    run_check("bulk_insert")
+
+
+def test_update_returning(run_check):
+    run_check("update_returning")
+
+
+def test_archive(run_check):
+    run_check("archive")
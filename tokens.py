@@ -0,0 +1,146 @@
+"""Access tokens: issuing, verifying and revoking.
+
+Tokens are HS256 JWTs that carry everything needed to authorize a request
+(user id, email, expiry, a unique ``jti``), so authentication never reads
+the users table. Verified tokens are kept in an LRU cache until they
+expire, which makes the common case a dictionary lookup.
+
+Revocations are held in memory and persisted by the caller; ``load_revoked``
+restores them at startup. With several API processes, a revocation takes
+effect in the others when they next restart.
+"""
+import collections
+import datetime as _dt
+import time
+import uuid
+
+import fastapi as _fastapi
+import jwt as _jwt
+
+import config as _config, instrumentation as _instrumentation, schemas as _schemas
+
+ALGORITHM = "HS256"
+
+
+def _unauthorized():
+    return _fastapi.HTTPException(
+        status_code=401,
+        detail="Invalid Email or Password",
+        headers={"WWW-Authenticate": "Bearer"},
+    )
+
+
+class TokenCache:
+    """Verified tokens, least recently used first, each kept until its expiry."""
+
+    def __init__(self, size: int):
+        self.size = size
+        self._entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, token: str):
+        entry = self._entries.get(token)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires, claims = entry
+        if expires <= time.time():
+            del self._entries[token]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(token)
+        self.hits += 1
+        return claims
+
+    def put(self, token: str, expires: float, claims):
+        if not self.size:
+            return
+        self._entries[token] = (expires, claims)
+        self._entries.move_to_end(token)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+
+    def discard(self, jti: str):
+        for token in [t for t, (_, claims) in self._entries.items() if claims.jti == jti]:
+            del self._entries[token]
+
+    def clear(self):
+        self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+cache = TokenCache(_config.settings.token_cache_size)
+
+# jti -> expiry timestamp of tokens revoked before they expired.
+_revoked = {}
+
+
+@_instrumentation.metrics.collector
+def _cache_metrics():
+    return [
+        ("dairy_token_cache_entries", "gauge", "Verified tokens held in memory.", len(cache)),
+        ("dairy_token_cache_hits_total", "counter", "Tokens found already verified.", cache.hits),
+        ("dairy_token_cache_misses_total", "counter", "Tokens whose signature was checked.", cache.misses),
+        ("dairy_token_revoked", "gauge", "Revoked tokens not yet expired.", len(_revoked)),
+    ]
+
+
+def issue(user: _schemas.User):
+    """Sign a token for ``user`` that expires after ``token_ttl_minutes``."""
+    now = int(time.time())
+    ttl = _config.settings.token_ttl_minutes * 60
+    payload = dict(
+        user.dict(),
+        sub=str(user.id),
+        jti=uuid.uuid4().hex,
+        iat=now,
+        exp=now + ttl,
+    )
+    token = _jwt.encode(payload, _config.settings.jwt_secret, algorithm=ALGORITHM)
+    return dict(access_token=token, token_type="bearer", expires_in=ttl)
+
+
+def verify(token: str):
+    """Return the claims of a valid token or raise a 401."""
+    claims = cache.get(token)
+    if claims is not None:
+        return claims
+
+    try:
+        payload = _jwt.decode(
+            token,
+            _config.settings.jwt_secret,
+            algorithms=[ALGORITHM],
+            options={"require": ["exp", "sub", "jti"]},
+        )
+        claims = _schemas.TokenClaims(**payload)
+    except (_jwt.PyJWTError, ValueError):
+        raise _unauthorized()
+
+    if claims.jti in _revoked:
+        raise _unauthorized()
+
+    cache.put(token, payload["exp"], claims)
+    return claims
+
+
+def revoke(jti: str, expires: float):
+    """Refuse the token with this ``jti`` from now on."""
+    _revoked[jti] = expires
+    cache.discard(jti)
+
+    now = time.time()
+    for stale in [j for j, exp in _revoked.items() if exp <= now]:
+        del _revoked[stale]
+
+
+def load_revoked(rows):
+    """Restore revocations from ``(jti, expires_at)`` rows."""
+    now = time.time()
+    for jti, expires_at in rows:
+        expires = expires_at.replace(tzinfo=_dt.timezone.utc).timestamp()
+        if expires > now:
+            _revoked[jti] = expires